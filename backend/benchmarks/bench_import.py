@@ -0,0 +1,87 @@
+"""
+Cold-start import benchmark.
+
+Measures how long a fresh interpreter takes to import the API module (the
+work an autoscaled worker does before it can serve) and fails when the
+median exceeds the budget. Also lists the slowest imports from -X importtime
+so regressions such as an eager torch or google.cloud.vision import are easy
+to spot.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --budget-ms 1000 --module utils.image_processing
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cold-start budget for `import main`, in milliseconds
+DEFAULT_BUDGET_MS = 1500
+
+# Modules that must never be imported eagerly by the API
+FORBIDDEN_MODULES = ("torch", "matplotlib", "google.cloud.vision")
+
+
+def time_import(module):
+    """Import module in a fresh interpreter; return (wall seconds, -X importtime output)"""
+    env = dict(os.environ, WARM_UP="0")
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{completed.stderr}")
+    return elapsed, completed.stderr
+
+
+def parse_importtime(output):
+    """Return [(cumulative microseconds, module)] from -X importtime output"""
+    rows = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.strip()))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    samples = []
+    output = ""
+    for _ in range(args.runs):
+        elapsed, output = time_import(args.module)
+        samples.append(elapsed * 1000)
+
+    median = statistics.median(samples)
+    print(f"import {args.module}: median {median:.0f} ms, min {min(samples):.0f} ms over {args.runs} runs "
+          f"(budget {args.budget_ms:.0f} ms, includes interpreter startup)")
+
+    rows = parse_importtime(output)
+    print(f"\nslowest imports (cumulative):")
+    for cumulative, name in sorted(rows, reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:10.1f} ms  {name}")
+
+    imported = {name for _, name in rows}
+    eager = [name for name in FORBIDDEN_MODULES if name in imported]
+    if eager:
+        raise SystemExit(f"\nFAIL: heavy modules imported eagerly: {', '.join(eager)}")
+    if median > args.budget_ms:
+        raise SystemExit(f"\nFAIL: cold start {median:.0f} ms exceeds budget {args.budget_ms:.0f} ms")
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    main()
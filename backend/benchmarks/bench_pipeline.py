@@ -0,0 +1,249 @@
+"""
+End-to-end benchmark and regression check for the OCR + segmentation API.
+
+Renders synthetic furniture sketches at several sizes, registers their words
+with the fake Vision client (no credentials or network needed) and posts
+them to /upload/ through the FastAPI app under concurrent load. Reports
+requests/sec, latency percentiles, per-stage latency (from the Server-Timing
+header) and peak RSS, then compares against the stored baseline:
+
+  * outputs (segments, links, measurements) must match exactly
+  * p50 latency and throughput must stay within --tolerance of the baseline
+
+Timing baselines are machine specific; record one on the machine that runs
+the comparison with --update-baseline.
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --sizes 800x600 1600x1200 --requests 32 --concurrency 8
+    python benchmarks/bench_pipeline.py --vision-latency 0.15 --update-baseline
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Measure the pipeline, not the OCR and result caches, and keep the app from
+# creating a real Vision client; must be set before the app is imported
+os.environ.setdefault("OCR_CACHE_SIZE", "0")
+os.environ.setdefault("RESULT_CACHE_SIZE", "0")
+os.environ.setdefault("VISION_CLIENT", "fake")
+os.environ.setdefault("OCR_BACKEND", "vision")
+
+import httpx
+
+from synthetic import draw_sketch, encode_sketch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = ["800x600", "1600x1200", "3200x2400"]
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def parse_server_timing(header):
+    """Return {stage: ms} from a Server-Timing header value"""
+    timings = {}
+    for part in filter(None, (p.strip() for p in header.split(","))):
+        name, _, duration = part.partition(";dur=")
+        if duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process plus the live segmentation worker
+    processes (worker peaks are read from /proc, so Linux only)
+    """
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is bytes on macOS, KiB elsewhere
+    total = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    for child in multiprocessing.active_children():
+        try:
+            with open(f"/proc/{child.pid}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return total
+
+
+def canonical_output(result):
+    """The parts of an /upload/ response that must not change between versions"""
+    text_result = result["text_result"]
+    segments_result = result["segments_result"]
+    return {
+        "measurements": [m["text"] for m in (text_result.get("measurements", []) if isinstance(text_result, dict) else [])],
+        "segments": [[s["bbox"], s["component_type"], s["vertices"], round(s["extent"], 6)]
+                     for s in segments_result.get("segments", [])],
+        "links": [[l["measurement_text"], l["segment_type"], l["segment_bbox"], l["distance"]]
+                  for l in result["linked_data"]],
+    }
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def load_test(client, images, requests, concurrency):
+    """Post images round-robin with `concurrency` requests in flight; return per-request samples"""
+    samples = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        name, data = images[i % len(images)]
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/upload/", files={"file": (name, data, "image/png")})
+            elapsed = time.perf_counter() - start
+        response.raise_for_status()
+        samples.append((elapsed, parse_server_timing(response.headers.get("server-timing", "")), response.json()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return samples, time.perf_counter() - start
+
+
+async def run(args):
+    from utils.fake_vision import FakeVisionClient
+    from utils.image_processing import set_vision_client
+    import main
+
+    fake = FakeVisionClient(latency=args.vision_latency)
+    set_vision_client(fake)
+
+    report = {"config": {"requests": args.requests, "concurrency": args.concurrency,
+                         "seeds": args.seeds, "vision_latency": args.vision_latency},
+              "sizes": {}, "outputs": {}}
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for size in args.sizes:
+                width, height = parse_size(size)
+                images = []
+                for seed in range(args.seeds):
+                    image, words = draw_sketch(width, height, seed=seed)
+                    data = encode_sketch(image)
+                    fake.add_image(data, words)
+                    images.append((f"sketch_{size}_{seed}.png", data))
+
+                # One warm-up request per image, which also provides the outputs to compare
+                for name, data in images:
+                    response = await client.post("/upload/", files={"file": (name, data, "image/png")})
+                    report["outputs"][name] = canonical_output(response.json())
+
+                samples, wall = await load_test(client, images, args.requests, args.concurrency)
+                latencies = [s[0] * 1000 for s in samples]
+                stages = {}
+                for _, timings, _ in samples:
+                    for name, ms in timings.items():
+                        stages.setdefault(name, []).append(ms)
+                report["sizes"][size] = {
+                    "requests_per_sec": round(len(samples) / wall, 2),
+                    "latency_ms": {"p50": round(percentile(latencies, 50), 1),
+                                   "p95": round(percentile(latencies, 95), 1),
+                                   "max": round(max(latencies), 1)},
+                    "stages_ms": {name: round(statistics.median(values), 1) for name, values in stages.items()},
+                    "peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+                }
+    return report
+
+
+def print_report(report):
+    print(f"{'size':>10} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'peak MB':>8}  stages (median ms)")
+    for size, row in report["sizes"].items():
+        stages = " ".join(f"{name}={ms}" for name, ms in row["stages_ms"].items() if name != "total")
+        peak = f"{row['peak_rss_mb']:8.1f}" if row["peak_rss_mb"] is not None else f"{'n/a':>8}"
+        print(f"{size:>10} {row['requests_per_sec']:7.2f} {row['latency_ms']['p50']:8.1f} "
+              f"{row['latency_ms']['p95']:8.1f} {peak}  {stages}")
+
+
+def compare(report, baseline, tolerance):
+    """Return a list of regressions relative to the baseline"""
+    problems = []
+    for name, output in report["outputs"].items():
+        expected = baseline.get("outputs", {}).get(name)
+        if expected is None:
+            continue
+        for key in ("measurements", "segments", "links"):
+            if output[key] != expected[key]:
+                problems.append(f"{name}: {key} differ from baseline "
+                                f"({len(output[key])} now, {len(expected[key])} in baseline)")
+
+    if report["config"] != baseline.get("config"):
+        print("\nnote: load settings differ from the baseline; skipping the timing comparison")
+        return problems
+
+    for size, row in report["sizes"].items():
+        expected = baseline.get("sizes", {}).get(size)
+        if expected is None:
+            continue
+        p50, expected_p50 = row["latency_ms"]["p50"], expected["latency_ms"]["p50"]
+        if p50 > expected_p50 * (1 + tolerance):
+            problems.append(f"{size}: p50 latency {p50} ms vs baseline {expected_p50} ms")
+        rps, expected_rps = row["requests_per_sec"], expected["requests_per_sec"]
+        if rps < expected_rps * (1 - tolerance):
+            problems.append(f"{size}: throughput {rps} req/s vs baseline {expected_rps} req/s")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, metavar="WIDTHxHEIGHT")
+    parser.add_argument("--seeds", type=int, default=2, help="distinct sketches per size")
+    parser.add_argument("--requests", type=int, default=16, help="requests per size")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--vision-latency", type=float, default=0.0, help="simulated Vision round-trip, seconds")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative timing regression")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"\nbaseline written to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline at {args.baseline}; run with --update-baseline to record one")
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = compare(report, baseline, args.tolerance)
+    if problems:
+        raise SystemExit("\nFAIL:\n  " + "\n  ".join(problems))
+    print("\nOK: outputs match the baseline" + (" and timings are within tolerance"
+                                                 if report["config"] == baseline.get("config") else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Accuracy vs latency of pyramid segmentation on large scans.
+
+Runs detect_segments at full resolution and in pyramid mode at several
+working sizes (with and without full-resolution refinement) on synthetic
+high-DPI sketches, and reports latency, peak traced memory and how closely
+the boxes match the full-resolution output.
+
+    VISION_CLIENT=fake python benchmarks/bench_pyramid.py
+    VISION_CLIENT=fake python benchmarks/bench_pyramid.py --size 6000 4000 --max-sides 1000 1500 2000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import draw_sketch
+from utils.image_processing import detect_segments, box_iou
+
+
+def match_boxes(reference, candidate, min_iou=0.8):
+    """Greedy one-to-one matching; returns (matched count, mean IoU of matches)"""
+    used = set()
+    ious = []
+    for ref in reference:
+        best, best_iou = None, min_iou
+        for i, seg in enumerate(candidate):
+            if i in used:
+                continue
+            iou = box_iou(ref["bbox"], seg["bbox"])
+            if iou >= best_iou:
+                best, best_iou = i, iou
+        if best is not None:
+            used.add(best)
+            ious.append(best_iou)
+    return len(ious), (sum(ious) / len(ious) if ious else 0.0)
+
+
+def run(image, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = detect_segments(image, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, nargs=2, default=[6000, 4000], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--max-sides", type=int, nargs="+", default=[1000, 1500, 2000, 3000])
+    parser.add_argument("--seeds", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = {}
+    for seed in range(args.seeds):
+        image, _ = draw_sketch(*args.size, seed=seed)
+        reference, ref_time, ref_peak = run(image, max_side=0)
+        ref_segments = reference["segments"]
+        rows.setdefault((None, False), []).append((ref_time, ref_peak, len(ref_segments), 1.0, 1.0))
+
+        for max_side in args.max_sides:
+            for refine in (False, True):
+                result, elapsed, peak = run(image, max_side=max_side, refine=refine)
+                matched, mean_iou = match_boxes(ref_segments, result["segments"])
+                rows.setdefault((max_side, refine), []).append(
+                    (elapsed, peak, len(result["segments"]), matched / max(len(ref_segments), 1), mean_iou)
+                )
+
+    print(f"{args.size[0]}x{args.size[1]} sketches, {args.seeds} seeds "
+          f"(recall = full-resolution boxes matched at IoU >= 0.8)")
+    print(f"{'mode':>18} {'latency ms':>11} {'peak MB':>8} {'segments':>9} {'recall':>7} {'mean IoU':>9}")
+    for (max_side, refine), samples in rows.items():
+        label = "full resolution" if max_side is None else f"{max_side}px{' +refine' if refine else ''}"
+        n = len(samples)
+        latency = sum(s[0] for s in samples) / n * 1000
+        peak = max(s[1] for s in samples) / 1e6
+        segments = sum(s[2] for s in samples) / n
+        recall = sum(s[3] for s in samples) / n
+        mean_iou = sum(s[4] for s in samples) / n
+        print(f"{label:>18} {latency:11.1f} {peak:8.1f} {segments:9.1f} {recall:7.2f} {mean_iou:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Segmentation process scaling benchmark.
+
+Runs bench_pipeline with 1, 2, 4, ... segmentation processes (up to the
+core count), for both ways of handing images to the processes (shared
+memory and encoded bytes, see SEGMENTATION_SHARED_MEMORY). Prints
+throughput per configuration and the scaling efficiency relative to one
+process; near 1.0 means throughput grows linearly with cores.
+
+    python benchmarks/bench_workers.py
+    python benchmarks/bench_workers.py --processes 1 4 16 --size 3200x2400 --requests 64
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+TRANSPORTS = {"shared_memory": "1", "bytes": "0"}
+
+
+def default_processes():
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def run_pipeline(processes, transport, args):
+    """Run bench_pipeline in a fresh interpreter; return requests/sec"""
+    with tempfile.TemporaryDirectory() as tmp:
+        report_path = os.path.join(tmp, "report.json")
+        env = dict(
+            os.environ,
+            SEGMENTATION_PROCESSES=str(processes),
+            SEGMENTATION_SHARED_MEMORY=TRANSPORTS[transport],
+            # Keep every process busy
+            MAX_CONCURRENT_UPLOADS=str(processes * 2),
+        )
+        completed = subprocess.run(
+            [sys.executable, os.path.join(BENCH_DIR, "bench_pipeline.py"), "--sizes", args.size,
+             "--requests", str(args.requests), "--concurrency", str(processes * 2),
+             "--baseline", os.path.join(tmp, "none.json"), "--json", report_path],
+            cwd=BACKEND_DIR, env=env, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            raise SystemExit(f"bench_pipeline failed:\n{completed.stderr[-2000:]}")
+        with open(report_path, "r", encoding="utf-8") as f:
+            return json.load(f)["sizes"][args.size]["requests_per_sec"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=default_processes())
+    parser.add_argument("--size", default="1600x1200", metavar="WIDTHxHEIGHT")
+    parser.add_argument("--requests", type=int, default=32, help="requests per configuration")
+    parser.add_argument("--transports", nargs="+", choices=list(TRANSPORTS), default=list(TRANSPORTS))
+    args = parser.parse_args()
+
+    print(f"{'processes':>9} " + " ".join(f"{name + ' req/s':>20} {'efficiency':>10}" for name in args.transports))
+    single = {}
+    for processes in args.processes:
+        cells = []
+        for transport in args.transports:
+            rps = run_pipeline(processes, transport, args)
+            single.setdefault(transport, rps / processes)
+            cells.append(f"{rps:20.2f} {rps / (processes * single[transport]):10.2f}")
+        print(f"{processes:>9} " + " ".join(cells))
+
+
+if __name__ == "__main__":
+    main()
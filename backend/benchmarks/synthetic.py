@@ -0,0 +1,121 @@
+"""
+Synthetic furniture sketches for benchmarks.
+
+draw_sketch renders a table/cabinet style line drawing with dimension labels
+(optionally on dimension lines) and returns the image together with the words
+a Vision OCR pass would find, so the same sketch can be registered with the
+fake Vision client.
+"""
+import cv2
+import numpy as np
+
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+def _put_label(image, words, text, x, y, scale, thickness):
+    (w, h), baseline = cv2.getTextSize(text, FONT, scale, thickness)
+    cv2.putText(image, text, (int(x), int(y)), FONT, scale, (0, 0, 0), thickness, cv2.LINE_AA)
+    words.append({"text": text, "bbox": [int(x), int(y) - h, int(w), int(h + baseline)], "confidence": 0.98})
+
+
+def _wobbly_rect(image, rng, x0, y0, x1, y1, thickness, jitter):
+    """Rectangle drawn as four slightly uneven strokes, like a pen sketch"""
+    corners = np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.float64)
+    corners += rng.uniform(-jitter, jitter, corners.shape)
+    cv2.polylines(image, [corners.astype(np.int32)], True, (0, 0, 0), thickness, cv2.LINE_AA)
+
+
+def _arrow_line(image, words, text, x0, x1, y, unit, line_thickness, text_scale, text_thickness):
+    """Horizontal dimension line from x0 to x1 with arrowheads, broken around its label"""
+    (w, h), _ = cv2.getTextSize(text, FONT, text_scale, text_thickness)
+    middle = (x0 + x1) / 2
+    for tip, inner in ((x0, middle - w / 2 - unit), (x1, middle + w / 2 + unit)):
+        cv2.line(image, (int(tip), int(y)), (int(inner), int(y)), (0, 0, 0), line_thickness, cv2.LINE_AA)
+        back = tip + (unit * 1.5 if inner > tip else -unit * 1.5)
+        head = np.array([[tip, y], [back, y - unit * 0.5], [back, y + unit * 0.5]], dtype=np.int32)
+        cv2.fillConvexPoly(image, head, (0, 0, 0), cv2.LINE_AA)
+    _put_label(image, words, text, middle - w / 2, y + h / 2, text_scale, text_thickness)
+
+
+def _tick_line(image, x, y0, y1, unit, line_thickness):
+    """Vertical dimension line from y0 to y1 with oblique ticks at both ends"""
+    cv2.line(image, (int(x), int(y0)), (int(x), int(y1)), (0, 0, 0), line_thickness, cv2.LINE_AA)
+    for y in (y0, y1):
+        cv2.line(image, (int(x - unit * 0.8), int(y + unit * 0.8)), (int(x + unit * 0.8), int(y - unit * 0.8)),
+                 (0, 0, 0), line_thickness, cv2.LINE_AA)
+
+
+def draw_sketch(width=1600, height=1200, seed=0, noise=True, dimensions=False):
+    """
+    Return (BGR image, words) for a synthetic furniture sketch. With
+    dimensions, the table top width and leg height labels go with dimension
+    lines (arrowheads and ticks respectively).
+    """
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    words = []
+
+    unit = min(width, height) / 100
+    thickness = max(2, int(round(unit * 0.4)))
+    jitter = unit * 0.15
+    text_scale = unit * 0.06
+    text_thickness = max(1, thickness // 2)
+
+    # Table top
+    left, right = width * 0.12, width * 0.88
+    top, top_bottom = height * 0.12, height * 0.22
+    _wobbly_rect(image, rng, left, top, right, top_bottom, thickness, jitter)
+    line_thickness = max(3, thickness // 2 + 1)
+    if dimensions:
+        _arrow_line(image, words, f"{int(rng.integers(90, 240))}cm", left, right, top - unit * 3, unit,
+                    line_thickness, text_scale, text_thickness)
+    else:
+        _put_label(image, words, f"{int(rng.integers(90, 240))}cm", width * 0.45, top - unit * 2, text_scale, text_thickness)
+
+    # Legs
+    leg_w = width * 0.03
+    for leg_x in (left + unit * 2, right - unit * 2 - leg_w):
+        _wobbly_rect(image, rng, leg_x, top_bottom, leg_x + leg_w, height * 0.9, thickness, jitter)
+    _put_label(image, words, f"{int(rng.integers(60, 110))}cm", left - unit * 10, height * 0.55, text_scale, text_thickness)
+    if dimensions:
+        _tick_line(image, left - unit * 4, top_bottom, height * 0.9, unit, line_thickness)
+
+    # Drawer section with drawers
+    section_left, section_right = width * 0.3, width * 0.7
+    section_top, section_bottom = top_bottom + unit * 2, height * 0.62
+    _wobbly_rect(image, rng, section_left, section_top, section_right, section_bottom, thickness, jitter)
+    n_drawers = int(rng.integers(2, 4))
+    drawer_h = (section_bottom - section_top - unit * 2) / n_drawers
+    for i in range(n_drawers):
+        d_top = section_top + unit + i * drawer_h
+        _wobbly_rect(image, rng, section_left + unit, d_top + unit * 0.5,
+                     section_right - unit, d_top + drawer_h - unit * 0.5, thickness, jitter)
+        cx = (section_left + section_right) / 2
+        cv2.circle(image, (int(cx), int(d_top + drawer_h / 2)), max(2, int(unit * 0.6)), (0, 0, 0), thickness)
+    _put_label(image, words, f"{int(rng.integers(30, 80))}cm", section_right + unit * 2, (section_top + section_bottom) / 2,
+               text_scale, text_thickness)
+
+    # Stretcher between the legs
+    _wobbly_rect(image, rng, left + unit * 2 + leg_w, height * 0.78, right - unit * 2 - leg_w, height * 0.8,
+                 thickness, jitter)
+
+    _put_label(image, words, "Desk", width * 0.05, height * 0.05 + unit * 2, text_scale, text_thickness)
+
+    if noise:
+        # Paper grain and stray pencil marks
+        grain = rng.normal(0, 6, image.shape[:2])
+        image = np.clip(image.astype(np.float64) - np.abs(grain)[..., None], 0, 255).astype(np.uint8)
+        for _ in range(int(20 * width * height / 1e6) + 5):
+            x, y = rng.integers(0, width), rng.integers(0, height)
+            dx, dy = rng.integers(-int(unit * 3), int(unit * 3) + 1, 2)
+            cv2.line(image, (int(x), int(y)), (int(x + dx), int(y + dy)), (90, 90, 90), 1, cv2.LINE_AA)
+
+    return image, words
+
+
+def encode_sketch(image, ext=".png"):
+    ok, encoded = cv2.imencode(ext, image)
+    if not ok:
+        raise ValueError("Failed to encode sketch")
+    return encoded.tobytes()
@@ -1,13 +1,43 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, UploadFile, File, Form, Query, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-import shutil
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import json
 import os
+import logging
 
-from utils.image_processing import extract_text, extract_segments, visualize_segments, link_measurements_to_segments
+from utils.pipeline import analyze_image_async, analyze_images_batch, update_analysis_async, shutdown_pools, warm_up
+from utils.visualization import overlay_cache
+from utils.instrumentation import configure_logging, TimingMiddleware, metrics, stage
+from utils.tables import dumps
+from utils.jobs import JobQueue, QueueFull
 
 
-app = FastAPI()
+configure_logging()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # WARM_UP and job_queue are defined below, before the app starts
+    if WARM_UP:
+        warm_up()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    shutdown_pools()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class ResultResponse(JSONResponse):
+    """JSON response for pipeline results; WordTable/SegmentTable become word/segment dicts here"""
+
+    def render(self, content):
+        return dumps(content)
+
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,10 +45,41 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(TimingMiddleware)
+
+MAX_BATCH_FILES = int(os.getenv("MAX_BATCH_FILES", "64"))
+
+# Per-request OCR choice: "auto" (Vision, local fallback), "cheapest" or a
+# single backend. Defaults to OCR_BACKEND.
+OCR_BACKEND_PATTERN = "^(auto|cheapest|vision|tesseract)$"
+
+# Per-request segmentation method; defaults to SEGMENTATION_METHOD
+SEGMENTATION_METHOD_PATTERN = "^(hierarchy_based_segmentation|connected_components)$"
+
+# Create the Vision client and start the worker pools at startup instead of on
+# the first request. Set WARM_UP=0 for the fastest possible boot.
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+
+
 
-UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
+async def analyze_upload(data, visualize=False, overlay_format="png", ocr_backend=None, method=None, use_cache=True):
+    """Run the pipeline on uploaded bytes and register the overlay, if one was rendered"""
+    result, overlay = await analyze_image_async(data, visualize, overlay_format, ocr_backend, method, use_cache)
+    
+    if overlay is not None:
+        overlay_id = overlay_cache.put(overlay, overlay_format)
+        result["overlay"] = {
+            "id": overlay_id,
+            "format": overlay_format,
+            "url": f"/overlays/{overlay_id}",
+        }
+    return result
+
+
+# Background jobs for uploads that should not hold the connection open
+job_queue = JobQueue(lambda job: analyze_upload(job.data, **job.options))
 
 
 @app.get("/")
@@ -27,66 +88,161 @@ async def root():
 
 
 @app.post("/upload/")
-async def upload_image(file: UploadFile = File(...)):
+async def upload_image(
+    file: UploadFile = File(...),
+    visualize: bool = Query(False, description="Render a segment/link overlay image"),
+    overlay_format: str = Query("png", pattern="^(png|jpe?g)$"),
+    ocr_backend: Optional[str] = Query(None, pattern=OCR_BACKEND_PATTERN, description="OCR backend or policy"),
+    method: Optional[str] = Query(None, pattern=SEGMENTATION_METHOD_PATTERN, description="Segmentation method"),
+    cache: bool = Query(True, description="Serve cached results for identical or near-duplicate uploads"),
+):
     """Upload image, extract text, and detect segments"""
     
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    
     try:
-        # Save uploaded file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        print(f"File saved: {file_path}")
-        
-        # Extract text using OCR
-        print("Starting text extraction...")
-        text_result = extract_text(file_path)
-        if isinstance(text_result, dict):
-            print(f"Text extraction result: {text_result.get('status', 'unknown')}")
-        else:
-            print(f"Extracted {len(text_result)} text items")
-
-        
-        # Extract segments using CV
-        print("Starting segmentation...")
-        segments_result = extract_segments(file_path)
-        print(f"Segmentation result: {segments_result.get('status', 'unknown')}")
+        # Keep the upload in memory; the same bytes go to Vision and OpenCV
+        with stage("upload"):
+            data = await file.read()
+        logger.info("Received %s (%d bytes)", file.filename, len(data))
         
-        # Don't visualize in API - it blocks
-        visualize_segments(file_path, segments_result)
-        
-        # Link measurements to nearest segments
-        print("Linking measurements to segments...")
-        linked_data = link_measurements_to_segments(
-            text_result if isinstance(text_result, list) else text_result.get("details", []),
-            segments_result.get("segments", [])
-        )
-
-        print(f"Linked {len(linked_data)} measurements to segments")
-
-        # Combine results
-        result = {
-            "text_result": text_result,
-            "segments_result": segments_result,
-            "linked_data": linked_data,   # <-- added this line
-        }
+        # Run OCR once and share it between segmentation and linking.
+        # The overlay is only rendered when asked for.
+        result = await analyze_upload(data, visualize, overlay_format, ocr_backend, method, cache)
 
-        return JSONResponse(content=result)
+        return ResultResponse(content=result)
     
     except Exception as e:
         import traceback
         error_detail = traceback.format_exc()
-        print(f"ERROR in upload endpoint: {error_detail}")
+        logger.error("ERROR in upload endpoint: %s", error_detail)
         return JSONResponse(
             status_code=500,
             content={"error": str(e), "detail": error_detail}
         )
+
+
+@app.post("/results/{result_id}/update")
+async def update_result(
+    result_id: str,
+    file: UploadFile = File(...),
+    regions: Optional[str] = Form(None, description="JSON list of changed [x, y, w, h] rects; default: diff against the previous image"),
+):
+    """Re-analyze an edited version of an /upload/ result, processing only the changed regions"""
+    
+    rects = None
+    if regions:
+        try:
+            rects = [[int(value) for value in rect] for rect in json.loads(regions)]
+            if any(len(rect) != 4 for rect in rects):
+                raise ValueError("rects must have 4 values")
+        except (ValueError, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid regions: {e}")
+    
+    with stage("upload"):
+        data = await file.read()
+    logger.info("Received update of %s: %s (%d bytes)", result_id, file.filename, len(data))
+    
+    try:
+        result = await update_analysis_async(result_id, data, rects)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found or expired")
+    return ResultResponse(content=result)
+
+
+@app.post("/upload/batch/")
+async def upload_batch(
+    files: List[UploadFile] = File(...),
+    ocr_backend: Optional[str] = Query(None, pattern=OCR_BACKEND_PATTERN, description="OCR backend or policy"),
+    method: Optional[str] = Query(None, pattern=SEGMENTATION_METHOD_PATTERN, description="Segmentation method"),
+):
+    """Upload many images; results stream back as NDJSON, one line per image as it finishes"""
+    
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_FILES} files per batch")
+    
+    with stage("upload"):
+        images = [await file.read() for file in files]
+    filenames = [file.filename for file in files]
+    logger.info("Received batch of %d files", len(images))
+    
+    async def stream_results():
+        async for index, result in analyze_images_batch(images, ocr_backend, method):
+            line = {"index": index, "filename": filenames[index], **result}
+            yield dumps(line) + b"\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+@app.post("/jobs/", status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    visualize: bool = Query(False, description="Render a segment/link overlay image"),
+    overlay_format: str = Query("png", pattern="^(png|jpe?g)$"),
+    ocr_backend: Optional[str] = Query(None, pattern=OCR_BACKEND_PATTERN, description="OCR backend or policy"),
+    method: Optional[str] = Query(None, pattern=SEGMENTATION_METHOD_PATTERN, description="Segmentation method"),
+    priority: int = Query(0, ge=-10, le=10, description="Higher runs first"),
+    cache: bool = Query(True, description="Serve cached results for identical or near-duplicate uploads"),
+):
+    """Queue an image for analysis and return the job id immediately"""
     
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            print(f"File deleted: {file_path}")
+    with stage("upload"):
+        data = await file.read()
+    
+    options = {"visualize": visualize, "overlay_format": overlay_format, "ocr_backend": ocr_backend, "method": method,
+               "use_cache": cache}
+    try:
+        job = await job_queue.submit(data, file.filename, options, priority)
+    except QueueFull as e:
+        # Backpressure: ask the client to retry instead of queueing without bound
+        return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
+    
+    logger.info("Queued job %s for %s (%d bytes)", job.id, file.filename, len(data))
+    return {
+        "id": job.id,
+        "status": job.status,
+        "url": f"/jobs/{job.id}",
+        "events": f"/jobs/{job.id}/events",
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job status, per-stage timings and, once done, the /upload/ result"""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ResultResponse(content=job.summary())
+
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-sent events: queued, started, one per pipeline stage, then done or failed"""
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def stream_events():
+        async for event, data in job.stream():
+            yield b"event: " + event.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+    
+    return StreamingResponse(stream_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Per-stage latency histograms and request counters in Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/overlays/{overlay_id}")
+async def get_overlay(overlay_id: str):
+    """Return a rendered overlay produced by /upload/?visualize=true"""
+    entry = overlay_cache.get(overlay_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Overlay not found or expired")
+    media_type, data = entry
+    return Response(content=data, media_type=media_type)
 
 if __name__ == "__main__":
     import uvicorn
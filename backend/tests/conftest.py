@@ -0,0 +1,44 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+from utils.ocr_backends import get_vision_client, set_vision_client
+from utils.ocr_cache import ocr_cache
+from utils.pipeline import shutdown_pools
+from utils.result_cache import result_cache
+
+
+@pytest.fixture
+def fake_vision(monkeypatch):
+    """The app's Vision client, created as VISION_CLIENT=fake would at startup, with empty caches"""
+    monkeypatch.setenv("VISION_CLIENT", "fake")
+    set_vision_client(None)
+    ocr_cache.clear()
+    result_cache.clear()
+    yield get_vision_client()
+    set_vision_client(None)
+    ocr_cache.clear()
+    result_cache.clear()
+    shutdown_pools()
+
+
+@pytest.fixture
+def run_app():
+    """
+    Run an async function of an httpx client talking to the app, in one
+    event loop; with lifespan=True the app's startup and shutdown run around
+    it (job queue, worker pools)
+    """
+    def run(fn, lifespan=False):
+        async def session():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+                return await fn(client)
+
+        async def session_in_lifespan():
+            async with main.app.router.lifespan_context(main.app):
+                return await session()
+        return asyncio.run(session_in_lifespan() if lifespan else session())
+    return run
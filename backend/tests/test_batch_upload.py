@@ -0,0 +1,47 @@
+import math
+
+import cv2
+import numpy as np
+import orjson
+
+from utils.ocr_backends import VISION_BATCH_LIMIT
+
+
+def sketch(rng):
+    """A small encoded drawing; random noise in one corner keeps its bytes (and cache keys) unique"""
+    image = np.full((96, 128, 3), 255, dtype=np.uint8)
+    cv2.rectangle(image, (16, 24), (112, 72), (0, 0, 0), 2)
+    image[:8, :8] = rng.integers(0, 256, (8, 8, 1), dtype=np.uint8)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def post_batch(run_app, files):
+    async def post(client):
+        response = await client.post("/upload/batch/", files=files)
+        response.raise_for_status()
+        return response
+    response = run_app(post)
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    return [orjson.loads(line) for line in response.text.splitlines()]
+
+
+def test_batch_streams_one_line_per_image(fake_vision, run_app):
+    rng = np.random.default_rng()
+    images = [sketch(rng) for _ in range(VISION_BATCH_LIMIT + 2)]
+    fake_vision.add_image(images[0], [{"text": "120cm", "bbox": [40, 76, 48, 14]}])
+    files = [("files", (f"{i}.png", data, "image/png")) for i, data in enumerate(images)]
+    files.append(("files", ("broken.png", b"not an image", "image/png")))
+
+    lines = post_batch(run_app, files)
+
+    assert sorted(line["index"] for line in lines) == list(range(len(files)))
+    by_index = {line["index"]: line for line in lines}
+    for index, (_, (filename, _, _)) in enumerate(files):
+        assert by_index[index]["filename"] == filename
+
+    assert [word["text"] for word in by_index[0]["text_result"]["details"]] == ["120cm"]
+    assert "error" not in by_index[1]["segments_result"]
+    assert by_index[len(images)]["segments_result"] == {"error": "Failed to read image"}
+
+    assert fake_vision.calls["batch_annotate_images"] == math.ceil(len(files) / VISION_BATCH_LIMIT)
+    assert fake_vision.calls["document_text_detection"] == 0
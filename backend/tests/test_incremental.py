@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+
+from utils import incremental
+from utils.tables import WordTable
+
+WORDS = [
+    {"text": "W:120cm", "bbox": [40, 20, 80, 16]},
+    {"text": "60cm", "bbox": [220, 22, 50, 16]},
+    {"text": "H=87cm", "bbox": [40, 60, 70, 16]},
+]
+ADDED = {"text": "45cm", "bbox": [220, 58, 50, 16]}
+
+
+def draw(words, rng):
+    image = np.full((240, 320, 3), 255, dtype=np.uint8)
+    cv2.rectangle(image, (30, 110), (290, 220), (0, 0, 0), 3)
+    image[:4, :4] = rng.integers(0, 256, (4, 4, 1), dtype=np.uint8)
+    for word in words:
+        x, y, w, h = word["bbox"]
+        cv2.rectangle(image, (x, y + 4), (x + w, y + h - 4), (0, 0, 0), -1)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def test_update_keeps_full_text_lines_of_a_full_run(fake_vision, run_app, monkeypatch):
+    rng = np.random.default_rng()
+    before, after = draw(WORDS, rng), draw(WORDS + [ADDED], rng)
+    fake_vision.add_image(before, WORDS)
+    fake_vision.add_image(after, WORDS + [ADDED])
+
+    def ocr_region(image, box, backend=None):
+        # What OCR of the crop would find, in image coordinates
+        x0, y0, x1, y1 = box
+        inside = [word for word in WORDS + [ADDED] if word["bbox"][0] >= x0 and word["bbox"][1] >= y0
+                  and word["bbox"][0] + word["bbox"][2] <= x1 and word["bbox"][1] + word["bbox"][3] <= y1]
+        return WordTable([word["text"] for word in inside], [0.99] * len(inside),
+                         [(x, y, x + w, y + h) for x, y, w, h in (word["bbox"] for word in inside)])
+    monkeypatch.setattr(incremental, "ocr_region", ocr_region)
+
+    async def analyze(client):
+        files = {"file": ("before.png", before, "image/png")}
+        original = (await client.post("/upload/", files=files)).json()
+        files = {"file": ("after.png", after, "image/png")}
+        updated = (await client.post(f"/results/{original['result_id']}/update", files=files)).json()
+        # Not from the result cache, which would give the near-duplicate original
+        full = (await client.post("/upload/?cache=false", files=files)).json()
+        return original, updated, full
+    original, updated, full = run_app(analyze)
+
+    assert original["text_result"]["full_text"] == "W:120cm 60cm\nH=87cm\n"
+    assert updated["incremental"]["words_added"] == 1
+    assert updated["text_result"]["full_text"] == "W:120cm 60cm\nH=87cm 45cm\n"
+    assert updated["text_result"]["full_text"] == full["text_result"]["full_text"]
+    assert ([(word["text"], word["bbox"]) for word in updated["text_result"]["details"]]
+            == [(word["text"], word["bbox"]) for word in full["text_result"]["details"]])
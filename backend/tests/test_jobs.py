@@ -0,0 +1,109 @@
+import asyncio
+
+import cv2
+import numpy as np
+import orjson
+
+import main
+from utils.jobs import DONE, QUEUED, RUNNING, Job, JobQueue, JobStore
+
+WORDS = [{"text": "120cm", "bbox": [40, 20, 60, 16]}]
+
+
+def sketch():
+    image = np.full((120, 160, 3), 255, dtype=np.uint8)
+    cv2.rectangle(image, (20, 40), (140, 100), (0, 0, 0), 2)
+    image[:4, :4] = np.random.default_rng().integers(0, 256, (4, 4, 1), dtype=np.uint8)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        event, data = block.split("\n", 1)
+        events.append((event.removeprefix("event: "), orjson.loads(data.removeprefix("data: "))))
+    return events
+
+
+def test_job_runs_to_done(fake_vision, run_app):
+    data = sketch()
+    fake_vision.add_image(data, WORDS)
+
+    async def submit_and_follow(client):
+        submitted = await client.post("/jobs/", files={"file": ("a.png", data, "image/png")})
+        job_id = submitted.json()["id"]
+        events = await client.get(f"/jobs/{job_id}/events")
+        job = await client.get(f"/jobs/{job_id}")
+        return submitted, events, job
+    submitted, events, job = run_app(submit_and_follow, lifespan=True)
+
+    assert submitted.status_code == 202
+    assert submitted.json()["status"] == QUEUED
+    names = [event for event, _ in parse_events(events.text)]
+    assert names[:2] == [QUEUED, "started"] and names[-1] == DONE
+    assert "stage" in names
+
+    summary = job.json()
+    assert summary["status"] == DONE and summary["error"] is None
+    assert [word["text"] for word in summary["result"]["text_result"]["details"]] == ["120cm"]
+    assert summary["stages"]
+
+
+def test_full_queue_rejects_with_429(fake_vision, run_app, monkeypatch):
+    monkeypatch.setattr(main.job_queue, "max_size", 0)
+
+    async def submit(client):
+        return await client.post("/jobs/", files={"file": ("a.png", sketch(), "image/png")})
+    response = run_app(submit, lifespan=True)
+
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "5"
+
+
+def test_unknown_job_is_404(fake_vision, run_app):
+    async def lookup(client):
+        return await client.get("/jobs/missing"), await client.get("/jobs/missing/events")
+    status, events = run_app(lookup, lifespan=True)
+    assert status.status_code == 404
+    assert events.status_code == 404
+
+
+def test_unfinished_jobs_are_restored_from_the_store(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    store = JobStore(path)
+    queued, running = Job(b"first", "a.png"), Job(b"second", "b.png", priority=1)
+    running.status = RUNNING
+    for job in (queued, running):
+        store.save(job)
+    store.close()
+
+    async def restart():
+        handled = []
+
+        async def handler(job):
+            handled.append(job.id)
+            return {"size": len(job.data)}
+        jobs = JobQueue(handler, db_path=path)
+        await jobs.start()
+        try:
+            restored = await jobs.get(queued.id)
+            for _ in range(100):
+                if len(handled) == 2:
+                    break
+                await asyncio.sleep(0.01)
+            return handled, restored, await jobs.get(running.id)
+        finally:
+            await jobs.stop()
+    handled, restored, finished = asyncio.run(restart())
+
+    assert handled == [running.id, queued.id]  # higher priority first
+    assert restored.filename == "a.png"
+    assert finished.status == DONE and finished.result == {"size": 6}
+
+    # Finished jobs are loaded from the store after a restart, without their upload
+    store = JobStore(path)
+    try:
+        reloaded = store.load(queued.id)
+    finally:
+        store.close()
+    assert reloaded.status == DONE and reloaded.result == {"size": 5} and reloaded.data is None
@@ -0,0 +1,104 @@
+import asyncio
+
+import cv2
+import numpy as np
+from google.cloud import vision
+
+from utils import ocr_backends
+from utils.ocr_backends import OCRBackend, build_text_result
+from utils.result_cache import HIT, MISS, NEAR_DUPLICATE, ResultCache, result_cache
+from utils.tables import WordTable
+
+WORDS = [{"text": "120cm", "bbox": [60, 20, 60, 16]}]
+
+
+def sketch(speck=None):
+    """An encoded drawing; speck=(x, y) adds a dot, a near-duplicate of the plain one"""
+    image = np.full((240, 320, 3), 255, dtype=np.uint8)
+    cv2.rectangle(image, (40, 60), (280, 200), (0, 0, 0), 3)
+    cv2.line(image, (40, 130), (280, 130), (0, 0, 0), 3)
+    if speck is not None:
+        cv2.circle(image, speck, 2, (0, 0, 0), -1)
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+def upload_all(run_app, uploads, pause=0):
+    async def post(client):
+        results = []
+        for i, data in enumerate(uploads):
+            if i:
+                await asyncio.sleep(pause)
+            response = await client.post("/upload/", files={"file": ("a.png", data, "image/png")})
+            response.raise_for_status()
+            results.append(response.json())
+        return results
+    return run_app(post)
+
+
+def vision_calls(fake):
+    return fake.calls["document_text_detection"] + fake.calls["batch_annotate_images"]
+
+
+def test_identical_upload_is_an_exact_hit(fake_vision, run_app):
+    data = sketch()
+    fake_vision.add_image(data, WORDS)
+    first, second = upload_all(run_app, [data, data])
+
+    assert first["cache"]["status"] == MISS
+    assert second["cache"]["status"] == HIT
+    assert second["text_result"] == first["text_result"]
+    assert second["segments_result"] == first["segments_result"]
+    assert vision_calls(fake_vision) == 1
+
+
+def test_near_duplicate_upload_gets_the_cached_result(fake_vision, run_app):
+    original, edited = sketch(), sketch(speck=(300, 20))
+    fake_vision.add_image(original, WORDS)
+    first, second = upload_all(run_app, [original, edited])
+
+    assert second["cache"]["status"] == NEAR_DUPLICATE
+    assert second["cache"]["distance"] <= result_cache.max_distance
+    assert second["text_result"] == first["text_result"]
+    assert vision_calls(fake_vision) == 1
+
+
+class LocalBackend(OCRBackend):
+    name = "local"
+
+    def recognize(self, content):
+        return build_text_result("120cm", WordTable(["120cm"], [0.9], [(60, 20, 60, 16)]), self.name)
+
+
+def test_fallback_results_are_not_cached(fake_vision, run_app, monkeypatch):
+    monkeypatch.setitem(ocr_backends.BACKENDS, "local", LocalBackend())
+    monkeypatch.setattr(ocr_backends, "OCR_BACKENDS", ["vision", "local"])
+    monkeypatch.setattr(
+        fake_vision, "_respond", lambda image: vision.AnnotateImageResponse(error={"code": 3, "message": "bad image"})
+    )
+    data = sketch()
+    first, second = upload_all(run_app, [data, data])
+
+    assert first["text_result"]["backend"] == second["text_result"]["backend"] == "local"
+    assert first["cache"]["status"] == second["cache"]["status"] == MISS
+    assert len(result_cache) == 0
+
+
+def test_entries_expire_after_the_ttl(fake_vision, run_app, monkeypatch):
+    monkeypatch.setattr(result_cache, "ttl", 0.05)
+    data = sketch()
+    fake_vision.add_image(data, WORDS)
+    first, second = upload_all(run_app, [data, data], pause=0.1)
+
+    assert first["cache"]["status"] == second["cache"]["status"] == MISS
+    assert len(result_cache) == 1  # stored again after expiring
+
+
+def test_put_leaves_out_raw_segments():
+    cache = ResultCache(max_entries=4)
+    segments_result = {"status": "success", "segments": [], "raw_segments": ["contours"]}
+    cache.put("key", ("auto",), (0, (320, 240)), {"backend": "vision"}, segments_result, "result-1")
+
+    text_result, cached_segments, result_id = cache.get("key")
+    assert "raw_segments" not in cached_segments
+    assert "raw_segments" in segments_result  # the caller's result is left alone
+    assert result_id == "result-1"
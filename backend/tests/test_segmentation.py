@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from benchmarks.bench_nms import reference_suppress, synthetic_boxes
+from benchmarks.synthetic import draw_sketch
+from utils import nms
+from utils.classifier import ComponentClassifier, segment_features
+from utils.image_processing import COMPONENTS_METHOD, detect_segments, remove_overlapping_segments_smart
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("n", [1, 50, 2000])
+def test_suppress_overlaps_matches_the_nested_loop(seed, n):
+    boxes = synthetic_boxes(n, seed=seed)
+    assert nms.suppress_overlaps(boxes) == reference_suppress(boxes)
+
+
+def test_suppress_overlaps_matches_the_nested_loop_across_batches(monkeypatch):
+    monkeypatch.setattr(nms, "PAIR_CHUNK", 7)
+    rng = np.random.default_rng(0)
+    boxes = np.column_stack([rng.uniform(0, 500, (300, 2)), rng.uniform(0, 120, (300, 2))])
+    boxes[::25, 2] = 0  # degenerate boxes are never suppressed, nor suppress others
+    assert nms.suppress_overlaps(boxes, 0.5) == reference_suppress(boxes.tolist(), 0.5)
+
+
+def segment_rows(result):
+    assert result.get("status") == "success", result
+    return sorted(tuple(segment.values()) for segment in result["segments"].to_dicts())
+
+
+@pytest.mark.parametrize("seed, dimensions", [(0, False), (1, True)])
+def test_components_match_hierarchy_segmentation(seed, dimensions):
+    image, _ = draw_sketch(1600, 1200, seed=seed, dimensions=dimensions)
+    whole = segment_rows(detect_segments(image, max_side=0, tile_size=0))
+    assert whole
+    assert segment_rows(detect_segments(image, max_side=0, tile_size=0, method=COMPONENTS_METHOD)) == whole
+
+
+@pytest.mark.parametrize("seed, dimensions", [(0, False), (1, True)])
+def test_tiled_matches_whole_image_segmentation(seed, dimensions):
+    image, _ = draw_sketch(1600, 1200, seed=seed, dimensions=dimensions)
+    whole = segment_rows(detect_segments(image, max_side=0, tile_size=0))
+    tiled = detect_segments(image, max_side=0, tile_size=400)
+    assert tiled["tiles"]["count"] > 1
+    assert segment_rows(tiled) == whole
+    assert segment_rows(detect_segments(image, max_side=0, tile_size=400, method=COMPONENTS_METHOD)) == whole
+
+
+def test_overlap_ties_keep_the_top_left_box_whatever_the_order():
+    def segment(x, y):
+        return {"bbox": [x, y, 100, 80], "area": 7200, "aspect_ratio": 1.25, "extent": 0.9,
+                "vertices": 4, "component_type": "panel"}
+    segments = [segment(12, 10), segment(10, 12), segment(10, 10), segment(300, 300)]
+    for order in ([0, 1, 2, 3], [3, 2, 1, 0], [1, 3, 0, 2]):
+        kept = remove_overlapping_segments_smart([segments[i] for i in order])
+        assert kept.boxes.tolist() == [[10, 10, 100, 80], [300, 300, 100, 80]]
+
+
+def classify_component(w, h, aspect_ratio, area_ratio, relative_y, extent, num_vertices):
+    """The if/elif chain the default rules replace"""
+    if aspect_ratio > 5:
+        return "horizontal_support" if w > h else "leg"
+    elif area_ratio > 0.25 and relative_y < 0.3:
+        return "table_top"
+    elif area_ratio > 0.15 and relative_y > 0.3:
+        return "drawer_section"
+    elif 2 < aspect_ratio < 4 and area_ratio < 0.1:
+        return "drawer"
+    elif extent > 0.85 and num_vertices <= 6:
+        return "panel"
+    return "component"
+
+
+def test_default_rules_match_the_if_chain():
+    rng = np.random.default_rng(0)
+    n, width, height = 5000, 1000, 800
+    boxes = np.column_stack([
+        rng.integers(0, width, n), rng.integers(0, height, n), rng.integers(1, width, n), rng.integers(1, height, n),
+    ])
+    area = boxes[:, 2] * boxes[:, 3] * rng.uniform(0.3, 1.0, n)
+    aspect_ratio = np.maximum(boxes[:, 2], boxes[:, 3]) / np.minimum(boxes[:, 2], boxes[:, 3])
+    extent = rng.uniform(0.5, 1.0, n)
+    vertices = rng.integers(4, 12, n)
+    types = ComponentClassifier().classify(
+        segment_features(boxes, area, aspect_ratio, extent, vertices, width, height)
+    )
+
+    expected = [
+        classify_component(w, h, aspect_ratio[i], area[i] / (width * height), (y + h / 2) / height,
+                           extent[i], vertices[i])
+        for i, (x, y, w, h) in enumerate(boxes)
+    ]
+    assert types.tolist() == expected
+    assert len(set(expected)) == 7
@@ -0,0 +1,294 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from google.cloud import vision
+
+from utils import ocr_backends
+from utils.fake_vision import FakeVisionClient
+from utils.instrumentation import deadline_scope
+from utils.ocr_backends import OCRBackend, build_text_result
+from utils.tables import WordTable
+from utils.vision_client import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, ManagedVisionClient, RetryBudget,
+)
+
+CONTENT = b"sketch"
+WORDS = [{"text": "120cm", "bbox": [10, 10, 50, 12]}]
+
+
+def make_client(latency=0.0, failures=3, reset_after=0.05, timeout=5.0, retries=2, budget=None):
+    fake = FakeVisionClient(latency=latency)
+    fake.add_image(CONTENT, WORDS)
+    client = ManagedVisionClient(
+        lambda: fake, fake.as_async, timeout=timeout, retries=retries, backoff=0.001, backoff_max=0.001,
+        budget=budget or RetryBudget(), breaker=CircuitBreaker(failures, reset_after, trial_timeout=timeout),
+    )
+    return client, fake
+
+def unavailable(image):
+    return vision.AnnotateImageResponse(error={"code": 14, "message": "unavailable"})
+
+def open_breaker(client):
+    for _ in range(client.breaker.failures):
+        client.breaker.record_failure()
+    assert client.breaker.state == OPEN
+
+def text_of(response):
+    return response.text_annotations[0].description.strip()
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failures=2, reset_after=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+
+def test_half_open_trial_closes_or_reopens():
+    breaker = CircuitBreaker(failures=1, reset_after=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()  # one trial at a time
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+def test_stalled_half_open_trial_is_replaced():
+    breaker = CircuitBreaker(failures=1, reset_after=0.01, trial_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.02)
+    assert breaker.allow()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow() and breaker.state == HALF_OPEN
+
+
+def test_half_open_trial_aborted_by_deadline_does_not_wedge_breaker():
+    client, fake = make_client()
+    open_breaker(client)
+    time.sleep(0.06)
+    with deadline_scope(time.monotonic() - 1):
+        with pytest.raises(TimeoutError):
+            client.call(lambda timeout: fake.document_text_detection(vision.Image(content=CONTENT), timeout=timeout))
+        with pytest.raises(TimeoutError):
+            client.document_text(CONTENT)
+    assert fake.calls["document_text_detection"] == 0
+
+    assert text_of(client.document_text(CONTENT)) == "120cm"
+    assert client.breaker.state == CLOSED
+
+
+def test_half_open_trial_cut_short_by_client_deadline_is_not_counted():
+    client, fake = make_client(latency=0.1)
+    open_breaker(client)
+    time.sleep(0.06)
+    with deadline_scope(time.monotonic() + 0.02):
+        with pytest.raises(TimeoutError):
+            client.document_text(CONTENT)
+    assert client.breaker.state == HALF_OPEN
+
+    assert text_of(client.document_text(CONTENT)) == "120cm"
+    assert client.breaker.state == CLOSED
+
+
+def test_cancelled_half_open_trial_frees_the_slot():
+    client, fake = make_client(latency=1.0)
+    open_breaker(client)
+    time.sleep(0.06)
+
+    async def cancel_trial():
+        task = asyncio.ensure_future(client.call_async(lambda timeout: asyncio.sleep(1)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(cancel_trial())
+    assert client.breaker.allow()
+
+
+def test_client_deadlines_do_not_trip_breaker():
+    client, fake = make_client(latency=0.1, failures=2)
+    for _ in range(5):
+        with deadline_scope(time.monotonic() + 0.02):
+            with pytest.raises(TimeoutError):
+                client.document_text(CONTENT)
+    assert client.breaker.state == CLOSED
+    assert text_of(client.document_text(CONTENT)) == "120cm"
+
+
+def test_vision_timeouts_trip_breaker():
+    client, fake = make_client(latency=0.1, failures=2, timeout=0.02, retries=0)
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            client.document_text(CONTENT)
+    assert client.breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        client.document_text(CONTENT)
+
+
+def test_transient_errors_are_retried():
+    client, fake = make_client()
+    respond = fake._respond
+    failures = iter([unavailable, unavailable])
+    fake._respond = lambda image: next(failures, respond)(image)
+    assert text_of(client.document_text(CONTENT)) == "120cm"
+    assert fake.calls["document_text_detection"] == 3
+    assert client.breaker.state == CLOSED
+
+
+def test_retry_budget_limits_retries():
+    client, fake = make_client(failures=0, budget=RetryBudget(ratio=0, reserve=1))
+    fake._respond = unavailable
+    response = client.document_text(CONTENT)
+    assert response.error.code == 14
+    assert fake.calls["document_text_detection"] == 2  # one retry, then the budget is spent
+
+
+def test_followers_share_one_call():
+    client, fake = make_client(latency=0.1)
+    results = []
+
+    def upload():
+        results.append(text_of(client.document_text(CONTENT)))
+    threads = [threading.Thread(target=upload) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["120cm"] * 4
+    assert fake.calls["document_text_detection"] == 1
+    assert client.single_flight.coalesced == 3
+
+
+def test_short_deadline_leader_does_not_fail_followers():
+    client, fake = make_client(latency=0.1)
+    outcomes = {}
+
+    def upload(name, timeout):
+        with deadline_scope(time.monotonic() + timeout):
+            try:
+                outcomes[name] = text_of(client.document_text(CONTENT))
+            except TimeoutError as e:
+                outcomes[name] = e
+    leader = threading.Thread(target=upload, args=("leader", 0.03))
+    follower = threading.Thread(target=upload, args=("follower", 2))
+    leader.start()
+    time.sleep(0.01)
+    follower.start()
+    leader.join()
+    follower.join()
+    assert isinstance(outcomes["leader"], TimeoutError)
+    assert outcomes["follower"] == "120cm"
+    assert client.breaker.state == CLOSED
+
+
+def test_follower_joining_after_the_last_retry_gets_a_fresh_call():
+    client, fake = make_client(latency=0.1, retries=0)
+    outcomes = {}
+
+    def upload(name, timeout):
+        with deadline_scope(time.monotonic() + timeout):
+            try:
+                outcomes[name] = text_of(client.document_text(CONTENT))
+            except TimeoutError as e:
+                outcomes[name] = e
+    leader = threading.Thread(target=upload, args=("leader", 0.03))
+    follower = threading.Thread(target=upload, args=("follower", 2))
+    leader.start()
+    time.sleep(0.01)
+    follower.start()
+    leader.join()
+    follower.join()
+    assert isinstance(outcomes["leader"], TimeoutError)
+    assert outcomes["follower"] == "120cm"
+    assert fake.calls["document_text_detection"] == 2
+
+
+def test_async_follower_joining_after_the_last_retry_gets_a_fresh_call():
+    client, fake = make_client(latency=0.1, retries=0)
+
+    async def upload(timeout, delay=0):
+        await asyncio.sleep(delay)
+        with deadline_scope(time.monotonic() + timeout):
+            return text_of(await client.document_text_async(CONTENT))
+
+    async def run():
+        return await asyncio.gather(upload(0.03), upload(2, 0.01), return_exceptions=True)
+    leader, follower = asyncio.run(run())
+    assert isinstance(leader, TimeoutError)
+    assert follower == "120cm"
+    assert fake.calls["batch_annotate_images"] == 2
+
+
+def test_followers_get_the_shared_error():
+    client, fake = make_client(retries=0, latency=0.05)
+    fake._respond = lambda image: vision.AnnotateImageResponse(error={"code": 3, "message": "bad image"})
+    results = []
+
+    def upload():
+        results.append(client.document_text(CONTENT).error.message)
+    threads = [threading.Thread(target=upload) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["bad image"] * 3
+    assert fake.calls["document_text_detection"] == 1
+
+
+def test_async_short_deadline_leader_does_not_fail_followers():
+    client, fake = make_client(latency=0.1)
+
+    async def upload(timeout, delay=0):
+        await asyncio.sleep(delay)
+        with deadline_scope(time.monotonic() + timeout):
+            return text_of(await client.document_text_async(CONTENT))
+
+    async def run():
+        return await asyncio.gather(upload(0.03), upload(2, 0.01), upload(2, 0.01), return_exceptions=True)
+    leader, *followers = asyncio.run(run())
+    assert isinstance(leader, TimeoutError)
+    assert followers == ["120cm", "120cm"]
+    assert client.single_flight.coalesced == 2
+    assert client.breaker.state == CLOSED
+
+
+class LocalBackend(OCRBackend):
+    name = "local"
+
+    def recognize(self, content):
+        return build_text_result("120cm", WordTable(["120cm"], [0.9], [(10, 10, 60, 22)]), self.name)
+
+
+def test_hanging_vision_falls_back_after_one_timeout(monkeypatch):
+    client, fake = make_client(latency=30, timeout=0.2, retries=2)
+    monkeypatch.setattr(ocr_backends, "vision_api", client)
+    monkeypatch.setitem(ocr_backends.BACKENDS, "local", LocalBackend())
+    monkeypatch.setattr(ocr_backends, "OCR_BACKENDS", ["vision", "local"])
+    monkeypatch.setattr(ocr_backends, "get_cached_text_result", lambda key: None)
+    monkeypatch.setattr(ocr_backends, "cache_text_result", lambda key, result: None)
+
+    start = time.monotonic()
+    result = ocr_backends.recognize(CONTENT)
+    assert result["backend"] == "local"
+    assert time.monotonic() - start < 0.4  # one attempt's timeout, no retries
+    assert fake.calls["document_text_detection"] == 1
+
+
+def test_timeouts_are_retried_within_a_deadline():
+    client, fake = make_client(latency=0.2, timeout=0.05, retries=2)
+    with deadline_scope(time.monotonic() + 5):
+        with pytest.raises(TimeoutError):
+            client.document_text(CONTENT)
+    assert fake.calls["document_text_detection"] == 3
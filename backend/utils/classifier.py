@@ -0,0 +1,169 @@
+import json
+import logging
+import operator
+import os
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Feature matrix columns, in order. horizontal is 1.0 when the box is wider
+# than tall (it separates horizontal supports from legs).
+FEATURES = ("aspect_ratio", "area_ratio", "relative_y", "extent", "vertices", "horizontal")
+
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+# Rules are tried in order and the first match wins; "when" maps a feature to
+# {operator: value} conditions that must all hold. These reproduce the
+# original hard-coded classification.
+DEFAULT_RULES = [
+    {"type": "horizontal_support", "when": {"aspect_ratio": {">": 5}, "horizontal": {"==": 1}}},
+    {"type": "leg", "when": {"aspect_ratio": {">": 5}}},
+    {"type": "table_top", "when": {"area_ratio": {">": 0.25}, "relative_y": {"<": 0.3}}},
+    {"type": "drawer_section", "when": {"area_ratio": {">": 0.15}, "relative_y": {">": 0.3}}},
+    {"type": "drawer", "when": {"aspect_ratio": {">": 2, "<": 4}, "area_ratio": {"<": 0.1}}},
+    {"type": "panel", "when": {"extent": {">": 0.85}, "vertices": {"<=": 6}}},
+]
+DEFAULT_TYPE = "component"
+
+# COMPONENT_RULES points to a JSON file {"rules": [...], "default": "...",
+# "model": "...", "labels": [...]} that replaces the rules above.
+# COMPONENT_MODEL (or "model" in that file) names an optional sklearn
+# (.joblib/.pkl) or ONNX (.onnx) model run on CPU for segments no rule
+# matches; "labels" maps integer model outputs to type names.
+COMPONENT_RULES = os.getenv("COMPONENT_RULES") or None
+COMPONENT_MODEL = os.getenv("COMPONENT_MODEL") or None
+
+
+def segment_features(boxes, area, aspect_ratio, extent, vertices, image_width, image_height):
+    """(N, len(FEATURES)) float matrix for segments given as columns; boxes are (x, y, w, h)"""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    y, w, h = boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    return np.column_stack([
+        np.asarray(aspect_ratio, dtype=np.float64),
+        np.asarray(area, dtype=np.float64) / (image_width * image_height),
+        (y + h / 2) / image_height,
+        np.asarray(extent, dtype=np.float64),
+        np.asarray(vertices, dtype=np.float64),
+        (w > h).astype(np.float64),
+    ])
+
+
+class RuleModel:
+    """Optional learned classifier, loaded lazily so sklearn/onnxruntime are only imported when configured"""
+
+    def __init__(self, path, labels=None):
+        self.path = path
+        self.labels = list(labels) if labels else None
+        self._predict = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.path.endswith(".onnx"):
+            import onnxruntime
+            session = onnxruntime.InferenceSession(self.path, providers=["CPUExecutionProvider"])
+            input_name = session.get_inputs()[0].name
+            return lambda features: session.run(None, {input_name: features.astype(np.float32)})[0]
+        import joblib
+        model = joblib.load(self.path)
+        return model.predict
+
+    def load(self):
+        """Load the model now instead of on the first prediction"""
+        if self._predict is None:
+            with self._lock:
+                if self._predict is None:
+                    self._predict = self._load()
+                    logger.info("Loaded component model %s", self.path)
+
+    def predict(self, features):
+        """Type names for the rows of a feature matrix"""
+        self.load()
+        predicted = np.asarray(self._predict(features)).reshape(-1)
+        if self.labels is not None and predicted.dtype.kind in "iu":
+            return np.asarray(self.labels, dtype=object)[predicted]
+        return predicted.astype(object)
+
+
+class ComponentClassifier:
+    """
+    Vectorized component typing: every rule is evaluated as a NumPy mask over
+    the feature matrix of all segments at once; the first matching rule sets
+    a row's type. Rows no rule matches go to the model if there is one,
+    otherwise they get the default type.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES, default=DEFAULT_TYPE, model=None):
+        self.rules = [self._compile(rule) for rule in rules]
+        self.default = default
+        self.model = model
+
+    @staticmethod
+    def _compile(rule):
+        conditions = []
+        for feature, tests in rule["when"].items():
+            if feature not in FEATURES:
+                raise ValueError(f"Unknown feature in rule {rule['type']!r}: {feature}")
+            for op, value in tests.items():
+                if op not in OPERATORS:
+                    raise ValueError(f"Unknown operator in rule {rule['type']!r}: {op}")
+                conditions.append((FEATURES.index(feature), OPERATORS[op], float(value)))
+        return rule["type"], conditions
+
+    @classmethod
+    def from_config(cls, path=COMPONENT_RULES, model_path=COMPONENT_MODEL):
+        """Build the classifier from a COMPONENT_RULES file and/or a COMPONENT_MODEL"""
+        config = {}
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        model_path = config.get("model", model_path)
+        if model_path and path and not os.path.isabs(model_path):
+            model_path = os.path.join(os.path.dirname(path), model_path)
+        model = RuleModel(model_path, config.get("labels")) if model_path else None
+        return cls(config.get("rules", DEFAULT_RULES), config.get("default", DEFAULT_TYPE), model)
+
+    def classify(self, features):
+        """Return an object array with one type name per feature row"""
+        features = np.asarray(features, dtype=np.float64).reshape(-1, len(FEATURES))
+        types = np.full(len(features), self.default, dtype=object)
+        matched = np.zeros(len(features), dtype=bool)
+        # Assign in reverse so earlier rules overwrite later ones (first match wins)
+        for name, conditions in reversed(self.rules):
+            mask = np.ones(len(features), dtype=bool)
+            for column, op, value in conditions:
+                mask &= op(features[:, column], value)
+            types[mask] = name
+            matched |= mask
+        
+        if self.model is not None and not matched.all():
+            rest = ~matched
+            types[rest] = self.model.predict(features[rest])
+        return types
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+
+def get_classifier():
+    """Return the shared classifier, loading COMPONENT_RULES/COMPONENT_MODEL on first use"""
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                _classifier = ComponentClassifier.from_config()
+    return _classifier
+
+def set_classifier(classifier):
+    """Replace the shared classifier (e.g. with custom rules in tests)"""
+    global _classifier
+    _classifier = classifier
@@ -0,0 +1,356 @@
+import logging
+import os
+import re
+
+import cv2
+import numpy as np
+
+from utils.spatial import SpanIndex
+
+logger = logging.getLogger(__name__)
+
+
+# Dimension lines are straight horizontal or vertical strokes ending in an
+# arrowhead or a tick (a cross stroke or extension line). Components of the
+# segmentation mask at least DIMENSION_MIN_LENGTH px long and
+# DIMENSION_MIN_ELONGATION times longer than wide are searched with
+# HoughLinesP one component at a time, so a stroke is found the same way in
+# any window of the image that contains it.
+DIMENSION_MIN_LENGTH = int(os.getenv("DIMENSION_MIN_LENGTH", "40"))
+DIMENSION_MIN_ELONGATION = 4
+DIMENSION_ANGLE_TOLERANCE = 3  # degrees off horizontal/vertical
+
+# Arrowheads and ticks are looked for within this many px of a stroke end
+ARROW_SIZE = 24
+
+# A dimension line broken by its label is two strokes, each terminated at its
+# outer end only; they are joined across gaps of up to this many px
+DIMENSION_MAX_GAP = 240
+
+# A measurement labels a dimension line that passes within DIMENSION_TEXT_GAP
+# px of its box, between the line's ends. The line measures the segment whose
+# extent along it matches the line's ends to DIMENSION_SPAN_TOLERANCE px (or
+# DIMENSION_SPAN_RATIO of the length, if larger).
+DIMENSION_TEXT_GAP = 24
+DIMENSION_SPAN_TOLERANCE = 12
+DIMENSION_SPAN_RATIO = 0.03
+
+HORIZONTAL = "horizontal"
+VERTICAL = "vertical"
+ARROW = "arrow"
+TICK = "tick"
+
+
+# -------- Values --------
+
+# Units measurements are reported in, and other spellings of them
+UNITS = ("mm", "cm", "m", "in", "ft")
+UNIT_ALIASES = {"inch": "in", "inches": "in", '"': "in", "″": "in", "feet": "ft", "foot": "ft", "'": "ft", "′": "ft"}
+
+# A label may be bracketed, approximate ('~120') or start with the dimension
+# it gives ('W:120cm', 'H=87'), and end in punctuation. Anything else around
+# the number ('45°', '10%', 'R10', 'Ø45') makes it something other than a
+# length along a line, and it does not parse.
+QUANTITY = re.compile(
+    r"^(?:[WHDL]\s*[:=]\s*)?[(\[~≈]?(?P<number>\d+/\d+|\d+(?:[.,]\d+)*)(?:[-\s](?P<fraction>\d+/\d+))?\s*"
+    r"(?P<unit>mm|cm|m|inches|inch|in|feet|foot|ft|\"|″|'|′)?[)\].,;:]*$",
+    re.IGNORECASE,
+)
+FEET_INCHES = re.compile(r"^(?P<feet>\d+)\s*['′]\s*-?\s*(?P<inches>\d+(?:\.\d+)?)\s*[\"″]?[)\].,;:]*$")
+
+
+def parse_number(text):
+    """Float of '12', '1.5', '1,5' (decimal comma), '1,200' (thousands) or '3/4'; None if unreadable"""
+    if "/" in text:
+        numerator, denominator = text.split("/")
+        return int(numerator) / int(denominator) if int(denominator) else None
+    if "," in text:
+        if re.fullmatch(r"\d{1,3}(?:,\d{3})+(?:\.\d+)?", text):
+            text = text.replace(",", "")
+        elif text.count(",") == 1 and "." not in text:
+            text = text.replace(",", ".")
+        else:
+            return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def parse_measurement(text):
+    """
+    (value, unit) of a measurement label such as '120cm', '1,5 m', '3/4"',
+    '1-1/2in' or '5\'6"' (reported as 66 in). unit is one of UNITS or None
+    when the label has none; (None, None) if the text is not one length
+    (e.g. '120x60', '45°', '10%').
+    """
+    text = text.strip()
+    match = FEET_INCHES.match(text)
+    if match:
+        return int(match["feet"]) * 12 + float(match["inches"]), "in"
+    match = QUANTITY.match(text)
+    if match is None:
+        return None, None
+    value = parse_number(match["number"])
+    if value is None:
+        return None, None
+    if match["fraction"]:
+        value += parse_number(match["fraction"]) or 0.0
+    unit = match["unit"]
+    if unit is not None:
+        unit = UNIT_ALIASES.get(unit.lower(), unit.lower())
+    return value, unit
+
+
+# -------- Detection --------
+
+def end_shape(mask, core, tip, inward, size):
+    """
+    What terminates the horizontal stroke covering rows core (first, last)
+    of mask at column tip (inward is +1 or -1, the direction the stroke runs
+    in): ARROW for a head widening away from the tip, TICK for a stroke
+    crossing it, None if the stroke just stops or turns a corner (ink on
+    one side only).
+    """
+    columns = np.arange(tip, tip + inward * size, inward)
+    columns = columns[(columns >= 0) & (columns < mask.shape[1])]
+    reach = size // 2
+    top, bottom = max(core[0] - reach, 0), min(core[1] + reach + 1, mask.shape[0])
+    above = mask[top:core[0], columns] > 0
+    below = mask[core[1] + 1:bottom, columns] > 0
+    if not above.any() or not below.any():
+        return None
+
+    # Farthest ink from the stroke per column, from the tip inward
+    above_distance = core[0] - np.arange(top, top + len(above))
+    below_distance = np.arange(bottom - len(below), bottom) - core[1]
+    spread = np.maximum(
+        np.where(above, above_distance[:, None], 0).max(axis=0),
+        np.where(below, below_distance[:, None], 0).max(axis=0),
+    )
+    peak = int(np.argmax(spread))
+    if peak >= max(2, len(spread) // 4) and spread[:2].max() <= spread[peak] / 2:
+        return ARROW
+    return TICK
+
+def horizontal_stroke(mask, row, start, end, min_length, size):
+    """
+    The stroke around the Hough segment (start, end) on row of a component
+    mask, as (row, start, end, ends, thickness), or None if it is too short
+    or neither end is terminated.
+    """
+    middle = np.arange(start + (end - start) // 4, end - (end - start) // 4 + 1)
+    top = max(row - size, 0)
+    band = mask[top:row + size + 1, middle] > 0
+
+    # The stroke is the rows inked along most of its middle half
+    rows = np.flatnonzero(band.mean(axis=1) > 0.5)
+    if not len(rows):
+        return None
+    rows = np.split(rows, np.flatnonzero(np.diff(rows) > 1) + 1)
+    rows = min(rows, key=lambda run: abs(top + (run[0] + run[-1]) / 2 - row))
+    core = (top + int(rows[0]), top + int(rows[-1]))
+    row = (core[0] + core[1]) // 2
+    if core[1] - core[0] + 1 > size // 2:
+        return None  # too thick for a line: a filled shape or a blob of text
+
+    # It runs as far as the ink along it does; gaps shorter than an
+    # arrowhead are bridged (the mask of a large filled head can be hollow)
+    ink = np.flatnonzero(mask[core[0]:core[1] + 1].any(axis=0))
+    runs = np.split(ink, np.flatnonzero(np.diff(ink) > size // 2) + 1)
+    mid = (start + end) // 2
+    run = min(runs, key=lambda run: 0 if run[0] <= mid <= run[-1] else min(abs(run[0] - mid), abs(run[-1] - mid)))
+    start, end = int(run[0]), int(run[-1])
+    if end - start < min_length:
+        return None
+
+    ends = [end_shape(mask, core, start, 1, size), end_shape(mask, core, end, -1, size)]
+    if ends == [None, None]:
+        return None
+    return row, start, end, ends, core[1] - core[0] + 1
+
+def component_stroke(mask, min_length, size):
+    """
+    The dimension stroke of one component mask as (orientation, row, start,
+    end, ends, thickness) in mask coordinates (row and start/end swap roles
+    for vertical strokes), or None
+    """
+    lines = cv2.HoughLinesP(mask, 1, np.pi / 180, threshold=max(min_length // 2, 1),
+                            minLineLength=min_length, maxLineGap=3)
+    if lines is None:
+        return None
+    x0, y0, x1, y1 = lines.reshape(-1, 4).T.astype(np.int64)
+    angle = np.degrees(np.arctan2(np.abs(y1 - y0), np.abs(x1 - x0)))
+    straight = (angle <= DIMENSION_ANGLE_TOLERANCE) | (angle >= 90 - DIMENSION_ANGLE_TOLERANCE)
+    if not straight.any():
+        return None
+    length = np.hypot(x1 - x0, y1 - y0)
+    best = np.flatnonzero(straight)[np.argmax(length[straight])]
+    if angle[best] <= DIMENSION_ANGLE_TOLERANCE:
+        stroke = horizontal_stroke(mask, (y0[best] + y1[best]) // 2, min(x0[best], x1[best]),
+                                   max(x0[best], x1[best]), min_length, size)
+        return None if stroke is None else (HORIZONTAL,) + stroke
+    stroke = horizontal_stroke(mask.T, (x0[best] + x1[best]) // 2, min(y0[best], y1[best]),
+                               max(y0[best], y1[best]), min_length, size)
+    return None if stroke is None else (VERTICAL,) + stroke
+
+def detect_dimension_strokes(binary, scale=(1.0, 1.0), offset=(0, 0), areas=None):
+    """
+    Dimension strokes of a segmentation mask (preprocess_gray output): the
+    straight strokes with an arrowhead or tick at one or both ends, one per
+    mask component. binary covers the image from offset (original px) at
+    scale; results are in original image coordinates. areas ((x0, y0, x1, y1)
+    array) restricts the search to components coming within 1 px of them.
+
+    Returns a list of {"line": [x0, y0, x1, y1], "orientation", "ends": [kind
+    or None per end], "thickness", "bbox": component [x, y, w, h]} dicts,
+    sorted by position. join_strokes turns them into dimension lines.
+    """
+    factor = min(scale)
+    min_length = max(int(round(DIMENSION_MIN_LENGTH * factor)), 8)
+    size = max(int(round(ARROW_SIZE * factor)), 6)
+
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    x, y, w, h = stats[1:, :4].T.astype(np.int64)
+    long_side, short_side = np.maximum(w, h), np.maximum(np.minimum(w, h), 1)
+    candidates = (long_side >= min_length) & (long_side >= DIMENSION_MIN_ELONGATION * short_side)
+
+    # Component boxes in original coordinates
+    boxes = np.column_stack([x / scale[0], y / scale[1], (x + w) / scale[0], (y + h) / scale[1]])
+    boxes = boxes + np.array([offset[0], offset[1], offset[0], offset[1]])
+    if areas is not None:
+        areas = np.asarray(areas, dtype=np.float64).reshape(-1, 4)
+        candidates &= ((boxes[:, None, 0] <= areas[:, 2] + 1) & (boxes[:, None, 2] >= areas[:, 0] - 1)
+                       & (boxes[:, None, 1] <= areas[:, 3] + 1) & (boxes[:, None, 3] >= areas[:, 1] - 1)).any(axis=1)
+
+    strokes = []
+    for i in np.flatnonzero(candidates).tolist():
+        mask = (labels[y[i]:y[i] + h[i], x[i]:x[i] + w[i]] == i + 1).astype(np.uint8) * 255
+        found = component_stroke(mask, min_length, size)
+        if found is None:
+            continue
+        orientation, row, start, end, ends, thickness = found
+        if orientation == HORIZONTAL:
+            line = [(x[i] + start) / scale[0], (y[i] + row) / scale[1], (x[i] + end) / scale[0], (y[i] + row) / scale[1]]
+        else:
+            line = [(x[i] + row) / scale[0], (y[i] + start) / scale[1], (x[i] + row) / scale[0], (y[i] + end) / scale[1]]
+        x0, y0, x1, y1 = boxes[i].round().astype(int).tolist()
+        strokes.append({
+            "line": [int(round(line[0] + offset[0])), int(round(line[1] + offset[1])),
+                     int(round(line[2] + offset[0])), int(round(line[3] + offset[1]))],
+            "orientation": orientation,
+            "ends": ends,
+            "thickness": int(round(thickness / factor)),
+            "bbox": [x0, y0, x1 - x0, y1 - y0],
+        })
+    return sort_strokes(strokes)
+
+def sort_strokes(strokes):
+    return sorted(strokes, key=lambda stroke: (stroke["line"][1], stroke["line"][0], stroke["line"][3], stroke["line"][2]))
+
+def join_strokes(strokes):
+    """
+    Dimension lines from detect_dimension_strokes output: strokes
+    terminated at both ends, plus pairs of collinear strokes terminated at
+    their outer ends only, facing each other across a gap of at most
+    DIMENSION_MAX_GAP px (a line broken by its label). Returns
+    {"line", "orientation", "ends", "bbox"} dicts.
+    """
+    lines = [stroke for stroke in strokes if None not in stroke["ends"]]
+    halves = [stroke for stroke in strokes if stroke["ends"].count(None) == 1]
+    pairs = []
+    for i, first in enumerate(halves):
+        if first["ends"][1] is not None:
+            continue
+        axis = 1 if first["orientation"] == HORIZONTAL else 0
+        for j, second in enumerate(halves):
+            if (second["orientation"] != first["orientation"] or second["ends"][0] is not None
+                    or abs(second["line"][axis] - first["line"][axis]) > max(first["thickness"], second["thickness"]) + 2):
+                continue
+            gap = second["line"][1 - axis] - first["line"][3 - axis]
+            if 0 <= gap <= DIMENSION_MAX_GAP:
+                pairs.append((gap, i, j))
+
+    # Closest pairs first; every stroke joins at most one other
+    used = set()
+    for _, i, j in sorted(pairs):
+        if i in used or j in used:
+            continue
+        used.update((i, j))
+        first, second = halves[i], halves[j]
+        axis = 1 if first["orientation"] == HORIZONTAL else 0
+        position = (first["line"][axis] + second["line"][axis]) // 2
+        line = [first["line"][0], position, second["line"][2], position] if axis == 1 else \
+            [position, first["line"][1], position, second["line"][3]]
+        x0 = min(first["bbox"][0], second["bbox"][0])
+        y0 = min(first["bbox"][1], second["bbox"][1])
+        x1 = max(first["bbox"][0] + first["bbox"][2], second["bbox"][0] + second["bbox"][2])
+        y1 = max(first["bbox"][1] + first["bbox"][3], second["bbox"][1] + second["bbox"][3])
+        lines.append({"line": line, "orientation": first["orientation"], "ends": [first["ends"][0], second["ends"][1]],
+                      "thickness": max(first["thickness"], second["thickness"]), "bbox": [x0, y0, x1 - x0, y1 - y0]})
+    return [
+        {"line": line["line"], "orientation": line["orientation"], "ends": line["ends"], "bbox": line["bbox"]}
+        for line in sort_strokes(lines)
+    ]
+
+
+# -------- Association --------
+
+def match_dimension_lines(measurements, segments, lines, max_distance, index=None):
+    """
+    Match measurements (WordTable) to the dimension lines they label and
+    each line to the segment edge it spans (see DIMENSION_TEXT_GAP and
+    DIMENSION_SPAN_TOLERANCE). Among the segments whose extent matches a
+    line's ends, the one with an edge closest to the line (within
+    max_distance) is taken; a measurement near several lines takes the
+    closest. index is a SpanIndex of segments.
+
+    Returns {measurement index: (segment index, line, edge, (anchor x,
+    anchor y))} where edge is "top", "bottom", "left" or "right" and the
+    anchor is the edge's midpoint.
+    """
+    index = index if index is not None else SpanIndex(segments)
+    boxes = measurements.boxes.astype(np.float64)
+    centers = measurements.centers()
+
+    # Measurement centers sorted along each axis, to find those between a line's ends
+    orders = [np.argsort(centers[:, axis], kind="stable") for axis in (0, 1)]
+    sorted_centers = [centers[order, axis] for axis, order in enumerate(orders)]
+
+    best = {}  # measurement index -> (text gap, line number, match)
+    for number, line in enumerate(lines):
+        x0, y0, x1, y1 = line["line"]
+        axis = 0 if line["orientation"] == HORIZONTAL else 1
+        start, end, position = (x0, x1, y0) if axis == 0 else (y0, y1, x0)
+
+        lo = np.searchsorted(sorted_centers[axis], start, side="left")
+        hi = np.searchsorted(sorted_centers[axis], end, side="right")
+        nearby = orders[axis][lo:hi]
+        low, high = boxes[nearby, 1 - axis], boxes[nearby, 3 - axis]
+        text_gap = np.maximum(np.maximum(low - position, position - high), 0)
+        nearby, text_gap = nearby[text_gap <= DIMENSION_TEXT_GAP], text_gap[text_gap <= DIMENSION_TEXT_GAP]
+        if not len(nearby):
+            continue
+
+        tolerance = max(DIMENSION_SPAN_TOLERANCE, DIMENSION_SPAN_RATIO * (end - start))
+        spanning = index.spanning(axis, start, end, tolerance)
+        if not len(spanning):
+            continue
+        near_edge = index.starts[1 - axis][spanning]
+        far_edge = index.ends[1 - axis][spanning]
+        edge_gap = np.minimum(np.abs(position - near_edge), np.abs(position - far_edge))
+        closest = int(np.argmin(edge_gap))
+        if edge_gap[closest] > max_distance:
+            continue
+        segment = int(spanning[closest])
+        near = abs(position - near_edge[closest]) <= abs(position - far_edge[closest])
+        edge_position = float(near_edge[closest] if near else far_edge[closest])
+        middle = float(index.starts[axis][segment] + index.ends[axis][segment]) / 2
+        if axis == 0:
+            match = (segment, line, "top" if near else "bottom", (middle, edge_position))
+        else:
+            match = (segment, line, "left" if near else "right", (edge_position, middle))
+
+        for i, gap in zip(nearby.tolist(), text_gap.tolist()):
+            if i not in best or (gap, number) < best[i][:2]:
+                best[i] = (gap, number, match)
+    return {i: match for i, (_, _, match) in best.items()}
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from google.cloud import vision
+
+from utils.ocr_backends import lines_text
+from utils.ocr_cache import content_hash
+from utils.tables import WordTable
+
+
+def build_text_response(words):
+    """
+    Build a Vision AnnotateImageResponse for a list of words, each a dict
+    with "text", "bbox" ([x, y, w, h]) and optional "confidence". The full
+    text has one line per row of words, as Vision reports it.
+    """
+    if not words:
+        return vision.AnnotateImageResponse()
+
+    vision_words = []
+    for word in words:
+        x, y, w, h = word["bbox"]
+        vision_words.append({
+            "symbols": [{"text": char} for char in word["text"]],
+            "confidence": word.get("confidence", 0.99),
+            "bounding_box": {"vertices": [
+                {"x": x, "y": y}, {"x": x + w, "y": y},
+                {"x": x + w, "y": y + h}, {"x": x, "y": y + h},
+            ]},
+        })
+
+    full_text = lines_text(WordTable(
+        [word["text"] for word in words], [0.0] * len(words),
+        [(x, y, x + w, y + h) for x, y, w, h in (word["bbox"] for word in words)],
+    ))
+    return vision.AnnotateImageResponse(
+        text_annotations=[{"description": full_text}],
+        full_text_annotation={
+            "text": full_text,
+            "pages": [{"blocks": [{"paragraphs": [{"words": vision_words}]}]}],
+        },
+    )
+
+
+class FakeVisionClient:
+    """
+    Offline stand-in for vision.ImageAnnotatorClient.
+
+    Words come from a fixture keyed by the SHA-256 of the image content, with
+    an optional "default" entry for unknown images. An optional latency
+    simulates the Vision round-trip; calls whose timeout is shorter than the
+    latency raise TimeoutError. Call counts are recorded for tests.
+    """
+
+    def __init__(self, fixture=None, latency=0.0):
+        fixture = fixture or {}
+        self.images = fixture.get("images", {})
+        self.default = fixture.get("default", [])
+        self.latency = latency
+        self.calls = {"document_text_detection": 0, "batch_annotate_images": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """Configure from FAKE_VISION_FIXTURE (JSON path) and FAKE_VISION_LATENCY"""
+        fixture = None
+        fixture_path = os.getenv("FAKE_VISION_FIXTURE")
+        if fixture_path:
+            with open(fixture_path, "r", encoding="utf-8") as f:
+                fixture = json.load(f)
+        return cls(fixture, latency=float(os.getenv("FAKE_VISION_LATENCY", "0")))
+
+    def add_image(self, content, words):
+        """Register the words returned for a given image content"""
+        self.images[content_hash(content)] = words
+
+    def _respond(self, image):
+        return build_text_response(self.images.get(content_hash(image.content), self.default))
+
+    def _record(self, method, timeout=None):
+        with self._lock:
+            self.calls[method] += 1
+        if timeout is not None and self.latency > timeout:
+            # Behave like a real call that misses its deadline
+            time.sleep(timeout)
+            raise TimeoutError(f"Deadline of {timeout}s exceeded")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def document_text_detection(self, image, timeout=None, **kwargs):
+        self._record("document_text_detection", timeout)
+        return self._respond(image)
+
+    def batch_annotate_images(self, requests, timeout=None, **kwargs):
+        self._record("batch_annotate_images", timeout)
+        return vision.BatchAnnotateImagesResponse(
+            responses=[self._respond(request.image) for request in requests]
+        )
+
+    def as_async(self):
+        """The matching fake of vision.ImageAnnotatorAsyncClient"""
+        return FakeVisionAsyncClient(self)
+
+
+class FakeVisionAsyncClient:
+    """
+    Offline stand-in for vision.ImageAnnotatorAsyncClient, sharing the
+    fixture, latency and call counts of a FakeVisionClient. The latency is
+    awaited, so concurrent calls overlap on one event loop.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def batch_annotate_images(self, requests, timeout=None, **kwargs):
+        client = self.client
+        with client._lock:
+            client.calls["batch_annotate_images"] += 1
+        if timeout is not None and client.latency > timeout:
+            await asyncio.sleep(timeout)
+            raise TimeoutError(f"Deadline of {timeout}s exceeded")
+        if client.latency:
+            await asyncio.sleep(client.latency)
+        return vision.BatchAnnotateImagesResponse(
+            responses=[client._respond(request.image) for request in requests]
+        )
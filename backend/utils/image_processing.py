@@ -1,341 +1,849 @@
-from google.cloud import vision
 import os
 import cv2
-import torch
-import matplotlib.pyplot as plt
 import random
 import numpy as np
-import io
-import math
+import logging
 
-# Initialize Google Cloud Vision client
-client = vision.ImageAnnotatorClient()
+from utils.ocr_backends import (
+    recognize, recognize_async, recognize_batch, parse_text_response, get_vision_client, set_vision_client,
+    create_vision_client, VISION_BATCH_LIMIT
+)
+from utils.spatial import SegmentIndex, SpanIndex, measurement_centers
+from utils.dimensions import detect_dimension_strokes, join_strokes, sort_strokes, match_dimension_lines, parse_measurement
+from utils.tables import WordTable, SegmentTable, as_segment_table
+from utils.nms import suppress_overlaps
+from utils.classifier import get_classifier, segment_features
+from utils.instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+def is_image_path(image):
+    return isinstance(image, (str, os.PathLike))
+
+def read_image_bytes(image):
+    """Return the encoded image bytes for a file path or bytes-like input"""
+    if is_image_path(image):
+        with open(image, "rb") as image_file:
+            return image_file.read()
+    return bytes(image)  # no copy when image is already bytes
+
+def decode_image(data):
+    """Decode encoded image bytes (bytes, bytearray or memoryview) into a BGR ndarray"""
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    with stage("decode"):
+        return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+def load_image(image):
+    """Return a BGR ndarray for a file path, encoded bytes or an already decoded ndarray"""
+    if isinstance(image, np.ndarray):
+        return image
+    if is_image_path(image):
+        with stage("decode"):
+            return cv2.imread(os.fspath(image))
+    return decode_image(image)
 
 # -------- SAM setup --------
+# (import torch here when re-enabling SAM; it is not needed otherwise)
 #SAM_CHECKPOINT = "models/sam_vit_h_4b8939.pth"
 #DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
 #sam_model = sam_model_registry["vit_h"](checkpoint=SAM_CHECKPOINT).to(DEVICE)
 #mask_generator = SamAutomaticMaskGenerator(sam_model)
 
-def extract_text(image_path):
-    """Extract text using Google Cloud Vision API"""
+def extract_text(image, backend=None):
+    """
+    Extract text from an image (file path or encoded bytes). backend names an
+    OCR backend or policy (see utils.ocr_backends); by default Google Vision
+    is tried first with local OCR as the fallback.
+    """
     
-    if not os.path.exists(image_path):
-        return {"error": f"File not found: {image_path}"}
+    if is_image_path(image) and not os.path.exists(image):
+        return {"error": f"File not found: {image}"}
     
     try:
-        print(f"Reading image: {image_path}")
-        
-        # Read image file
-        with open(image_path, "rb") as image_file:
-            content = image_file.read()
-        
-        # Create image object
-        image = vision.Image(content=content)
-        
-        print("Sending to Google Cloud Vision API...")
-        
-        # Use document_text_detection for better handling of text
-        response = client.document_text_detection(image=image)
-        
-        if not response.text_annotations:
-            print("No text found in image")
-            return []  # Return empty array when no text found
-        
-        # Get the full text (first annotation contains all text in reading order)
-        full_text = response.text_annotations[0].description if response.text_annotations else ""
-        
-        # Extract individual words/phrases with position info
-        details = []
-        for page in response.full_text_annotation.pages:
-            for block in page.blocks:
-                for paragraph in block.paragraphs:
-                    for word in paragraph.words:
-                        word_text = ''.join([symbol.text for symbol in word.symbols])
-                        # Only include actual text (not empty or just punctuation)
-                        if word_text.strip() and not word_text.strip().isspace():
-                            # Get bounding box coordinates
-                            vertices = word.bounding_box.vertices
-                            xs = [vertex.x for vertex in vertices]
-                            ys = [vertex.y for vertex in vertices]
-                            bbox = {
-                                "x": min(xs),
-                                "y": min(ys),
-                                "width": max(xs) - min(xs),
-                                "height": max(ys) - min(ys),
-                                "center_x": (min(xs) + max(xs)) / 2,
-                                "center_y": (min(ys) + max(ys)) / 2
-                            }
-                            
-                            confidence = word.confidence if word.confidence is not None else 0.0
-                            details.append({
-                                "text": word_text,
-                                "confidence": confidence,
-                                "bbox": bbox
-                            })
+        if is_image_path(image):
+            logger.debug("Reading image: %s", image)
         
-        # Filter for measurements (text containing numbers)
-        measurements = []
-        for detail in details:
-            text = detail["text"]
-            # Check if the text contains numbers (potential measurements)
-            if any(char.isdigit() for char in text):
-                measurements.append(detail)
-        
-        #print(f"Found {len(measurements)} potential measurements in text")
-        #return measurements  # Return measurements array directly
-
-        print(f"Found {len(measurements)} potential measurements in text")
-
-        return {
-            "status": "success",
-            "full_text": full_text,
-            "details": details,           # all detected text
-            "measurements": measurements, # only those with numbers
-            "total_words": len(details)
-        }
+        # Encoded bytes go to the OCR backend as-is; repeated uploads of the
+        # same image are served from the OCR cache
+        return recognize(read_image_bytes(image), backend)
+    
+    except Exception as e:
+        error_msg = f"Text extraction failed: {str(e)}"
+        logger.exception(error_msg)
+        return {"error": error_msg}
 
+async def extract_text_async(content, backend=None, executor=None):
+    """
+    extract_text of encoded image bytes for the event loop: Vision on the
+    asyncio transport is awaited directly, other backends run on executor
+    """
+    
+    try:
+        return await recognize_async(content, backend, executor)
     
     except Exception as e:
         error_msg = f"Text extraction failed: {str(e)}"
-        print(f"ERROR: {error_msg}")
+        logger.exception(error_msg)
         return {"error": error_msg}
 
-def find_nearest_segment(measurement, segments, max_distance=100):
-    """Find the nearest segment to a measurement based on center point distance"""
-    measurement_center = (measurement["bbox"]["center_x"], measurement["bbox"]["center_y"])
-    min_distance = float('inf')
-    nearest_segment = None
+def extract_text_batch(images, backend=None):
+    """
+    Extract text from many images (file paths or encoded bytes). Cached images
+    are skipped; with Vision the rest are sent VISION_BATCH_LIMIT per
+    batch_annotate_images call. Returns one extract_text-style result per
+    image, in order.
+    """
+    results = [None] * len(images)
+    pending = []  # (index, content)
     
-    for segment in segments:
-        # Get segment center
-        segment_x = segment["bbox"][0] + segment["bbox"][2]/2
-        segment_y = segment["bbox"][1] + segment["bbox"][3]/2
-        
-        # Calculate Euclidean distance between centers
-        distance = math.sqrt(
-            (measurement_center[0] - segment_x)**2 + 
-            (measurement_center[1] - segment_y)**2
-        )
-        
-        if distance < min_distance and distance <= max_distance:
-            min_distance = distance
-            nearest_segment = segment
+    for i, image in enumerate(images):
+        if is_image_path(image) and not os.path.exists(image):
+            results[i] = {"error": f"File not found: {image}"}
+        else:
+            pending.append((i, read_image_bytes(image)))
+    
+    if pending:
+        try:
+            batch_results = recognize_batch([content for _, content in pending], backend)
+        except Exception as e:
+            error_msg = f"Text extraction failed: {str(e)}"
+            logger.exception(error_msg)
+            batch_results = [{"error": error_msg}] * len(pending)
+        for (i, _), result in zip(pending, batch_results):
+            results[i] = result
     
-    return nearest_segment, min_distance if nearest_segment else None
+    return results
 
-def match_measurements_to_segments(measurements, segments):
+def find_nearest_segment(measurement, segments, max_distance=100, metric="center", index=None):
+    """Find the nearest segment to a measurement based on center (or edge) distance"""
+    index = index if index is not None else SegmentIndex(segments)
+    indices, distances = index.nearest(measurement_centers([measurement]), max_distance, metric)
+    if indices[0] < 0:
+        return None, None
+    return index.segments[indices[0]], float(distances[0])
+
+def match_measurements_to_segments(measurements, segments, max_distance=100, metric="center"):
     """Match each measurement with its closest segment"""
     matched_pairs = []
+    if not measurements or not segments:
+        return matched_pairs
     
-    for measurement in measurements:
-        nearest_segment, distance = find_nearest_segment(measurement, segments)
-        if nearest_segment:
+    index = SegmentIndex(segments)
+    indices, distances = index.nearest(measurement_centers(measurements), max_distance, metric)
+    for measurement, idx, distance in zip(measurements, indices, distances):
+        if idx >= 0:
             matched_pairs.append({
                 "measurement": measurement["text"],
-                "segment_bbox": nearest_segment["bbox"],
-                "distance": distance
+                "segment_bbox": segments[idx]["bbox"],
+                "distance": float(distance)
             })
     
     return matched_pairs
 
-def extract_segments(image_path: str):
-    """Extract furniture components using contour hierarchy"""
-    if not os.path.exists(image_path):
-        return {"error": f"File not found: {image_path}"}
+def get_measurements(text_result):
+    """Return the measurement words from an extract_text result"""
+    if isinstance(text_result, dict):
+        return text_result.get("measurements", [])
+    return text_result or []
+
+# Links are only made to segments within this many px of a measurement
+LINK_MAX_DISTANCE = 500
+
+# Dimension-line linking (see utils.dimensions): a measurement that labels a
+# dimension line is linked to the segment edge the line spans, the others to
+# their nearest segment. DIMENSION_LINES=0 links every measurement to its
+# nearest segment.
+DIMENSION_LINES = os.getenv("DIMENSION_LINES", "1") == "1"
+
+# Contour filters shared by all segmentation modes
+MIN_AREA_RATIO = 0.003  # 0.3% of image
+MAX_AREA_RATIO = 0.90
+MIN_SIDE = 15  # px, in original image coordinates
+
+# Pyramid mode: threshold and find contours on a copy downscaled so its longest
+# side is SEGMENTATION_MAX_SIDE px (0 disables), then optionally refine the
+# retained boxes on full-resolution crops.
+SEGMENTATION_MAX_SIDE = int(os.getenv("SEGMENTATION_MAX_SIDE", "0"))
+SEGMENTATION_REFINE = os.getenv("SEGMENTATION_REFINE", "1") == "1"
+
+# Tiled mode for very large scans at full resolution: the image is segmented
+# in SEGMENTATION_TILE_SIZE px tiles (0 disables), so the filtering and
+# thresholding intermediates are tile sized instead of image sized. Each tile
+# is preprocessed with a TILE_HALO px margin of context, which must cover the
+# reach of preprocess_gray (bilateral 4 + threshold 6 + morphology 6 px).
+SEGMENTATION_TILE_SIZE = int(os.getenv("SEGMENTATION_TILE_SIZE", "0"))
+TILE_HALO = 32
+
+# Segmentation methods: contour hierarchy (the original) or connected
+# components, which measures every region in one vectorized call and only
+# approximates polygons for regions that pass the filters
+HIERARCHY_METHOD = "hierarchy_based_segmentation"
+COMPONENTS_METHOD = "connected_components"
+SEGMENTATION_METHODS = (HIERARCHY_METHOD, COMPONENTS_METHOD)
+SEGMENTATION_METHOD = os.getenv("SEGMENTATION_METHOD", HIERARCHY_METHOD)
+
+def preprocess_gray(gray):
+    """Denoise, threshold and clean a grayscale image into a binary mask"""
+    # Apply bilateral filter to reduce noise while keeping edges
+    gray = cv2.bilateralFilter(gray, 9, 75, 75)
     
-    try:
-        print(f"Starting segmentation for: {image_path}")
-        
-        # Read and preprocess
-        image = cv2.imread(image_path)
-        if image is None:
-            return {"error": "Failed to read image"}
-        
-        original_height, original_width = image.shape[:2]
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply bilateral filter to reduce noise while keeping edges
-        gray = cv2.bilateralFilter(gray, 9, 75, 75)
-        
-        # Get measurements from text detection
-        #measurements = extract_text(image_path)
-        #if isinstance(measurements, dict) and "error" in measurements:
-        #    print(f"Error in text extraction: {measurements['error']}")
-        #    measurements = []  # Use empty array if there was an error
-        #print(f"Found {len(measurements)} measurements")
-        #print("Measurements found:", [m["text"] for m in measurements] if measurements else "None")
-
-        text_result = extract_text(image_path)
-        measurements = text_result.get("measurements", []) if isinstance(text_result, dict) else text_result
-        print("Measurements found:", [m["text"] for m in measurements] if measurements else "None")
+    # Adaptive thresholding
+    binary = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY_INV, 13, 3
+    )
+    
+    # Morphological operations to clean up
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    
+    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel, iterations=2)
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=1)
+    return binary
 
+def describe_contour(contour, image_width, image_height, scale=(1.0, 1.0), offset=(0, 0)):
+    """
+    Build the (x, y, w, h, area, aspect_ratio, extent, vertices) row for a
+    contour, or return None if it is filtered out; build_segments types the
+    rows and turns them into a SegmentTable. Contour coordinates are divided by scale (x, y) and shifted by offset to
+    map them into original image coordinates.
+    """
+    scale_x, scale_y = scale
+    image_area = image_width * image_height
+    
+    area = cv2.contourArea(contour)
+    if scale_x != 1.0 or scale_y != 1.0:
+        area = area / (scale_x * scale_y)
+    area_ratio = area / image_area
+    
+    # Filter by area
+    if area_ratio < MIN_AREA_RATIO or area_ratio > MAX_AREA_RATIO:
+        return None
+    
+    # Get bounding rectangle
+    x, y, w, h = cv2.boundingRect(contour)
+    if scale_x != 1.0 or scale_y != 1.0:
+        x0, y0 = round(x / scale_x), round(y / scale_y)
+        x, y, w, h = x0, y0, round((x + w) / scale_x) - x0, round((y + h) / scale_y) - y0
+    x += offset[0]
+    y += offset[1]
+    
+    # Skip very small dimensions
+    if w < MIN_SIDE or h < MIN_SIDE:
+        return None
+    
+    # Calculate shape features
+    aspect_ratio = max(w, h) / (min(w, h) + 1e-5)
+    
+    # Approximate contour to polygon
+    epsilon = 0.02 * cv2.arcLength(contour, True)
+    approx = cv2.approxPolyDP(contour, epsilon, True)
+    num_vertices = len(approx)
+    
+    # Calculate extent (ratio of contour area to bounding box area)
+    bbox_area = w * h
+    extent = area / (bbox_area + 1e-5)
+    
+    # Furniture parts are typically rectangular with high extent
+    if extent < 0.5:  # Too irregular
+        return None
+    
+    # area stays a float here; it is classified before being truncated
+    return (int(x), int(y), int(w), int(h), float(area), float(aspect_ratio), float(extent), int(num_vertices))
+
+def build_segments(rows, image_width, image_height, contours=None):
+    """
+    SegmentTable from describe_contour rows (and optionally their contours),
+    with every row typed in one classifier pass
+    """
+    if not rows:
+        return SegmentTable()
+    x, y, w, h, area, aspect_ratio, extent, vertices = (np.asarray(column) for column in zip(*rows))
+    boxes = np.column_stack([x, y, w, h])
+    features = segment_features(boxes, area, aspect_ratio, extent, vertices, image_width, image_height)
+    component_type = get_classifier().classify(features)
+    return SegmentTable(boxes, area.astype(np.int64), aspect_ratio, extent, vertices, component_type, contours=contours)
+
+def describe_components(binary, image_width, image_height, scale=(1.0, 1.0)):
+    """
+    Connected-components counterpart of the describe_contour loop over a
+    whole binary mask. One connectedComponentsWithStats pass gives the
+    bounding box of every stroke component, and NumPy masks drop the ones too
+    small to hold a segment. Only the survivors are traced: their outer
+    contour and holes (every enclosed region is a hole of the stroke
+    component around it) go through describe_contour, so the segments match
+    the contour hierarchy method. Returns a SegmentTable in original image
+    coordinates.
+    """
+    scale_x, scale_y = scale
+    min_area = MIN_AREA_RATIO * image_width * image_height * scale_x * scale_y
+    
+    count, labels, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(binary, 8, cv2.CV_32S, cv2.CCL_BBDT)
+    w, h = stats[:, 2], stats[:, 3]
+    
+    # A contour's area is at most its bounding box, so components whose box
+    # is too small or too thin cannot produce a segment (nor can their holes)
+    keep = (w.astype(np.int64) * h >= min_area) & (w / scale_x >= MIN_SIDE - 1) & (h / scale_y >= MIN_SIDE - 1)
+    keep[0] = False  # background
+    
+    rows = []
+    contours_kept = []
+    for i in np.flatnonzero(keep).tolist():
+        x, y, cw, ch = stats[i, :4].tolist()
+        mask = (labels[y:y + ch, x:x + cw] == i).astype(np.uint8)
+        contours, _ = cv2.findContours(mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+        for contour in contours:
+            row = describe_contour(contour, image_width, image_height, scale)
+            if row is not None:
+                rows.append(row)
+                contours_kept.append(contour)
+    
+    return build_segments(rows, image_width, image_height, contours_kept)
+
+def tile_binary(image, x0, y0, x1, y1, halo=TILE_HALO):
+    """
+    preprocess_gray mask of image[y0:y1, x0:x1] (BGR or gray), computed on a
+    crop padded by halo px so it equals the same window of the whole-image mask
+    """
+    image_height, image_width = image.shape[:2]
+    cx0, cy0 = max(x0 - halo, 0), max(y0 - halo, 0)
+    cx1, cy1 = min(x1 + halo, image_width), min(y1 + halo, image_height)
+    crop = image[cy0:cy1, cx0:cx1]
+    gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY) if crop.ndim == 3 else crop
+    return preprocess_gray(gray)[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+
+def region_binary(image, x0, y0, x1, y1, tile_size, masks=None):
+    """
+    Mask of an arbitrary region, assembled from the tile grid so only the mask
+    itself is region sized. masks maps tile origins to tile masks already
+    computed, stored bit-packed (np.packbits).
+    """
+    masks = masks or {}
+    binary = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+    for ty in range(y0 - y0 % tile_size, y1, tile_size):
+        for tx in range(x0 - x0 % tile_size, x1, tile_size):
+            tx1 = min(tx + tile_size, image.shape[1])
+            ty1 = min(ty + tile_size, image.shape[0])
+            packed = masks.get((tx, ty))
+            if packed is not None:
+                tile = np.unpackbits(packed, axis=1, count=tx1 - tx) * np.uint8(255)
+            else:
+                tile = tile_binary(image, tx, ty, tx1, ty1)
+            ix0, iy0 = max(tx, x0), max(ty, y0)
+            ix1, iy1 = min(tx1, x1), min(ty1, y1)
+            binary[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = tile[iy0 - ty:iy1 - ty, ix0 - tx:ix1 - tx]
+    return binary
+
+def touches_edge(x, y, w, h, x0, y0, x1, y1, image_width, image_height):
+    """True if box (x, y, w, h) reaches an edge of window (x0, y0, x1, y1) that is not an image border"""
+    return ((x == x0 and x0 > 0) or (y == y0 and y0 > 0)
+            or (x + w == x1 and x1 < image_width) or (y + h == y1 and y1 < image_height))
+
+def group_boxes(boxes):
+    """Union-find over (x0, y0, x1, y1) boxes that overlap or touch; returns each group's union box"""
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    parent = list(range(len(boxes)))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for i, (x0, y0, x1, y1) in enumerate(boxes.tolist()):
+        rest = boxes[i + 1:]
+        near = (rest[:, 0] <= x1) & (rest[:, 2] >= x0) & (rest[:, 1] <= y1) & (rest[:, 3] >= y0)
+        for j in (np.flatnonzero(near) + i + 1).tolist():
+            parent[find(j)] = find(i)
+    
+    groups = {}
+    for i, box in enumerate(boxes.tolist()):
+        union = groups.setdefault(find(i), list(box))
+        union[0], union[1] = min(union[0], box[0]), min(union[1], box[1])
+        union[2], union[3] = max(union[2], box[2]), max(union[3], box[3])
+    return list(groups.values())
+
+def describe_tiled(image, tile_size):
+    """
+    Tiled counterpart of preprocess_gray + findContours + describe_contour
+    over the whole image, for decoded images too large to preprocess at once.
+    
+    Each tile's mask comes from tile_binary, so it matches the whole-image
+    mask exactly. Contours that stay clear of the tile's inner edges are
+    complete and described right away. Contours cut by a tile edge belong to
+    components spanning several tiles: their fragments are grouped, and each
+    group's bounding region is re-traced on a mask assembled from the tiles'
+    masks (kept bit-packed, 1/8 of their size), where the components are
+    whole. Returns (SegmentTable, tile count, merged region
+    count); the rows are those of the whole-image pass, in a different order.
+    """
+    image_height, image_width = image.shape[:2]
+    min_area = MIN_AREA_RATIO * image_width * image_height
+    rows = []
+    contours_kept = []
+    fragments = []  # (x0, y0, x1, y1) of contours cut by a tile edge
+    masks = {}  # tile origin -> packed mask of tiles with fragments, reused for the regions
+    
+    def tile_origin(x, y):
+        return x - x % tile_size, y - y % tile_size
+    
+    def complete_in_tile(x, y, w, h):
+        tx, ty = tile_origin(x, y)
+        tx1, ty1 = min(tx + tile_size, image_width), min(ty + tile_size, image_height)
+        return (x + w <= tx1 and y + h <= ty1
+                and not touches_edge(x, y, w, h, tx, ty, tx1, ty1, image_width, image_height))
+    
+    tiles = 0
+    for ty in range(0, image_height, tile_size):
+        for tx in range(0, image_width, tile_size):
+            tiles += 1
+            tx1, ty1 = min(tx + tile_size, image_width), min(ty + tile_size, image_height)
+            with stage("preprocess"):
+                binary = tile_binary(image, tx, ty, tx1, ty1)
+            with stage("find_contours"):
+                contours, _ = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=(tx, ty))
+            with stage("classify"):
+                for contour in contours:
+                    x, y, w, h = cv2.boundingRect(contour)
+                    if touches_edge(x, y, w, h, tx, ty, tx1, ty1, image_width, image_height):
+                        fragments.append((x, y, x + w, y + h))
+                        if (tx, ty) not in masks:
+                            masks[tx, ty] = np.packbits(binary, axis=1)
+                        continue
+                    row = describe_contour(contour, image_width, image_height)
+                    if row is not None:
+                        rows.append(row)
+                        contours_kept.append(contour)
+    
+    # Re-trace components that span tiles. A region can also contain whole
+    # components of a neighbouring group, so contours are keyed on their
+    # geometry to count each once.
+    regions = 0
+    seen = set()
+    for x0, y0, x1, y1 in group_boxes(fragments):
+        # Groups too small to hold a segment (e.g. noise on a tile edge)
+        if (x1 - x0) * (y1 - y0) < min_area or x1 - x0 < MIN_SIDE or y1 - y0 < MIN_SIDE:
+            continue
+        regions += 1
+        # One pixel of margin, so whole components never touch the region edge
+        x0, y0 = max(x0 - 1, 0), max(y0 - 1, 0)
+        x1, y1 = min(x1 + 1, image_width), min(y1 + 1, image_height)
+        with stage("preprocess"):
+            binary = region_binary(image, x0, y0, x1, y1, tile_size, masks)
+        with stage("find_contours"):
+            contours, _ = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+        del binary
+        with stage("classify"):
+            for contour in contours:
+                x, y, w, h = cv2.boundingRect(contour)
+                if touches_edge(x, y, w, h, x0, y0, x1, y1, image_width, image_height) or complete_in_tile(x, y, w, h):
+                    continue
+                key = (x, y, w, h, len(contour), int(contour[0, 0, 0]), int(contour[0, 0, 1]))
+                if key in seen:
+                    continue
+                seen.add(key)
+                row = describe_contour(contour, image_width, image_height)
+                if row is not None:
+                    rows.append(row)
+                    contours_kept.append(contour)
+    
+    with stage("classify"):
+        segments = build_segments(rows, image_width, image_height, contours_kept)
+    return segments, tiles, regions
+
+def contour_pixels(contour):
+    """All pixels of a CHAIN_APPROX_SIMPLE contour, whose points are joined by straight 8-connected runs"""
+    points = contour.reshape(-1, 2).astype(np.int64)
+    steps = np.roll(points, -1, axis=0) - points
+    lengths = np.maximum(np.abs(steps).max(axis=1), 1)
+    starts = np.repeat(points, lengths, axis=0)
+    directions = np.repeat(np.sign(steps), lengths, axis=0)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts + directions * offsets[:, None]
+
+def contour_touches(contour, areas):
+    """True if a contour passes within 1 px of any (x0, y0, x1, y1) area"""
+    bx, by, bw, bh = cv2.boundingRect(contour)
+    for start in range(0, len(areas), 64):
+        chunk = areas[start:start + 64]
+        x0, y0, x1, y1 = chunk[:, 0] - 1, chunk[:, 1] - 1, chunk[:, 2] + 1, chunk[:, 3] + 1
+        # Cheap box test first; most contours are nowhere near the edit
+        near = (bx < x1) & (bx + bw > x0) & (by < y1) & (by + bh > y0)
+        if not near.any():
+            continue
+        pixels = contour_pixels(contour)
+        px, py = pixels[:, :1], pixels[:, 1:]
+        x0, y0, x1, y1 = x0[near], y0[near], x1[near], y1[near]
+        if ((px >= x0) & (px < x1) & (py >= y0) & (py < y1)).any():
+            return True
+    return False
+
+def dirty_areas(rects, image_width, image_height):
+    """(x0, y0, x1, y1) areas where edits in rects ((x, y, w, h) list) can change the mask: TILE_HALO px around them"""
+    return np.array([
+        (max(x - TILE_HALO, 0), max(y - TILE_HALO, 0), min(x + w + TILE_HALO, image_width), min(y + h + TILE_HALO, image_height))
+        for x, y, w, h in rects
+    ], dtype=np.int64).reshape(-1, 4)
+
+def seed_windows(dirty, boxes):
+    """
+    Starting windows for re-processing edits: the dirty areas plus the
+    (x0, y0, x1, y1) boxes of what they touch, which is usually where those
+    things still are, grouped where they meet; two px of margin so anything
+    passing next to an edit is seen in its window
+    """
+    return group_boxes(np.concatenate([dirty, np.asarray(boxes, dtype=np.int64).reshape(-1, 4)]) + np.array([-2, -2, 2, 2]))
+
+def grow_window(image, window, find, stage_name="preprocess"):
+    """
+    Run find(binary, x0, y0) -> (found, boxes) on the mask of an (x0, y0,
+    x1, y1) window, growing the window towards every edge one of the
+    (x, y, w, h) boxes is cut by (boxes of what changed, in image
+    coordinates) until none is. Returns (window, binary, found) of the last
+    run.
+    """
+    image_height, image_width = image.shape[:2]
+    x0, y0, x1, y1 = window
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, image_width), min(y1, image_height)
+    while True:
+        with stage(stage_name):
+            binary = tile_binary(image, x0, y0, x1, y1)
+        found, boxes = find(binary, x0, y0)
         
-        # Adaptive thresholding
-        binary = cv2.adaptiveThreshold(
-            gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV, 13, 3
-        )
+        grow = [False] * 4
+        for x, y, w, h in boxes:
+            if touches_edge(x, y, w, h, x0, y0, x1, y1, image_width, image_height):
+                grow = [grow[0] or x == x0, grow[1] or y == y0, grow[2] or x + w == x1, grow[3] or y + h == y1]
+        if not any(grow):
+            return (x0, y0, x1, y1), binary, found
+        step_x, step_y = x1 - x0, y1 - y0
+        x0, y0 = max(x0 - step_x * grow[0], 0), max(y0 - step_y * grow[1], 0)
+        x1, y1 = min(x1 + step_x * grow[2], image_width), min(y1 + step_y * grow[3], image_height)
+
+def update_segments(image, raw_segments, rects):
+    """
+    Re-segment an image that changed only inside rects ((x, y, w, h) list),
+    given the raw_segments of the previous version (detect_segments with
+    keep_raw, which keeps their contours). Returns (raw_segments, segments,
+    windows): the new raw and final tables, the same as a full
+    detect_segments run, and the re-processed windows.
+    
+    An edit changes the mask at most TILE_HALO px around it, and a contour
+    can only change if it passes through that area (border following only
+    looks at the neighbours of the contour pixels). Old rows whose contours
+    stay clear of it are kept. The rest are replaced by the contours found in
+    a window around the edit, which grows until every contour passing
+    through the edit is complete in it. Work is proportional to the edit and
+    the components it touches, not to the image.
+    """
+    image_height, image_width = image.shape[:2]
+    raw_segments = as_segment_table(raw_segments)
+    if any(contour is None for contour in raw_segments.contours):
+        raise ValueError("raw_segments have no contours; run detect_segments with keep_raw")
+    dirty = dirty_areas(rects, image_width, image_height)
+    
+    with stage("classify"):
+        touched = np.array([contour_touches(contour, dirty) for contour in raw_segments.contours], dtype=bool)
+    x, y, w, h = raw_segments.boxes[touched].T.astype(np.int64)
+    
+    def changed_contours(binary, x0, y0):
+        with stage("find_contours"):
+            contours, _ = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+        changed = [(contour, cv2.boundingRect(contour)) for contour in contours if contour_touches(contour, dirty)]
+        return changed, [box for _, box in changed]
+    
+    rows = []
+    contours_kept = []
+    seen = set()
+    windows = []
+    for seed in seed_windows(dirty, np.column_stack([x, y, x + w, y + h])):
+        (x0, y0, x1, y1), _, changed = grow_window(image, seed, changed_contours)
+        windows.append([int(x0), int(y0), int(x1 - x0), int(y1 - y0)])
         
-        # Morphological operations to clean up
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        with stage("classify"):
+            for contour, (x, y, w, h) in changed:
+                # Grown windows can overlap; count each contour once
+                key = (x, y, w, h, len(contour), int(contour[0, 0, 0]), int(contour[0, 0, 1]))
+                if key in seen:
+                    continue
+                seen.add(key)
+                row = describe_contour(contour, image_width, image_height)
+                if row is not None:
+                    rows.append(row)
+                    contours_kept.append(contour)
+    
+    with stage("classify"):
+        raw_segments = SegmentTable.concat([
+            raw_segments.take(~touched), build_segments(rows, image_width, image_height, contours_kept)
+        ])
+    
+    segments = remove_overlapping_segments_smart(raw_segments)
+    segments = segments.take(np.argsort(-segments.area, kind="stable")).without_contours()
+    return raw_segments, segments, windows
+
+def box_iou(a, b):
+    """IoU of two [x, y, w, h] boxes"""
+    x_left = max(a[0], b[0])
+    y_top = max(a[1], b[1])
+    x_right = min(a[0] + a[2], b[0] + b[2])
+    y_bottom = min(a[1] + a[3], b[1] + b[3])
+    if x_right <= x_left or y_bottom <= y_top:
+        return 0.0
+    intersection = (x_right - x_left) * (y_bottom - y_top)
+    return intersection / (a[2] * a[3] + b[2] * b[3] - intersection)
+
+def refine_segments(gray, segments, scale, min_iou=0.5):
+    """
+    Re-detect each coarse segment on a full-resolution crop around it and
+    replace it with the best matching full-resolution contour.
+    """
+    image_height, image_width = gray.shape[:2]
+    pad_x = int(np.ceil(2 / scale[0])) + 8
+    pad_y = int(np.ceil(2 / scale[1])) + 8
+    best_rows = []
+    sources = []  # per segment: (True, index into best_rows) or (False, index into segments)
+    
+    for i, (x, y, w, h) in enumerate(segments.boxes.tolist()):
+        x0, y0 = max(x - pad_x, 0), max(y - pad_y, 0)
+        x1, y1 = min(x + w + pad_x, image_width), min(y + h + pad_y, image_height)
         
-        print(f"Starting with {len(measurements)} measurements")
-        binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel, iterations=2)
-        binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=1)
+        binary = preprocess_gray(gray[y0:y1, x0:x1])
+        contours, _ = cv2.findContours(binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
         
-        print("Preprocessing complete")
+        best, best_iou = None, min_iou
+        for contour in contours:
+            candidate = describe_contour(contour, image_width, image_height, offset=(x0, y0))
+            if candidate is None:
+                continue
+            iou = box_iou(candidate[:4], (x, y, w, h))
+            if iou >= best_iou:
+                best, best_iou = candidate, iou
         
-        # Find contours with hierarchy
-        contours, hierarchy = cv2.findContours(
-            binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
-        )
+        if best is not None:
+            sources.append((True, len(best_rows)))
+            best_rows.append(best)
+        else:
+            sources.append((False, i))
+    
+    refined = build_segments(best_rows, image_width, image_height)
+    return SegmentTable.concat([refined.take([j]) if found else segments.take([j]) for found, j in sources])
+
+def detect_segments(image, max_side=None, refine=None, method=None, tile_size=None, keep_raw=False):
+    """
+    Detect furniture components using contour hierarchy, without OCR.
+    image is a file path, encoded bytes or a decoded BGR ndarray.
+    Safe to run in a worker process alongside extract_text.
+    
+    method is one of SEGMENTATION_METHODS (defaults to SEGMENTATION_METHOD);
+    "connected_components" replaces the per-contour loop with one
+    connectedComponentsWithStats pass.
+    
+    max_side enables pyramid mode for large scans (defaults to
+    SEGMENTATION_MAX_SIDE): contours are found on a downscaled copy and
+    mapped back, then refined at full resolution if refine is set.
+    
+    tile_size enables tiled mode for images larger than one tile (defaults
+    to SEGMENTATION_TILE_SIZE) when pyramid mode is off: the mask is built and
+    traced tile by tile (see describe_tiled) and the segments are the same as
+    with whole-image processing, whichever method is requested.
+    
+    keep_raw adds the segments before overlap removal as "raw_segments"
+    (full-resolution modes only), which update_segments needs to re-segment
+    edited regions later.
+    
+    With DIMENSION_LINES, the dimension strokes of the mask are added as
+    "dimension_strokes" (not in tiled mode, which never holds the whole
+    mask); attach_measurements turns them into dimension lines.
+    """
+    if is_image_path(image) and not os.path.exists(image):
+        return {"error": f"File not found: {image}"}
+    
+    max_side = SEGMENTATION_MAX_SIDE if max_side is None else max_side
+    refine = SEGMENTATION_REFINE if refine is None else refine
+    tile_size = SEGMENTATION_TILE_SIZE if tile_size is None else tile_size
+    method = method or SEGMENTATION_METHOD
+    if method not in SEGMENTATION_METHODS:
+        return {"error": f"Unknown segmentation method: {method}"}
+    
+    try:
+        logger.debug("Starting segmentation for: %s", image if is_image_path(image) else type(image).__name__)
         
-        print(f"Found {len(contours)} contours")
+        # Read and preprocess
+        image = load_image(image)
+        if image is None:
+            return {"error": "Failed to read image"}
         
-        # Process contours
-        segments = []
-        image_area = original_width * original_height
-        min_area_ratio = 0.003  # 0.3% of image
-        max_area_ratio = 0.90
+        original_height, original_width = image.shape[:2]
+        tiled = (bool(tile_size) and max(original_width, original_height) > tile_size
+                 and not (max_side and max(original_width, original_height) > max_side))
         
-        for idx, contour in enumerate(contours):
-            area = cv2.contourArea(contour)
-            area_ratio = area / image_area
-            
-            # Filter by area
-            if area_ratio < min_area_ratio or area_ratio > max_area_ratio:
-                continue
-            
-            # Get bounding rectangle
-            x, y, w, h = cv2.boundingRect(contour)
-            
-            # Skip very small dimensions
-            if w < 15 or h < 15:
-                continue
-            
-            # Calculate shape features
-            aspect_ratio = max(w, h) / (min(w, h) + 1e-5)
-            
-            # Approximate contour to polygon
-            epsilon = 0.02 * cv2.arcLength(contour, True)
-            approx = cv2.approxPolyDP(contour, epsilon, True)
-            num_vertices = len(approx)
-            
-            # Calculate extent (ratio of contour area to bounding box area)
-            bbox_area = w * h
-            extent = area / (bbox_area + 1e-5)
-            
-            # Furniture parts are typically rectangular with high extent
-            if extent < 0.5:  # Too irregular
-                continue
-            
-            # Classify based on position, size, and shape
-            center_y = y + h / 2
-            relative_y = center_y / original_height
+        if tiled:
+            logger.debug("Tiled mode: %dpx tiles", tile_size)
+            segments, tiles, regions = describe_tiled(image, tile_size)
+            scale = (1.0, 1.0)
+        else:
+            with stage("preprocess"):
+                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                
+                # Downscale large scans in pyramid mode
+                scale = (1.0, 1.0)
+                work = gray
+                if max_side and max(original_width, original_height) > max_side:
+                    factor = max_side / max(original_width, original_height)
+                    size = (max(1, round(original_width * factor)), max(1, round(original_height * factor)))
+                    work = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+                    scale = (size[0] / original_width, size[1] / original_height)
+                    logger.debug("Pyramid mode: segmenting at %dx%d", size[0], size[1])
+                
+                binary = preprocess_gray(work)
             
-            if aspect_ratio > 5:
-                if w > h:  # Horizontal long element
-                    component_type = "horizontal_support"
-                else:  # Vertical long element
-                    component_type = "leg"
-            elif area_ratio > 0.25 and relative_y < 0.3:
-                component_type = "table_top"
-            elif area_ratio > 0.15 and relative_y > 0.3:
-                component_type = "drawer_section"
-            elif 2 < aspect_ratio < 4 and area_ratio < 0.1:
-                component_type = "drawer"
-            elif extent > 0.85 and num_vertices <= 6:
-                component_type = "panel"
+            strokes = None
+            if DIMENSION_LINES:
+                with stage("dimension_lines"):
+                    strokes = detect_dimension_strokes(binary, scale)
+        
+            if method == COMPONENTS_METHOD:
+                with stage("classify"):
+                    segments = describe_components(binary, original_width, original_height, scale)
             else:
-                component_type = "component"
-            
-            segments.append({
-                "bbox": [int(x), int(y), int(w), int(h)],
-                "area": int(area),
-                "aspect_ratio": float(aspect_ratio),
-                "extent": float(extent),
-                "vertices": int(num_vertices),
-                "component_type": component_type, 
-                "predicted_iou": float(min(extent * 0.95, 0.92))
-            })
+                # Find contours with hierarchy
+                with stage("find_contours"):
+                    contours, hierarchy = cv2.findContours(
+                        binary, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE
+                    )
+                
+                logger.debug("Found %d contours", len(contours))
+                
+                # Process contours
+                with stage("classify"):
+                    rows = []
+                    contours_kept = []
+                    for contour in contours:
+                        row = describe_contour(contour, original_width, original_height, scale)
+                        if row is not None:
+                            rows.append(row)
+                            contours_kept.append(contour)
+                    segments = build_segments(rows, original_width, original_height, contours_kept)
         
-        print(f"Extracted {len(segments)} raw segments")
+        logger.debug("Extracted %d raw segments", len(segments))
+        raw_segments = segments
         
         # Remove overlaps
         segments = remove_overlapping_segments_smart(segments)
         
-        # Sort by area
-        segments = sorted(segments, key=lambda x: x['area'], reverse=True)
+        # Tighten the coarse boxes on full-resolution crops
+        pyramid = scale != (1.0, 1.0)
+        if pyramid and refine:
+            with stage("refine"):
+                segments = refine_segments(gray, segments, scale)
+            segments = remove_overlapping_segments_smart(segments)
         
-        print(f"Final: {len(segments)} segments")
+        # Sort by area
+        segments = segments.take(np.argsort(-segments.area, kind="stable")).without_contours()
         
-        # Link measurements to segments
-        measurement_links = link_measurements_to_segments(measurements, segments)
+        logger.info("Segmentation found %d segments", len(segments))
         
-        return {
+        result = {
             "status": "success",
             "num_segments": len(segments),
             "segments": segments,
-            "measurements": measurements,
-            "links": measurement_links,
-            "method": "hierarchy_based_segmentation",
+            "method": method,
             "image_size": [original_width, original_height]
         }
+        if pyramid:
+            result["pyramid"] = {"scale": [scale[0], scale[1]], "refined": bool(refine)}
+        if tiled:
+            result["tiles"] = {"size": tile_size, "count": tiles, "merged_regions": regions}
+        elif strokes is not None:
+            result["dimension_strokes"] = strokes
+        if keep_raw and not pyramid:
+            result["raw_segments"] = raw_segments
+        return result
     
     except Exception as e:
-        print(f"SEGMENTATION ERROR: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Segmentation failed")
         return {"error": f"CV segmentation failed: {str(e)}"}
 
+def attach_measurements(segments_result, text_result):
+    """Add OCR measurements and their segment links to a detect_segments result"""
+    if "error" in segments_result:
+        return segments_result
+    
+    measurements = get_measurements(text_result)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Measurements found: %s", [m["text"] for m in measurements] if measurements else "None")
+    
+    segments = segments_result["segments"]
+    strokes = segments_result.get("dimension_strokes")
+    dimension_lines = join_strokes(strokes) if strokes is not None else None
+    measurement_links = link_measurements_to_segments(measurements, segments, dimension_lines=dimension_lines)
+    
+    result = {
+        "status": segments_result["status"],
+        "num_segments": segments_result["num_segments"],
+        "segments": segments,
+        "measurements": measurements,
+        "links": measurement_links,
+        "method": segments_result["method"],
+        "image_size": segments_result["image_size"]
+    }
+    if dimension_lines is not None:
+        result["dimension_lines"] = dimension_lines
+    return result
+
+def extract_segments(image, text_result=None):
+    """
+    Extract furniture components and link them to OCR measurements.
+    image is a file path, encoded bytes or a decoded BGR ndarray.
+    Pass the extract_text result as text_result to reuse it for linking;
+    otherwise OCR is run here (and served from the OCR cache if possible).
+    """
+    if text_result is None and isinstance(image, np.ndarray):
+        return {"error": "text_result is required when passing a decoded image"}
+    
+    segments_result = detect_segments(image)
+    if "error" in segments_result:
+        return segments_result
+    
+    if text_result is None:
+        text_result = extract_text(image)
+    return attach_measurements(segments_result, text_result)
+
 def remove_overlapping_segments_smart(segments, iou_threshold=0.6):
-    """Remove overlapping segments intelligently"""
-    if not segments:
+    """Remove overlapping segments intelligently (SegmentTable or list of segment dicts)"""
+    segments = as_segment_table(segments)
+    if not len(segments):
         return segments
     
-    # Sort by extent/rectangularity (better quality first)
-    segments = sorted(segments, key=lambda x: x.get('extent', x.get('rectangularity', 0)), reverse=True)
+    # Sort by extent/rectangularity (better quality first); ties go to the
+    # top-left box so the result does not depend on contour order (tiled mode
+    # finds the same contours in a different order)
+    x, y, w, h = segments.boxes.T
+    segments = segments.take(np.lexsort((h, w, x, y, -segments.extent)))
     
-    keep = []
-    for seg1 in segments:
-        x1, y1, w1, h1 = seg1['bbox']
-        should_keep = True
-        
-        for seg2 in keep:
-            x2, y2, w2, h2 = seg2['bbox']
-            
-            # Calculate overlap
-            x_left = max(x1, x2)
-            y_top = max(y1, y2)
-            x_right = min(x1 + w1, x2 + w2)
-            y_bottom = min(y1 + h1, y2 + h2)
-            
-            if x_right > x_left and y_bottom > y_top:
-                intersection = (x_right - x_left) * (y_bottom - y_top)
-                area1 = w1 * h1
-                area2 = w2 * h2
-                
-                # If either box is mostly inside the other, it's a duplicate
-                if intersection / area1 > iou_threshold or intersection / area2 > iou_threshold:
-                    should_keep = False
-                    break
-        
-        if should_keep:
-            keep.append(seg1)
-    
-    return keep  
+    # If either box is mostly inside a better kept box, it's a duplicate
+    with stage("nms"):
+        keep = suppress_overlaps(segments.boxes, iou_threshold)
+    return segments.take(keep)
 
 def visualize_segments(image_path, sam_output):
+    """
+    Show segments in an interactive Matplotlib window (local debugging only).
+    The API renders overlays with utils.visualization.render_overlay instead.
+    """
+    if not sam_output or "segments" not in sam_output:
+        logger.warning("No segments found in SAM output.")
+        return  # safely exit
+    
+    import matplotlib.pyplot as plt
+    
     image = cv2.imread(image_path)
     image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     plt.figure(figsize=(10, 8))
     plt.imshow(image_rgb)
-    
-    if not sam_output or "segments" not in sam_output:
-        print("⚠️ No segments found in SAM output.")
-        return  # safely exit
 
     for seg in sam_output["segments"]:
         x, y, w, h = seg["bbox"]
@@ -345,100 +853,189 @@ def visualize_segments(image_path, sam_output):
         plt.text(x, y - 5, f"{seg['predicted_iou']:.2f}", color=color, fontsize=8)
     
     plt.axis("off")
-    plt.show() 
+    plt.show()
+    plt.close()
 
-def link_measurements_to_segments(measurements, segments, max_distance=None):
+@stage("linking")
+def link_measurements_to_segments(measurements, segments, max_distance=None, metric="center", dimension_lines=None):
     """
-    Link measurements to their nearest segments based on center point distance.
-    Prints detailed coordinate information for debugging.
+    Link measurements to their nearest segments based on center point distance
+    (metric="edge" measures to the closest point on the segment box instead).
+    measurements is a WordTable and segments a SegmentTable (lists of dicts are
+    accepted too). Logs detailed coordinate information at DEBUG level.
+    
+    Measurements labelling one of dimension_lines (attach_measurements
+    output) are linked to the segment edge that line spans instead.
     """
-    if not measurements or not segments:
-        print("No measurements or segments to link")
+    if not len(measurements) or not len(segments):
+        logger.debug("No measurements or segments to link")
         return []
 
-    # Print all measurements and their coordinates
-    print("\nDEBUG - All Measurements:")
-    for m in measurements:
-        print(f"Text: {m['text']}")
-        print(f"Bbox: {m['bbox']}")
-        print(f"Center: ({m['bbox']['center_x']}, {m['bbox']['center_y']})")
-        print("---")
-
-    # Print all segments and their coordinates
-    print("\nDEBUG - All Segments:")
-    for i, s in enumerate(segments):
-        bbox = s['bbox']
-        center_x = bbox[0] + bbox[2]/2
-        center_y = bbox[1] + bbox[3]/2
-        print(f"Segment {i}: {s['component_type']}")
-        print(f"Bbox: {bbox}")
-        print(f"Center: ({center_x}, {center_y})")
-        print("---")
+    if not isinstance(measurements, WordTable):
+        # Skip measurements without usable coordinates
+        valid = []
+        for measurement in measurements:
+            try:
+                measurement["bbox"]["center_x"], measurement["bbox"]["center_y"]
+                valid.append(measurement)
+            except (KeyError, TypeError) as e:
+                logger.warning("Error processing measurement '%s': %s", measurement.get('text'), e)
+        if not valid:
+            return []
+        measurements = WordTable.from_dicts(valid)
+    segments = as_segment_table(segments)
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        # Dump all measurements and segments with their coordinates
+        lines = ["All Measurements:"]
+        for m in measurements:
+            lines.append(f"  {m['text']}: bbox={m['bbox']} center=({m['bbox']['center_x']}, {m['bbox']['center_y']})")
+        lines.append("All Segments:")
+        for i, s in enumerate(segments):
+            bbox = s['bbox']
+            lines.append(f"  Segment {i}: {s['component_type']} bbox={bbox} center=({bbox[0] + bbox[2]/2}, {bbox[1] + bbox[3]/2})")
+        logger.debug("\n".join(lines))
+
+    links, indices, _ = nearest_segment_links(measurements, segments, max_distance, metric, debug)
+    if dimension_lines:
+        links = add_dimension_links(measurements, segments, dimension_lines, links, indices, max_distance)
+    return links
 
+def nearest_segment_links(measurements, segments, max_distance=None, metric="center", debug=False):
+    """
+    link_measurements_to_segments for a WordTable and a SegmentTable that also
+    returns, per measurement, the linked segment index (-1 if none) and the
+    distance to the nearest segment. Incremental re-analysis keeps these to
+    decide which links an edit can change.
+    """
     # Set a very lenient max_distance (500 pixels or auto-calculated)
     if max_distance is None:
-        # Use the larger image dimension to calculate threshold
-        img_w = max([seg["bbox"][0] + seg["bbox"][2] for seg in segments])
-        img_h = max([seg["bbox"][1] + seg["bbox"][3] for seg in segments])
-        max_distance = 500  # increased to 500px for more matches
-        print(f"\nUsing max_distance: {max_distance}px")
+        max_distance = LINK_MAX_DISTANCE
+        logger.debug("Using max_distance: %spx", max_distance)
+
+    # Batched nearest-segment query for all measurements at once
+    index = SegmentIndex(segments)
+    points = measurements.centers()
+    indices, distances = index.nearest(points, max_distance, metric)
+    anchors = index.anchor_points(points, np.maximum(indices, 0), metric)
+
+    # Build the link dicts from whole columns at once
+    linked = np.flatnonzero(indices >= 0)
+    matched = indices[linked]
+    rows = zip(
+        [measurements.texts[i] for i in linked.tolist()],
+        measurements.bboxes(linked),
+        points[linked].tolist(),
+        segments.component_type[matched].tolist(),
+        segments.boxes[matched].tolist(),
+        distances[linked].tolist(),
+        anchors[linked].tolist(),
+    )
 
     links = []
+    for text, bbox, center, segment_type, segment_bbox, distance, anchor in rows:
+        value, unit = parse_measurement(text)
+        links.append({
+            "measurement_text": text,
+            "measurement_bbox": bbox,
+            "value": value,
+            "unit": unit,
+            "segment_type": segment_type,
+            "segment_bbox": segment_bbox,
+            "distance": round(distance, 2),
+            "association": "nearest",
+            "connection": {
+                "measurement": center,
+                "segment": anchor
+            }
+        })
+        if debug:
+            logger.debug("Linked: %s → %s (distance: %.2fpx)", text, segment_type, distance)
 
-    for measurement in measurements:
-        try:
-            text = measurement["text"]
-            m_center_x = measurement["bbox"]["center_x"]
-            m_center_y = measurement["bbox"]["center_y"]
-            
-            best_match = None
-            min_dist = float("inf")
-            
-            # Try to link to nearest segment
-            for segment in segments:
-                s_bbox = segment["bbox"]
-                s_center_x = s_bbox[0] + s_bbox[2]/2
-                s_center_y = s_bbox[1] + s_bbox[3]/2
-                
-                dist = math.sqrt(
-                    (m_center_x - s_center_x)**2 + 
-                    (m_center_y - s_center_y)**2
-                )
-                
-                print(f"\nDEBUG - Distance check:")
-                print(f"Measurement '{text}' at ({m_center_x}, {m_center_y})")
-                print(f"to Segment {segment['component_type']} at ({s_center_x}, {s_center_y})")
-                print(f"Distance: {dist}px")
-
-                if dist < min_dist:
-                    min_dist = dist
-                    best_match = segment
-
-            # Link to nearest segment if within threshold
-            if best_match and min_dist <= max_distance:
-                s_bbox = best_match["bbox"]
-                s_center_x = s_bbox[0] + s_bbox[2]/2
-                s_center_y = s_bbox[1] + s_bbox[3]/2
-                
-                links.append({
-                    "measurement_text": text,
-                    "measurement_bbox": measurement["bbox"],
-                    "segment_type": best_match["component_type"],
-                    "segment_bbox": best_match["bbox"],
-                    "distance": round(min_dist, 2),
-                    "connection": {
-                        "measurement": [m_center_x, m_center_y],
-                        "segment": [s_center_x, s_center_y]
-                    }
-                })
-                print(f"\nLinked: {text} → {best_match['component_type']} (distance: {min_dist:.2f}px)")
-            else:
-                print(f"\nNo link created for '{text}' - min distance {min_dist:.2f}px > threshold {max_distance}px")
+    if debug:
+        for i in np.flatnonzero(indices < 0).tolist():
+            logger.debug("No link created for '%s' - min distance %.2fpx > threshold %spx",
+                         measurements.texts[i], distances[i], max_distance)
 
-        except Exception as e:
-            print(f"Error processing measurement '{text}': {str(e)}")
-            continue
+    logger.debug("Total links created: %d", len(links))
+    return links, indices, distances
 
-    print(f"\nTotal links created: {len(links)}")
-    return links
+def add_dimension_links(measurements, segments, dimension_lines, links, indices, max_distance=None):
+    """
+    Replace the nearest-segment links (nearest_segment_links output, with
+    its indices) of length measurements that label a dimension line by links to
+    the segment edge the line spans; measurements out of reach of every
+    segment centre can still be linked this way. Links stay in measurement
+    order.
+    """
+    max_distance = LINK_MAX_DISTANCE if max_distance is None else max_distance
+    matches = match_dimension_lines(measurements, segments, dimension_lines, max_distance, SpanIndex(segments))
+    if not matches:
+        return links
 
+    word_links = [None] * len(measurements)
+    for position, link in zip(np.flatnonzero(indices >= 0).tolist(), links):
+        word_links[position] = link
+    centers = measurements.centers()
+    for position, (segment, line, edge, anchor) in matches.items():
+        text = measurements.texts[position]
+        value, unit = parse_measurement(text)
+        if value is None:
+            # Not a length ('45°', '10%'); it keeps its nearest-segment link
+            continue
+        center = centers[position].tolist()
+        word_links[position] = {
+            "measurement_text": text,
+            "measurement_bbox": measurements.bboxes([position])[0],
+            "value": value,
+            "unit": unit,
+            "segment_type": segments.component_type[segment],
+            "segment_bbox": segments.boxes[segment].tolist(),
+            "distance": round(float(np.hypot(center[0] - anchor[0], center[1] - anchor[1])), 2),
+            "association": "dimension_line",
+            "dimension_line": line["line"],
+            "edge": edge,
+            "connection": {
+                "measurement": center,
+                "segment": list(anchor)
+            }
+        }
+    logger.debug("Linked %d measurements through dimension lines", len(matches))
+    return [link for link in word_links if link is not None]
+
+def update_dimension_strokes(image, strokes, rects):
+    """
+    detect_dimension_strokes for an image that changed only inside rects
+    ((x, y, w, h) list), given the strokes of the previous version; the same
+    as a full run. Strokes whose component comes near an edit are dropped and
+    the components there searched again, in windows around the edits that
+    grow until each of those components lies wholly inside one
+    (grow_window, as in update_segments).
+    """
+    image_height, image_width = image.shape[:2]
+    dirty = dirty_areas(rects, image_width, image_height)
+    
+    def near_dirty(x0, y0, x1, y1):
+        # The same test detect_dimension_strokes applies to its areas
+        return ((x0[:, None] <= dirty[:, 2] + 1) & (x1[:, None] >= dirty[:, 0] - 1)
+                & (y0[:, None] <= dirty[:, 3] + 1) & (y1[:, None] >= dirty[:, 1] - 1)).any(axis=1)
+    
+    boxes = np.array([stroke["bbox"] for stroke in strokes], dtype=np.int64).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    touched = near_dirty(*boxes.T)
+    
+    def components_near_edits(binary, x0, y0):
+        _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        x, y, w, h = stats[1:, :4].T.astype(np.int64)
+        x, y = x + x0, y + y0
+        return None, np.column_stack([x, y, w, h])[near_dirty(x, y, x + w, y + h)].tolist()
+    
+    found = {}
+    for seed in seed_windows(dirty, boxes[touched]):
+        (x0, y0, _, _), binary, _ = grow_window(image, seed, components_near_edits, "dimension_lines")
+        # Grown windows can overlap; count each stroke once
+        for stroke in detect_dimension_strokes(binary, offset=(x0, y0), areas=dirty):
+            found[tuple(stroke["bbox"] + stroke["line"])] = stroke
+    
+    return sort_strokes([stroke for stroke, gone in zip(strokes, touched) if not gone] + list(found.values()))
@@ -0,0 +1,297 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from utils.image_processing import (
+    group_boxes, nearest_segment_links, link_measurements_to_segments, get_measurements, LINK_MAX_DISTANCE
+)
+from utils.dimensions import join_strokes
+from utils.ocr_backends import recognize, build_text_result, lines_text
+from utils.spatial import SegmentIndex
+from utils.tables import WordTable, as_segment_table
+from utils.instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+
+# Analyses kept for incremental re-analysis (POST /results/{id}/update), as
+# an in-memory LRU of this many results; each keeps its upload bytes and
+# segment contours. INCREMENTAL_STATES=0 disables it.
+INCREMENTAL_STATES = int(os.getenv("INCREMENTAL_STATES", "32"))
+
+# Context around each changed region sent to OCR, so words crossing the edit
+# are read whole
+OCR_MARGIN = 48
+
+# Changes closer than this many px are treated as one region
+REGION_GAP = 8
+
+
+class AnalysisState:
+    """What an incremental update of one analysis needs: its image, options and results"""
+
+    __slots__ = ("data", "options", "text_result", "raw_segments", "result", "strokes")
+
+    def __init__(self, data, options, text_result, raw_segments, result, strokes=None):
+        self.data = data
+        self.options = options  # (ocr_backend, method)
+        self.text_result = text_result
+        self.raw_segments = raw_segments  # before overlap removal, with contours
+        self.result = result  # combine_results output
+        self.strokes = strokes  # detect_segments dimension_strokes, if detected
+
+    @property
+    def image_size(self):
+        return self.result["segments_result"].get("image_size")
+
+
+class AnalysisStore:
+    """Size-bounded LRU of AnalysisStates by result id"""
+
+    def __init__(self, max_entries=INCREMENTAL_STATES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def put(self, state):
+        """Store a state and return its new result id"""
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[result_id] = state
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return result_id
+
+    def get(self, result_id):
+        with self._lock:
+            state = self._entries.get(result_id)
+            if state is not None:
+                self._entries.move_to_end(result_id)
+            return state
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+analysis_store = AnalysisStore()
+
+
+def text_words(text_result):
+    """All words of an extract_text result as a WordTable ([] means no text)"""
+    if isinstance(text_result, dict):
+        return text_result.get("details", WordTable())
+    return text_result if isinstance(text_result, WordTable) else WordTable.from_dicts(text_result or [])
+
+def join_words(a, b):
+    return WordTable(a.texts + b.texts, np.concatenate([a.confidence, b.confidence]), np.concatenate([a.boxes, b.boxes]))
+
+def intersects(boxes, rects):
+    """Mask of (x0, y0, x1, y1) boxes overlapping any (x, y, w, h) rect"""
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 1, 4)
+    rects = np.asarray(rects, dtype=np.int64).reshape(1, -1, 4)
+    return ((boxes[..., 0] < rects[..., 0] + rects[..., 2]) & (boxes[..., 2] > rects[..., 0])
+            & (boxes[..., 1] < rects[..., 1] + rects[..., 3]) & (boxes[..., 3] > rects[..., 1])).any(axis=1)
+
+def clip_rects(rects, image_width, image_height):
+    """Clip (x, y, w, h) rects to the image, dropping empty ones"""
+    clipped = []
+    for x, y, w, h in rects:
+        x0, y0 = max(int(x), 0), max(int(y), 0)
+        x1, y1 = min(int(x + w), image_width), min(int(y + h), image_height)
+        if x1 > x0 and y1 > y0:
+            clipped.append([x0, y0, x1 - x0, y1 - y0])
+    return clipped
+
+@stage("diff")
+def changed_regions(old, new):
+    """
+    (x, y, w, h) rects covering every pixel that differs between two images
+    of the same size, to REGION_GAP px (changes are found per
+    REGION_GAP x REGION_GAP cell, which keeps this pass cheap on large images)
+    """
+    image_height, image_width = new.shape[:2]
+    channels = new.shape[2] if new.ndim == 3 else 1
+    changed = cv2.compare(old.reshape(image_height, -1), new.reshape(image_height, -1), cv2.CMP_NE)
+    
+    # Any changed byte in a cell makes the cell's mean non-zero
+    rows, cols = -(-image_height // REGION_GAP), -(-image_width // REGION_GAP)
+    changed = cv2.copyMakeBorder(changed, 0, rows * REGION_GAP - image_height, 0,
+                                 (cols * REGION_GAP - image_width) * channels, cv2.BORDER_CONSTANT, value=0)
+    cells = (cv2.resize(changed, (cols, rows), interpolation=cv2.INTER_AREA) > 0).astype(np.uint8)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(cells, connectivity=8)
+    if count <= 1:
+        return []
+    
+    # Cells of neighbouring changes are merged, then boxes grow by one cell
+    x, y, w, h = stats[1:, :4].T.astype(np.int64)
+    boxes = np.column_stack([x - 1, y - 1, x + w + 1, y + h + 1]) * REGION_GAP
+    return clip_rects([(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in group_boxes(boxes)], image_width, image_height)
+
+
+# -------- Text --------
+
+def ocr_region(image, box, backend=None):
+    """OCR one (x0, y0, x1, y1) crop of a decoded image; words come back in image coordinates"""
+    x0, y0, x1, y1 = box
+    ok, encoded = cv2.imencode(".png", image[y0:y1, x0:x1])
+    if not ok:
+        return {"error": "Text extraction failed: could not encode region"}
+    result = recognize(encoded.tobytes(), backend)
+    if not isinstance(result, dict) or "error" in result:
+        return result
+    words = result["details"]
+    return WordTable(words.texts, words.confidence, words.boxes + np.array([x0, y0, x0, y0], dtype=np.int32))
+
+def update_text(image, text_result, rects, backend=None):
+    """
+    Re-run OCR on the changed rects of an image whose previous OCR result is
+    text_result. Only crops around the rects (plus OCR_MARGIN) are sent to
+    the backend; old words overlapping a rect are replaced by the new words
+    overlapping one. Words cut by a crop border are dropped, as they are
+    only partly visible there.
+
+    Returns (text_result, kept, fresh): the new extract_text result, whose
+    words are the kept old words (boolean mask over the old words) followed
+    by the fresh ones and whose full text is laid out in lines as the OCR
+    engines do (lines_text); or ({"error": ...}, None, None) if OCR failed.
+    """
+    old_words = text_words(text_result)
+    image_height, image_width = image.shape[:2]
+    boxes = [(max(x - OCR_MARGIN, 0), max(y - OCR_MARGIN, 0),
+              min(x + w + OCR_MARGIN, image_width), min(y + h + OCR_MARGIN, image_height)) for x, y, w, h in rects]
+
+    fresh = WordTable()
+    for x0, y0, x1, y1 in group_boxes(boxes):
+        words = ocr_region(image, (x0, y0, x1, y1), backend)
+        if isinstance(words, dict):
+            return words, None, None
+        if not len(words):
+            continue
+        bx0, by0, bx1, by1 = words.boxes.T
+        whole = (((bx0 > x0) | (x0 == 0)) & ((by0 > y0) | (y0 == 0))
+                 & ((bx1 < x1) | (x1 == image_width)) & ((by1 < y1) | (y1 == image_height)))
+        fresh = join_words(fresh, words.take(whole & intersects(words.boxes, rects)))
+
+    kept = ~intersects(old_words.boxes, rects)
+    words = join_words(old_words.take(kept), fresh)
+    if not len(words):
+        return [], kept, fresh
+    backend_name = text_result.get("backend") if isinstance(text_result, dict) else None
+    return build_text_result(lines_text(words), words, backend_name or backend), kept, fresh
+
+
+# -------- Linking --------
+
+def segment_keys(segments):
+    return [
+        (tuple(box), component_type, area)
+        for box, component_type, area in zip(segments.boxes.tolist(), segments.component_type.tolist(),
+                                             segments.area.tolist())
+    ]
+
+@stage("linking")
+def relink(old_words, old_links, old_segments, kept, fresh, segments, max_distance=None):
+    """
+    Links for old_words.take(kept) followed by fresh against segments, equal
+    to link_measurements_to_segments on the new words and segments, reusing
+    old_links (the links of old_words to old_segments) wherever the edit
+    cannot change them. A kept word is relinked only if the segment it was
+    linked to is gone, or a new segment is at least as close as its old
+    nearest one; fresh words are always linked. Returns (links, relinked).
+    """
+    max_distance = LINK_MAX_DISTANCE if max_distance is None else max_distance
+    old_segments, segments = as_segment_table(old_segments), as_segment_table(segments)
+    words = join_words(old_words.take(kept), fresh)
+    if not len(words) or not len(segments):
+        return [], 0
+
+    # Nearest old segment of every old word; the old links belong to the linked ones in order
+    old_nearest, old_distance = SegmentIndex(old_segments).nearest(old_words.centers(), max_distance)
+    old_link_of = dict(zip(np.flatnonzero(old_nearest >= 0).tolist(), old_links))
+
+    new_keys = set(segment_keys(segments))
+    old_keys = segment_keys(old_segments)
+    removed = np.array([key not in new_keys for key in old_keys] + [False], dtype=bool)
+    old_key_set = set(old_keys)
+    added = np.array([key not in old_key_set for key in segment_keys(segments)], dtype=bool)
+
+    kept_positions = np.flatnonzero(kept)
+    affected = removed[old_nearest[kept_positions]]  # index -1 hits the trailing False
+    if added.any():
+        _, added_distance = SegmentIndex(segments.take(added)).nearest(words.centers()[:len(kept_positions)])
+        affected |= added_distance <= old_distance[kept_positions]
+
+    recompute = np.concatenate([np.flatnonzero(affected), np.arange(len(kept_positions), len(words))])
+    new_links, new_nearest, _ = nearest_segment_links(words.take(recompute), segments, max_distance)
+
+    word_links = [None] * len(words)
+    for position, old_position in enumerate(kept_positions.tolist()):
+        if not affected[position]:
+            word_links[position] = old_link_of.get(old_position)
+    for position, link in zip(recompute[new_nearest >= 0].tolist(), new_links):
+        word_links[position] = link
+    return [link for link in word_links if link is not None], len(recompute)
+
+def relink_result(state, text_result, kept, fresh, segments_result):
+    """
+    combine_results for an incremental update: the measurement links and
+    linked_data of the previous result (state) carried over to the new text
+    and segments through relink; with dimension lines, everything is linked
+    again. Returns (result, relinked words).
+    """
+    old_result = state.result
+    old_segments = old_result["segments_result"].get("segments", [])
+    segments = segments_result["segments"]
+    old_words = text_words(state.text_result)
+    strokes = segments_result.get("dimension_strokes")
+    dimension_lines = join_strokes(strokes) if strokes is not None else None
+
+    if dimension_lines or old_result["segments_result"].get("dimension_lines"):
+        # A dimension line can move the link of a measurement far from the
+        # edit; linking is indexed and cheap next to OCR and segmentation,
+        # so everything is relinked
+        words = text_words(text_result)
+        measurement_links = link_measurements_to_segments(get_measurements(text_result), segments,
+                                                          dimension_lines=dimension_lines)
+        linked_data = link_measurements_to_segments(words, segments, dimension_lines=dimension_lines)
+        relinked_measurements = relinked_words = len(words)
+    else:
+        # Measurements are the words with digits, in word order, so their
+        # kept mask is the words' mask restricted to them
+        old_digits = old_words.has_digits()
+        measurement_links, relinked_measurements = relink(
+            old_words.take(old_digits), old_result["segments_result"].get("links", []), old_segments,
+            kept[old_digits], fresh.take(fresh.has_digits()), segments
+        )
+        linked_data, relinked_words = relink(old_words, old_result["linked_data"], old_segments, kept, fresh, segments)
+
+    segments_result = {
+        "status": segments_result["status"],
+        "num_segments": segments_result["num_segments"],
+        "segments": segments,
+        "measurements": get_measurements(text_result),
+        "links": measurement_links,
+        "method": segments_result["method"],
+        "image_size": segments_result["image_size"]
+    }
+    if dimension_lines is not None:
+        segments_result["dimension_lines"] = dimension_lines
+    result = {
+        "text_result": text_result,
+        "segments_result": segments_result,
+        "linked_data": linked_data,
+    }
+    return result, max(relinked_measurements, relinked_words)
@@ -0,0 +1,241 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from starlette.datastructures import MutableHeaders
+
+
+logger = logging.getLogger(__name__)
+
+# Stage timings of the request currently being handled (stage -> seconds)
+_current_timings = contextvars.ContextVar("stage_timings", default=None)
+# Optional callback(name, seconds) notified as stages are recorded (job progress)
+_stage_listener = contextvars.ContextVar("stage_listener", default=None)
+_timings_lock = threading.Lock()
+# Absolute time.monotonic() deadline of the request being handled, if any;
+# OCR calls and their retries must finish before it
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+# Default request deadline in seconds (0 = none); clients can send their own
+# in an X-Request-Timeout header
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "0"))
+
+# Histogram buckets (seconds) for the Prometheus metrics
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def configure_logging(level=None):
+    """Configure root logging from LOG_LEVEL (default INFO); safe to call repeatedly"""
+    level = level or os.getenv("LOG_LEVEL", "INFO").upper()
+    logging.basicConfig(
+        level=level,
+        format="%(asctime)s %(levelname)s %(process)d %(name)s: %(message)s",
+    )
+    logging.getLogger().setLevel(level)
+
+
+def record_timing(name, seconds):
+    """Add seconds to stage name in the current request's timings, if any"""
+    timings = _current_timings.get()
+    if timings is None:
+        return
+    with _timings_lock:
+        timings[name] = timings.get(name, 0.0) + seconds
+    listener = _stage_listener.get()
+    if listener is not None:
+        listener(name, seconds)
+
+
+def merge_timings(timings):
+    """Merge timings collected elsewhere (e.g. in a worker process) into the current request"""
+    for name, seconds in timings.items():
+        record_timing(name, seconds)
+
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage and record it for the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        record_timing(name, elapsed)
+        logger.debug("stage %s took %.1f ms", name, elapsed * 1000)
+
+
+@contextmanager
+def collect_timings(listener=None):
+    """
+    Collect stage timings for work outside an HTTP request (e.g. a background
+    job) and yield the timings dict. listener(name, seconds) is called for
+    every stage recorded in this context, including timings merged back
+    from worker pools.
+    """
+    timings = {}
+    token = _current_timings.set(timings)
+    listener_token = _stage_listener.set(listener)
+    try:
+        yield timings
+    finally:
+        _stage_listener.reset(listener_token)
+        _current_timings.reset(token)
+
+
+def run_timed(fn, *args, **kwargs):
+    """
+    Run fn with its own timing collector and return (result, timings).
+    Used for work submitted to thread or process pools, where the request's
+    context is not available; the caller merges the timings back.
+    """
+    timings = {}
+    token = _current_timings.set(timings)
+    try:
+        return fn(*args, **kwargs), timings
+    finally:
+        _current_timings.reset(token)
+
+
+def get_deadline():
+    """The current request's deadline (time.monotonic() value) or None"""
+    return _deadline.get()
+
+
+def time_remaining():
+    """Seconds left until the current request's deadline, or None without one"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def deadline_scope(deadline):
+    """Apply a deadline (time.monotonic() value) to the work in this context; an earlier outer deadline still wins"""
+    current = _deadline.get()
+    if deadline is None or (current is not None and current <= deadline):
+        yield
+        return
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def run_with_deadline(deadline, fn, *args):
+    """Call fn under a deadline; used to carry the request deadline into worker pools"""
+    with deadline_scope(deadline):
+        return fn(*args)
+
+
+class StageMetrics:
+    """Cumulative per-stage histograms and request counters, exported in Prometheus text format"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._stages = {}  # stage -> [bucket counts, sum, count]
+        self._requests = {}  # (method, route, status) -> [count, sum]
+        self._lock = threading.Lock()
+
+    def observe_stage(self, name, seconds):
+        with self._lock:
+            entry = self._stages.setdefault(name, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry[0][i] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def observe_request(self, method, route, status, seconds, timings):
+        with self._lock:
+            entry = self._requests.setdefault((method, route, status), [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        for name, stage_seconds in timings.items():
+            self.observe_stage(name, stage_seconds)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = [
+            "# HELP designableai_stage_duration_seconds Time spent in each pipeline stage per request",
+            "# TYPE designableai_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, (counts, total, count) in sorted(self._stages.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'designableai_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {bucket_count}')
+                lines.append(f'designableai_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+                lines.append(f'designableai_stage_duration_seconds_sum{{stage="{name}"}} {total}')
+                lines.append(f'designableai_stage_duration_seconds_count{{stage="{name}"}} {count}')
+
+            lines.append("# HELP designableai_requests_total HTTP requests handled")
+            lines.append("# TYPE designableai_requests_total counter")
+            for (method, route, status), (count, _) in sorted(self._requests.items()):
+                lines.append(f'designableai_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+            lines.append("# HELP designableai_request_duration_seconds_sum Total time spent handling HTTP requests")
+            lines.append("# TYPE designableai_request_duration_seconds_sum counter")
+            for (method, route, status), (_, total) in sorted(self._requests.items()):
+                lines.append(f'designableai_request_duration_seconds_sum{{method="{method}",route="{route}",status="{status}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = StageMetrics()
+
+
+def server_timing_header(timings, total=None):
+    """Format stage timings as a Server-Timing header value (durations in ms)"""
+    parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware that collects stage timings for each HTTP request, sends
+    them as a Server-Timing response header and feeds the /metrics counters.
+    It also sets the request deadline (X-Request-Timeout or REQUEST_TIMEOUT).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        token = _current_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        timeout = REQUEST_TIMEOUT
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-timeout":
+                try:
+                    timeout = float(value)
+                except ValueError:
+                    pass
+        deadline_token = _deadline.set(time.monotonic() + timeout if timeout > 0 else None)
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing_header(timings, time.perf_counter() - start))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _deadline.reset(deadline_token)
+            _current_timings.reset(token)
+            route = scope.get("route")
+            endpoint = scope.get("endpoint")
+            route_path = getattr(route, "path", None) or getattr(endpoint, "__name__", None) or "unmatched"
+            metrics.observe_request(scope["method"], route_path, status, time.perf_counter() - start, timings)
@@ -0,0 +1,264 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from utils.instrumentation import collect_timings, metrics
+from utils.tables import to_jsonable
+
+logger = logging.getLogger(__name__)
+
+
+# Background job settings. JOB_QUEUE_SIZE bounds the number of queued jobs
+# (further submissions are rejected until the queue drains), JOB_WORKERS is the
+# number of jobs processed at once and JOB_HISTORY the number of finished jobs
+# kept in memory. Set JOBS_DB to a SQLite file to keep jobs across restarts.
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "1000"))
+JOBS_DB = os.getenv("JOBS_DB") or None
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+FINISHED = (DONE, FAILED)
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when the queue is at capacity"""
+
+
+class Job:
+    """One queued upload: its input, progress events and final result"""
+
+    __slots__ = ("id", "filename", "options", "priority", "data", "status", "created_at",
+                 "started_at", "finished_at", "stages", "result", "error", "events", "_updated")
+
+    def __init__(self, data, filename=None, options=None, priority=0, job_id=None, created_at=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.filename = filename
+        self.options = options or {}
+        self.priority = priority
+        self.data = data
+        self.status = QUEUED
+        self.created_at = created_at or time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stages = {}  # stage -> seconds
+        self.result = None
+        self.error = None
+        self.events = []  # (event, data) in order, replayed to every stream subscriber
+        self._updated = asyncio.Event()
+
+    def publish(self, event, data):
+        """Record a progress event and wake up stream subscribers"""
+        self.events.append((event, data))
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+
+    async def stream(self):
+        """Yield (event, data) from the first event until the job finishes"""
+        if self.status in FINISHED and not self.events:
+            # Loaded from the store after a restart; only the outcome is known
+            yield self.status, self.summary()
+            return
+        sent = 0
+        while True:
+            updated = self._updated
+            while sent < len(self.events):
+                yield self.events[sent]
+                sent += 1
+            if sent and self.events[sent - 1][0] in FINISHED:
+                return
+            await updated.wait()
+
+    def summary(self):
+        """JSON-ready job status, including the result once finished"""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "filename": self.filename,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stages": {name: round(seconds * 1000, 1) for name, seconds in self.stages.items()},
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """SQLite persistence for jobs, so queued work and results survive restarts"""
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, status TEXT, filename TEXT, options TEXT, priority INTEGER,"
+                " created_at REAL, started_at REAL, finished_at REAL, stages TEXT,"
+                " result TEXT, error TEXT, data BLOB)"
+            )
+
+    def save(self, job):
+        """Insert or update a job; the upload bytes are dropped once it finishes"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.status, job.filename, json.dumps(job.options), job.priority,
+                 job.created_at, job.started_at, job.finished_at, json.dumps(job.stages),
+                 json.dumps(job.result) if job.result is not None else None, job.error,
+                 None if job.status in FINISHED else job.data),
+            )
+
+    def _from_row(self, row):
+        (job_id, status, filename, options, priority, created_at, started_at, finished_at,
+         stages, result, error, data) = row
+        job = Job(data, filename, json.loads(options), priority, job_id, created_at)
+        job.status = status
+        job.started_at = started_at
+        job.finished_at = finished_at
+        job.stages = json.loads(stages or "{}")
+        job.result = json.loads(result) if result is not None else None
+        job.error = error
+        return job
+
+    def load(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def load_unfinished(self):
+        """Jobs that were queued or running when the process stopped, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JobQueue:
+    """
+    Bounded in-process priority queue of upload jobs, processed by a fixed
+    number of asyncio workers. handler(job) is awaited for each job and
+    returns its result; higher priority jobs run first, FIFO within a
+    priority. Progress is published as job events (queued, started, one
+    "stage" per pipeline stage, then done or failed).
+    """
+
+    def __init__(self, handler, max_size=JOB_QUEUE_SIZE, workers=JOB_WORKERS,
+                 history=JOB_HISTORY, db_path=JOBS_DB):
+        self.handler = handler
+        self.max_size = max_size
+        self.num_workers = workers
+        self.history = history
+        self.db_path = db_path
+        self.store = None
+        self._jobs = OrderedDict()  # id -> Job; finished jobs beyond history are evicted
+        self._queue = None
+        self._workers = []
+        self._sequence = itertools.count()
+
+    async def start(self):
+        """Start the workers and re-queue jobs left unfinished by a previous run"""
+        self._queue = asyncio.PriorityQueue()
+        if self.db_path:
+            self.store = JobStore(self.db_path)
+            for job in self.store.load_unfinished():
+                job.status = QUEUED
+                self._enqueue(job)
+            if self._queue.qsize():
+                logger.info("Restored %d unfinished jobs", self._queue.qsize())
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def _enqueue(self, job):
+        self._jobs[job.id] = job
+        self._queue.put_nowait((-job.priority, next(self._sequence), job.id))
+        job.publish(QUEUED, {"id": job.id, "position": self._queue.qsize()})
+
+    async def submit(self, data, filename=None, options=None, priority=0):
+        """Queue a job and return it; raises QueueFull when max_size jobs are waiting"""
+        if self._queue is None:
+            raise RuntimeError("JobQueue.start() has not been called")
+        if self._queue.qsize() >= self.max_size:
+            raise QueueFull(f"Job queue is full ({self.max_size} jobs waiting)")
+        job = Job(data, filename, options, priority)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.save, job)
+        self._enqueue(job)
+        return job
+
+    async def get(self, job_id):
+        """Return the job, loading it from the store if it is no longer in memory"""
+        job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = await asyncio.to_thread(self.store.load, job_id)
+        return job
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(len(finished) - self.history, 0)]:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        while True:
+            _, _, job_id = await self._queue.get()
+            try:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job):
+        job.status = RUNNING
+        job.started_at = time.time()
+        job.publish("started", {"id": job.id})
+        if self.store is not None:
+            await asyncio.to_thread(self.store.save, job)
+
+        def on_stage(name, seconds):
+            job.publish("stage", {"stage": name, "ms": round(seconds * 1000, 1)})
+
+        try:
+            with collect_timings(on_stage) as timings:
+                result = await self.handler(job)
+            job.result = to_jsonable(result)
+            job.status = DONE
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.error = str(e)
+            job.status = FAILED
+
+        job.finished_at = time.time()
+        job.stages = timings
+        job.data = None
+        for name, seconds in timings.items():
+            metrics.observe_stage(name, seconds)
+        if self.store is not None:
+            await asyncio.to_thread(self.store.save, job)
+        job.publish(job.status, job.summary())
+        self._evict()
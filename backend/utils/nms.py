@@ -0,0 +1,143 @@
+import numpy as np
+
+
+# Maximum number of candidate box pairs tested per vectorized batch
+PAIR_CHUNK = 1 << 20
+
+
+def _grid_entries(x0, y0, x1, y1):
+    """
+    Bucket boxes into a uniform grid sized to the typical box.
+    Returns (box index, cell key, cell size, key stride) with one entry per
+    (box, covered cell), sorted by cell key.
+    """
+    candidates = np.flatnonzero((x1 > x0) & (y1 > y0))
+    sizes = np.maximum(x1[candidates] - x0[candidates], y1[candidates] - y0[candidates])
+    cell = float(max(np.percentile(sizes, 90), 1))
+
+    cx0 = np.floor(x0[candidates] / cell).astype(np.int64)
+    cy0 = np.floor(y0[candidates] / cell).astype(np.int64)
+    cx1 = np.ceil(x1[candidates] / cell).astype(np.int64) - 1
+    cy1 = np.ceil(y1[candidates] / cell).astype(np.int64) - 1
+    origin_x, origin_y = cx0.min(), cy0.min()
+    stride = int(cy1.max() - origin_y + 1)
+
+    ncx = cx1 - cx0 + 1
+    ncy = cy1 - cy0 + 1
+    n_cells = ncx * ncy
+    total = int(n_cells.sum())
+    box = np.repeat(candidates, n_cells)
+    local = np.arange(total) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+    ncx_rep = np.repeat(ncx, n_cells)
+    cell_x = np.repeat(cx0, n_cells) + local % ncx_rep
+    cell_y = np.repeat(cy0, n_cells) + local // ncx_rep
+    keys = (cell_x - origin_x) * stride + (cell_y - origin_y)
+
+    order = np.argsort(keys, kind="stable")
+    return box[order], keys[order], cell, (origin_x, origin_y, stride)
+
+
+def _overlapping_pairs(boxes, threshold):
+    """
+    Yield (i, j) index arrays of box pairs where the intersection covers more
+    than threshold of either box.
+
+    Only boxes sharing a grid cell are tested, and each pair is reported once,
+    from the cell holding the top-left corner of its intersection.
+    """
+    x0 = boxes[:, 0]
+    y0 = boxes[:, 1]
+    x1 = boxes[:, 0] + boxes[:, 2]
+    y1 = boxes[:, 1] + boxes[:, 3]
+    area = boxes[:, 2] * boxes[:, 3]
+
+    box, keys, cell, (origin_x, origin_y, stride) = _grid_entries(x0, y0, x1, y1)
+    n = len(box)
+    if n < 2:
+        return
+
+    # Every entry pairs with the entries after it in the same cell
+    starts = np.arange(1, n + 1)
+    ends = np.searchsorted(keys, keys, side="right")
+    counts = ends - starts
+
+    # Split the candidates into batches of at most PAIR_CHUNK pairs
+    cumulative = np.cumsum(counts)
+    batch_start = 0
+    while batch_start < n:
+        offset = cumulative[batch_start - 1] if batch_start else 0
+        batch_end = int(np.searchsorted(cumulative, offset + PAIR_CHUNK, side="right"))
+        batch_end = min(max(batch_end, batch_start + 1), n)
+
+        batch_counts = counts[batch_start:batch_end]
+        total = int(batch_counts.sum())
+        if total:
+            pos_i = np.repeat(np.arange(batch_start, batch_end), batch_counts)
+            # Offset of each pair within its run of candidates for pos_i
+            run_starts = np.cumsum(batch_counts) - batch_counts
+            pos_j = starts[pos_i] + np.arange(total) - np.repeat(run_starts, batch_counts)
+
+            i = box[pos_i]
+            j = box[pos_j]
+            x_left = np.maximum(x0[i], x0[j])
+            y_top = np.maximum(y0[i], y0[j])
+            x_right = np.minimum(x1[i], x1[j])
+            y_bottom = np.minimum(y1[i], y1[j])
+
+            corner_key = (
+                (np.floor(x_left / cell).astype(np.int64) - origin_x) * stride
+                + (np.floor(y_top / cell).astype(np.int64) - origin_y)
+            )
+            overlaps = (x_right > x_left) & (y_bottom > y_top) & (corner_key == keys[pos_i])
+            i, j = i[overlaps], j[overlaps]
+            intersection = (x_right[overlaps] - x_left[overlaps]) * (y_bottom[overlaps] - y_top[overlaps])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                duplicate = (intersection / area[i] > threshold) | (intersection / area[j] > threshold)
+            if duplicate.any():
+                yield i[duplicate], j[duplicate]
+
+        batch_start = batch_end
+
+
+def suppress_overlaps(boxes, threshold=0.6):
+    """
+    Greedy containment suppression over [x, y, w, h] boxes given in priority
+    order (best first). A box is dropped when a higher-priority kept box covers
+    more than threshold of it, or it covers more than threshold of that box.
+
+    Returns the indices of the kept boxes, in priority order. Matches the
+    nested-loop version exactly, but only tests boxes that share a grid cell.
+    """
+    boxes = np.asarray(boxes)
+    n = len(boxes)
+    if n == 0:
+        return []
+    if not np.issubdtype(boxes.dtype, np.number):
+        boxes = boxes.astype(np.float64)
+    boxes = boxes.reshape(n, 4)
+
+    # Direct every conflicting pair from the higher to the lower priority box
+    first_parts, second_parts = [], []
+    for i, j in _overlapping_pairs(boxes, threshold):
+        first_parts.append(np.minimum(i, j))
+        second_parts.append(np.maximum(i, j))
+
+    if not first_parts:
+        return list(range(n))
+
+    first = np.concatenate(first_parts)
+    second = np.concatenate(second_parts)
+    by_first = np.argsort(first, kind="stable")
+    first, second = first[by_first], second[by_first]
+    bounds = np.searchsorted(first, np.arange(n + 1), side="left")
+
+    suppressed = np.zeros(n, dtype=bool)
+    keep = []
+    for idx in range(n):
+        if suppressed[idx]:
+            continue
+        keep.append(idx)
+        lo, hi = bounds[idx], bounds[idx + 1]
+        if hi > lo:
+            suppressed[second[lo:hi]] = True
+    return keep
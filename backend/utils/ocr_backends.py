@@ -0,0 +1,429 @@
+import asyncio
+import logging
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from utils.ocr_cache import ocr_cache, content_hash
+from utils.instrumentation import stage, get_deadline, run_with_deadline
+from utils.vision_client import ManagedVisionClient
+from utils.tables import WordTable, to_jsonable
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of images per Vision batch_annotate_images call
+VISION_BATCH_LIMIT = 16
+
+# How Vision is called: "grpc" (the sync client, on the OCR threads) or
+# "grpc_asyncio" (ImageAnnotatorAsyncClient, awaited on the event loop)
+VISION_TRANSPORT = os.getenv("VISION_TRANSPORT", "grpc")
+ASYNC_TRANSPORT = "grpc_asyncio"
+
+# Backend used when a request does not name one: "auto" tries OCR_BACKENDS in
+# order, "cheapest" tries the available backends from lowest cost up, or name
+# a single backend ("vision", "tesseract")
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto")
+OCR_BACKENDS = [name.strip() for name in os.getenv("OCR_BACKENDS", "vision,tesseract").split(",") if name.strip()]
+
+# Tesseract options; page segmentation mode 11 finds sparse text such as
+# dimension labels scattered over a drawing
+TESSERACT_CONFIG = os.getenv("TESSERACT_CONFIG", "--psm 11")
+
+# google.cloud.vision is slow to import and the client needs credentials, so
+# both are loaded on first use (or by the warm-up hook at startup) instead of
+# at import time
+_vision_client = None
+_vision_client_lock = threading.Lock()
+_vision_async_client = None  # (event loop, client)
+
+def create_vision_client():
+    """Create the Vision client; VISION_CLIENT=fake uses the offline fake client"""
+    if os.getenv("VISION_CLIENT", "").lower() == "fake":
+        from utils.fake_vision import FakeVisionClient
+        return FakeVisionClient.from_env()
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient()
+
+def get_vision_client():
+    """Return the shared Vision client, creating it on first use"""
+    global _vision_client
+    if _vision_client is None:
+        with _vision_client_lock:
+            if _vision_client is None:
+                _vision_client = create_vision_client()
+    return _vision_client
+
+def set_vision_client(client):
+    """Replace the shared Vision client (e.g. with a FakeVisionClient in tests)"""
+    global _vision_client, _vision_async_client
+    _vision_client = client
+    _vision_async_client = None
+
+def get_vision_async_client():
+    """
+    Return the asyncio Vision client of the running event loop, creating it
+    on first use. gRPC asyncio channels belong to one loop, so a new loop
+    gets a new client. A fake sync client provides its own async twin.
+    """
+    global _vision_async_client
+    loop = asyncio.get_running_loop()
+    if _vision_async_client is None or _vision_async_client[0] is not loop:
+        fake = os.getenv("VISION_CLIENT", "").lower() == "fake" or hasattr(_vision_client, "as_async")
+        if fake:
+            async_client = get_vision_client().as_async()
+        else:
+            from google.cloud import vision
+            async_client = vision.ImageAnnotatorAsyncClient()
+        _vision_async_client = (loop, async_client)
+    return _vision_async_client[1]
+
+# All Vision traffic goes through this: timeouts, retries, circuit breaker
+# and request coalescing (see utils.vision_client)
+vision_api = ManagedVisionClient(get_vision_client, get_vision_async_client)
+
+
+# -------- Result normalization --------
+# Every backend collects words into a WordTable and builds its result with
+# build_text_result, so callers never see which engine ran. Tables become the
+# JSON word dicts only at the API boundary (utils.tables.dumps).
+
+def build_text_result(full_text, words, backend):
+    """Build the extract_text result from the full text and a WordTable of detected words"""
+    # Filter for measurements (text containing numbers)
+    measurements = words.take(words.has_digits())
+
+    logger.info("Found %d potential measurements in text", len(measurements))
+
+    return {
+        "status": "success",
+        "full_text": full_text,
+        "details": words,             # all detected text
+        "measurements": measurements, # only those with numbers
+        "total_words": len(words),
+        "backend": backend
+    }
+
+def lines_text(words):
+    """
+    Full text of a WordTable laid out the way the OCR engines report it: one
+    line per row of words, rows top to bottom, words left to right, each
+    line ending in a newline. A word joins the row above when its vertical
+    centre lies within that row.
+    """
+    if not len(words):
+        return ""
+    boxes = words.boxes
+    centers = (boxes[:, 1] + boxes[:, 3]) / 2
+    rows = []  # [bottom, word indices]
+    for i in np.argsort(centers, kind="stable").tolist():
+        # Words come by centre, so only the last row can take this one
+        if rows and centers[i] <= rows[-1][0]:
+            rows[-1][0] = max(rows[-1][0], boxes[i, 3])
+            rows[-1][1].append(i)
+        else:
+            rows.append([boxes[i, 3], [i]])
+    return "".join(
+        " ".join(words.texts[i] for i in sorted(row, key=lambda i: boxes[i, 0])) + "\n" for _, row in rows
+    )
+
+def parse_text_response(response):
+    """Turn a Vision document_text_detection response into the extract_text result"""
+    # Walk the raw protobuf message; the proto-plus wrappers allocate a new
+    # wrapper object on every attribute access, which dominates large pages
+    if hasattr(type(response), "pb"):
+        response = type(response).pb(response)
+
+    if response.error.message:
+        return {"error": f"Text extraction failed: {response.error.message}"}
+
+    if not response.text_annotations:
+        logger.info("No text found in image")
+        return []  # Return empty array when no text found
+
+    # Get the full text (first annotation contains all text in reading order)
+    full_text = response.text_annotations[0].description
+
+    # Extract individual words/phrases with position info
+    texts, confidences, boxes = [], [], []
+    for page in response.full_text_annotation.pages:
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                for word in paragraph.words:
+                    word_text = ''.join([symbol.text for symbol in word.symbols])
+                    # Only include actual text (not empty or just punctuation)
+                    if word_text.strip() and not word_text.strip().isspace():
+                        vertices = word.bounding_box.vertices
+                        xs = [vertex.x for vertex in vertices]
+                        ys = [vertex.y for vertex in vertices]
+                        texts.append(word_text)
+                        confidences.append(word.confidence if word.confidence is not None else 0.0)
+                        boxes.append((min(xs), min(ys), max(xs), max(ys)))
+
+    return build_text_result(full_text, WordTable(texts, confidences, boxes), "vision")
+
+def restore_text_result(result):
+    """Rebuild the WordTables of an extract_text result stored as plain JSON (OCR cache)"""
+    if not isinstance(result, dict) or "details" not in result:
+        return result
+    restored = dict(result)
+    restored["details"] = WordTable.from_dicts(result["details"])
+    restored["measurements"] = WordTable.from_dicts(result["measurements"])
+    return restored
+
+
+# -------- Backends --------
+
+class OCRBackend:
+    """
+    Interface for OCR engines. recognize takes encoded image bytes and returns
+    an extract_text result: a build_text_result dict, [] when there is no
+    text, or {"error": ...}. Exceptions are treated as failures as well.
+    cost is a relative price per image used by the "cheapest" policy.
+    """
+
+    name = None
+    cost = 0.0
+
+    def is_available(self):
+        return True
+
+    def recognize(self, content):
+        raise NotImplementedError
+
+    async def recognize_async(self, content):
+        """Native asyncio recognition; only backends with supports_async implement it"""
+        raise NotImplementedError
+
+    @property
+    def supports_async(self):
+        return False
+
+    def recognize_batch(self, contents):
+        """Recognize many images; backends with a batch API override this"""
+        results = []
+        for content in contents:
+            try:
+                results.append(self.recognize(content))
+            except Exception as e:
+                logger.exception("%s OCR failed", self.name)
+                results.append({"error": f"Text extraction failed: {str(e)}"})
+        return results
+
+
+class GoogleVisionBackend(OCRBackend):
+    """Google Cloud Vision document_text_detection (network round-trip, billed per image)"""
+
+    name = "vision"
+    cost = 1.0
+
+    def recognize(self, content):
+        # Use document_text_detection for better handling of text
+        return parse_text_response(vision_api.document_text(content))
+
+    async def recognize_async(self, content):
+        return parse_text_response(await vision_api.document_text_async(content))
+
+    @property
+    def supports_async(self):
+        return VISION_TRANSPORT == ASYNC_TRANSPORT
+
+    def recognize_batch(self, contents):
+        """Send images VISION_BATCH_LIMIT per batch_annotate_images call"""
+        results = []
+        for start in range(0, len(contents), VISION_BATCH_LIMIT):
+            chunk = contents[start:start + VISION_BATCH_LIMIT]
+            try:
+                response = vision_api.document_text_batch(chunk)
+                results.extend(parse_text_response(image_response) for image_response in response.responses)
+            except Exception as e:
+                error_msg = f"Text extraction failed: {str(e)}"
+                logger.exception(error_msg)
+                results.extend({"error": error_msg} for _ in chunk)
+        return results
+
+
+class TesseractBackend(OCRBackend):
+    """Local Tesseract OCR through pytesseract; runs offline on the CPU"""
+
+    name = "tesseract"
+    cost = 0.0
+
+    def __init__(self, config=TESSERACT_CONFIG):
+        self.config = config
+        self._available = None
+
+    def is_available(self):
+        """True when pytesseract and the tesseract binary are installed (checked once)"""
+        if self._available is None:
+            try:
+                import pytesseract
+                pytesseract.get_tesseract_version()
+                self._available = True
+            except Exception:
+                logger.info("Tesseract is not available; local OCR disabled")
+                self._available = False
+        return self._available
+
+    def recognize(self, content):
+        import pytesseract
+        image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return {"error": "Text extraction failed: could not decode image"}
+
+        data = pytesseract.image_to_data(image, config=self.config, output_type=pytesseract.Output.DICT)
+
+        texts, confidences, boxes = [], [], []
+        lines = {}  # (block, paragraph, line) -> words, in reading order
+        for i, text in enumerate(data["text"]):
+            text = text.strip()
+            confidence = float(data["conf"][i])
+            # Rows without text (pages, blocks, lines) have confidence -1
+            if not text or confidence < 0:
+                continue
+            x, y = data["left"][i], data["top"][i]
+            texts.append(text)
+            confidences.append(confidence / 100)
+            boxes.append((x, y, x + data["width"][i], y + data["height"][i]))
+            lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(text)
+
+        if not texts:
+            logger.info("No text found in image")
+            return []
+
+        full_text = "\n".join(" ".join(words) for words in lines.values()) + "\n"
+        return build_text_result(full_text, WordTable(texts, confidences, boxes), self.name)
+
+
+BACKENDS = {backend.name: backend for backend in (GoogleVisionBackend(), TesseractBackend())}
+
+def register_backend(backend):
+    """Make an OCRBackend selectable by name"""
+    BACKENDS[backend.name] = backend
+
+def resolve_backends(name=None):
+    """
+    Return the backends to try, in order, for a backend name or policy:
+    "auto" (OCR_BACKENDS order), "cheapest" (lowest cost first) or a single
+    backend name. Unavailable backends are skipped by the policies.
+    """
+    name = name or OCR_BACKEND
+    if name == "auto":
+        return [BACKENDS[n] for n in OCR_BACKENDS if n in BACKENDS and BACKENDS[n].is_available()]
+    if name == "cheapest":
+        return sorted((b for b in BACKENDS.values() if b.is_available()), key=lambda b: b.cost)
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown OCR backend: {name}")
+    return [BACKENDS[name]]
+
+
+# -------- Cached recognition with fallback --------
+
+def cache_key(backend, content):
+    return f"{backend.name}-{content_hash(content)}"
+
+def cache_text_result(key, result):
+    """Store successful OCR results (including 'no text') in the OCR cache, as plain JSON"""
+    if "error" not in result:
+        ocr_cache.set(key, to_jsonable(result))
+
+def get_cached_text_result(key):
+    cached = ocr_cache.get(key)
+    return None if cached is None else restore_text_result(cached)
+
+def recognize(content, backend=None):
+    """
+    OCR encoded image bytes, trying each backend from resolve_backends in turn
+    until one succeeds. Results are cached per backend and content hash.
+    """
+    result = {"error": "Text extraction failed: no OCR backend available"}
+    for engine in resolve_backends(backend):
+        key = cache_key(engine, content)
+        cached = get_cached_text_result(key)
+        if cached is not None:
+            logger.info("OCR cache hit (%s)", engine.name)
+            return cached
+
+        try:
+            with stage("ocr"):
+                result = engine.recognize(content)
+        except Exception as e:
+            result = {"error": f"Text extraction failed: {str(e)}"}
+
+        if "error" not in result:
+            cache_text_result(key, result)
+            return result
+        logger.warning("%s OCR failed (%s), trying next backend", engine.name, result["error"])
+    return result
+
+async def recognize_async(content, backend=None, executor=None):
+    """
+    recognize for the event loop. Backends with native asyncio support
+    (Vision with VISION_TRANSPORT=grpc_asyncio) are awaited directly, the
+    others run on executor (the loop's default executor if None) with the
+    request deadline carried over.
+    """
+    loop = asyncio.get_running_loop()
+    result = {"error": "Text extraction failed: no OCR backend available"}
+    for engine in resolve_backends(backend):
+        key = cache_key(engine, content)
+        cached = get_cached_text_result(key)
+        if cached is not None:
+            logger.info("OCR cache hit (%s)", engine.name)
+            return cached
+
+        try:
+            with stage("ocr"):
+                if engine.supports_async:
+                    result = await engine.recognize_async(content)
+                else:
+                    result = await loop.run_in_executor(executor, run_with_deadline, get_deadline(), engine.recognize, content)
+        except Exception as e:
+            result = {"error": f"Text extraction failed: {str(e)}"}
+
+        if "error" not in result:
+            cache_text_result(key, result)
+            return result
+        logger.warning("%s OCR failed (%s), trying next backend", engine.name, result["error"])
+    return result
+
+def recognize_batch(contents, backend=None):
+    """
+    OCR many encoded images; returns one result per image, in order. Each
+    backend gets the images that are neither cached nor done yet in a single
+    recognize_batch call (Vision batches them), failures fall through to the
+    next backend.
+    """
+    results = [None] * len(contents)
+    pending = list(range(len(contents)))
+    for engine in resolve_backends(backend):
+        uncached = []
+        for i in pending:
+            cached = get_cached_text_result(cache_key(engine, contents[i]))
+            if cached is not None:
+                results[i] = cached
+            else:
+                uncached.append(i)
+        if not uncached:
+            return results
+
+        with stage("ocr"):
+            engine_results = engine.recognize_batch([contents[i] for i in uncached])
+
+        pending = []
+        for i, result in zip(uncached, engine_results):
+            results[i] = result
+            if "error" in result:
+                pending.append(i)
+            else:
+                cache_text_result(cache_key(engine, contents[i]), result)
+        if not pending:
+            return results
+        logger.warning("%s OCR failed for %d images, trying next backend", engine.name, len(pending))
+
+    for i in pending:
+        if results[i] is None:
+            results[i] = {"error": "Text extraction failed: no OCR backend available"}
+    return results
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+def content_hash(content):
+    """Return the SHA-256 hex digest used as the OCR cache key"""
+    return hashlib.sha256(content).hexdigest()
+
+
+class OCRCache:
+    """
+    Content-hash keyed cache for OCR results.
+
+    Entries live in an in-memory LRU bounded by max_entries and expire after
+    ttl_seconds. If cache_dir is set, results are also written there as JSON
+    so they survive restarts and can be shared between workers.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=3600, cache_dir=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _expired(self, stored_at):
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            stored_at = os.path.getmtime(path)
+            if self._expired(stored_at):
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return stored_at, json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, value):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("OCR cache: failed to write %s: %s", path, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _insert(self, key, stored_at, value):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry[0]):
+                    del self._entries[key]
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+
+            if entry is None and self.cache_dir:
+                entry = self._read_disk(key)
+                if entry is not None:
+                    self._insert(key, *entry)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store an OCR result under key"""
+        with self._lock:
+            self._insert(key, time.time(), value)
+            if self.cache_dir:
+                self._write_disk(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared cache used by extract_text. Configure through environment variables;
+# OCR_CACHE_SIZE=0 with no OCR_CACHE_DIR disables caching.
+ocr_cache = OCRCache(
+    max_entries=int(os.getenv("OCR_CACHE_SIZE", "256")),
+    ttl_seconds=float(os.getenv("OCR_CACHE_TTL", "86400")),
+    cache_dir=os.getenv("OCR_CACHE_DIR") or None,
+)
@@ -0,0 +1,473 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+import cv2
+import numpy as np
+
+from utils.image_processing import (
+    extract_text, extract_text_async, extract_text_batch, detect_segments, attach_measurements,
+    link_measurements_to_segments, decode_image, get_vision_client, update_segments,
+    update_dimension_strokes,
+    VISION_BATCH_LIMIT, SEGMENTATION_METHOD
+)
+from utils.ocr_backends import resolve_backends, OCR_BACKEND, VISION_TRANSPORT, ASYNC_TRANSPORT
+from utils.result_cache import result_cache, fingerprint_bytes, image_fingerprint, HIT, NEAR_DUPLICATE, MISS
+from utils.incremental import (
+    analysis_store, AnalysisState, changed_regions, clip_rects, update_text, relink_result
+)
+from utils.shared_images import shared_images, call_with_shared_image, start_tracker
+from utils.classifier import get_classifier
+from utils.visualization import render_overlay
+from utils.instrumentation import configure_logging, run_timed, run_with_deadline, get_deadline, merge_timings
+
+logger = logging.getLogger(__name__)
+
+
+# Concurrency settings. OCR is network-bound and runs on threads; segmentation
+# is CPU-bound and runs on worker processes (SEGMENTATION_PROCESSES=0 keeps it
+# on the thread pool instead). MAX_CONCURRENT_UPLOADS bounds how many images
+# are processed at once per API worker.
+OCR_THREADS = int(os.getenv("OCR_THREADS", "8"))
+SEGMENTATION_PROCESSES = int(os.getenv("SEGMENTATION_PROCESSES", str(os.cpu_count() or 1)))
+MAX_CONCURRENT_UPLOADS = int(os.getenv("MAX_CONCURRENT_UPLOADS", "4"))
+
+# How uploads reach the segmentation processes: with SEGMENTATION_SHARED_MEMORY
+# the API process decodes each image once (the array is reused for the
+# overlay and the result cache fingerprint) and workers read it from shared
+# memory; with SEGMENTATION_SHARED_MEMORY=0 they get the encoded bytes and
+# decode them themselves
+SEGMENTATION_SHARED_MEMORY = os.getenv("SEGMENTATION_SHARED_MEMORY", "1") == "1"
+
+# Segmentation processes are started from a clean server process rather than
+# forked from the API process, which by then has gRPC channels and threads
+# (the thread pools, the Vision client, the event loop) that fork does not
+# carry over safely
+SEGMENTATION_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+_thread_pool = None
+_process_pool = None
+_upload_semaphore = None
+
+
+def get_thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=OCR_THREADS, thread_name_prefix="ocr")
+    return _thread_pool
+
+
+def get_segmentation_pool():
+    """Return the executor used for segmentation (process pool unless disabled)"""
+    global _process_pool
+    if SEGMENTATION_PROCESSES <= 0:
+        return get_thread_pool()
+    if _process_pool is None:
+        if SEGMENTATION_SHARED_MEMORY:
+            start_tracker()
+        _process_pool = ProcessPoolExecutor(
+            max_workers=SEGMENTATION_PROCESSES, initializer=init_worker,
+            mp_context=multiprocessing.get_context(SEGMENTATION_START_METHOD),
+        )
+    return _process_pool
+
+
+def get_upload_semaphore():
+    global _upload_semaphore
+    if _upload_semaphore is None:
+        _upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
+    return _upload_semaphore
+
+
+def shutdown_pools():
+    """Stop the worker pools; called on application shutdown"""
+    global _thread_pool, _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    shared_images.close()
+
+
+def submit_to_pool(pool, fn, *args):
+    """Submit fn to a worker pool with the request deadline; returns the concurrent future of (result, timings)"""
+    deadline = get_deadline()
+    if deadline is not None:
+        fn, args = run_with_deadline, (deadline, fn) + args
+    return pool.submit(run_timed, fn, *args)
+
+
+async def run_in_pool(pool, fn, *args):
+    """
+    Run fn on a worker pool and merge its stage timings into the current
+    request. The request deadline goes along, so OCR calls on the pool
+    respect it.
+    """
+    result, timings = await asyncio.wrap_future(submit_to_pool(pool, fn, *args))
+    merge_timings(timings)
+    return result
+
+
+def text_job(data, ocr_backend=None):
+    """OCR of an upload as an awaitable: on the event loop with the asyncio Vision transport, else on the thread pool"""
+    if VISION_TRANSPORT == ASYNC_TRANSPORT:
+        return extract_text_async(data, ocr_backend, get_thread_pool())
+    return run_in_pool(get_thread_pool(), extract_text, data, ocr_backend)
+
+
+def warm_up_worker():
+    """Run a tiny segmentation so OpenCV/NumPy code paths (and the component model) are loaded in this process"""
+    detect_segments(np.full((64, 64, 3), 255, dtype=np.uint8))
+    classifier = get_classifier()
+    if classifier.model is not None:
+        classifier.model.load()
+    return os.getpid()
+
+
+def init_worker():
+    """
+    Segmentation process initializer: logging, OpenCV threads and a warm-up
+    run, so the first request a process gets does not pay for them. The
+    processes split the cores between them; OpenCV's own thread pool
+    would otherwise start a thread per core in every process.
+    """
+    configure_logging()
+    cv2.setNumThreads(max(1, (os.cpu_count() or 1) // max(SEGMENTATION_PROCESSES, 1)))
+    warm_up_worker()
+
+
+async def segment_shared(data, decoded, method, keep_raw):
+    """
+    detect_segments on a segmentation process, with the image decoded here
+    (unless decoded is given) and passed through shared memory. Returns
+    (segments_result, decoded).
+    """
+    if decoded is None:
+        decoded = await run_in_pool(get_thread_pool(), decode_image, data)
+        if decoded is None:
+            return {"error": "Failed to read image"}, None
+    # Cancelling the request (JobQueue.stop, a cancelled gather) does not
+    # stop the thread copying into the block or the process reading it, so
+    # the block goes back to the pool only once they are done with it
+    copy = submit_to_pool(get_thread_pool(), shared_images.put, decoded)
+    try:
+        ref, timings = await asyncio.wrap_future(copy)
+    except asyncio.CancelledError:
+        copy.add_done_callback(release_copied)
+        raise
+    merge_timings(timings)
+    try:
+        job = submit_to_pool(
+            get_segmentation_pool(), call_with_shared_image, detect_segments, ref, None, None, method, None, keep_raw
+        )
+    except BaseException:
+        shared_images.release(ref)
+        raise
+    job.add_done_callback(lambda done: shared_images.release(ref))
+    segments_result, timings = await asyncio.wrap_future(job)
+    merge_timings(timings)
+    return segments_result, decoded
+
+
+def release_copied(copy):
+    """Done callback of a shared_images.put job nobody waits for any more: release its block"""
+    if not copy.cancelled() and copy.exception() is None:
+        shared_images.release(copy.result()[0])
+
+
+def warm_up():
+    """
+    Load everything the first request would otherwise pay for: the OCR
+    backends and Vision client, OpenCV/NumPy code paths and the worker pools (with each
+    segmentation process started and warmed).
+    """
+    backends = [backend.name for backend in resolve_backends()]
+    logger.info("OCR backends in use: %s", ", ".join(backends) or "none")
+    if "vision" in backends:
+        try:
+            get_vision_client()
+        except Exception:
+            logger.warning("Vision client could not be created; Vision OCR requests will fail", exc_info=True)
+
+    warm_up_worker()
+    get_thread_pool()
+    if SEGMENTATION_PROCESSES > 0:
+        pool = get_segmentation_pool()
+        done, _ = wait([pool.submit(warm_up_worker) for _ in range(SEGMENTATION_PROCESSES)])
+        logger.info("Warmed %d segmentation processes", len({future.result() for future in done}))
+
+
+def get_text_details(text_result):
+    """Return all detected words from an extract_text result"""
+    if isinstance(text_result, list):
+        return text_result
+    return text_result.get("details", [])
+
+
+def is_primary_result(text_result, ocr_backend=None):
+    """
+    True if text_result comes from the first backend the OCR policy tries.
+    A fallback result (Tesseract while Vision is down) or one of unknown
+    origin ([] for no text) says nothing about what the next upload gets.
+    """
+    if not isinstance(text_result, dict) or "backend" not in text_result:
+        return False
+    backends = resolve_backends(ocr_backend)
+    return bool(backends) and text_result["backend"] == backends[0].name
+
+
+def combine_results(text_result, segments_result):
+    """Link measurements to segments and build the API response body"""
+    if isinstance(text_result, dict):
+        logger.debug("Text extraction result: %s", text_result.get('status', 'unknown'))
+    else:
+        logger.debug("Extracted %d text items", len(text_result))
+    logger.debug("Segmentation result: %s", segments_result.get('status', 'unknown'))
+
+    segments_result = attach_measurements(segments_result, text_result)
+
+    # Link measurements to nearest segments (or along their dimension lines)
+    linked_data = link_measurements_to_segments(
+        get_text_details(text_result),
+        segments_result.get("segments", []),
+        dimension_lines=segments_result.get("dimension_lines")
+    )
+    logger.info("Linked %d measurements to segments", len(linked_data))
+
+    return {
+        "text_result": text_result,
+        "segments_result": segments_result,
+        "linked_data": linked_data,
+    }
+
+
+async def analyze_image_async(data, visualize=False, overlay_format="png", ocr_backend=None, method=None, use_cache=True):
+    """
+    Run the full OCR + segmentation + linking pipeline on in-memory encoded
+    bytes. OCR and segmentation run in parallel on the worker pools so the
+    event loop is never blocked and latency is roughly the slower of the two
+    stages.
+
+    Results are kept in the result cache: identical uploads are served from
+    it without running the pipeline, near-duplicates (by perceptual hash)
+    get the cached result of the closest image. result["cache"] tells which
+    happened. use_cache=False skips the lookup but still stores the result.
+    Results of a fallback OCR backend are not cached.
+    
+    Results computed for these bytes (not near-duplicates) are kept in the
+    analysis store for update_analysis_async; result["result_id"] names them.
+
+    Returns (result, overlay) where overlay holds the encoded overlay image
+    when visualize is set, else None.
+    """
+    async with get_upload_semaphore():
+        options = (ocr_backend or OCR_BACKEND, method or SEGMENTATION_METHOD)
+        cached, cache_info, fingerprint, decoded, result_id = None, None, None, None, None
+        if result_cache.enabled:
+            key = result_cache.key(data, options)
+            if use_cache:
+                cached = result_cache.get(key)
+                if cached is not None:
+                    cache_info = {"status": HIT}
+                elif result_cache.has_candidates(options):
+                    if SEGMENTATION_PROCESSES > 0 and not SEGMENTATION_SHARED_MEMORY:
+                        fingerprint = await run_in_pool(get_thread_pool(), fingerprint_bytes, data)
+                    else:
+                        # The decoded image is needed below anyway
+                        decoded = await run_in_pool(get_thread_pool(), decode_image, data)
+                        if decoded is not None:
+                            fingerprint = await run_in_pool(get_thread_pool(), image_fingerprint, decoded)
+                    similar = result_cache.find_similar(fingerprint, options)
+                    if similar is not None:
+                        source, distance, cached = similar
+                        cache_info = {"status": NEAR_DUPLICATE, "distance": distance, "source": source[:16]}
+            if cache_info is None:
+                cache_info = {"status": MISS}
+
+        if cached is not None:
+            logger.info("Result cache %s", cache_info["status"])
+            text_result, segments_result, result_id = cached
+            if visualize and decoded is None:
+                decoded = await run_in_pool(get_thread_pool(), decode_image, data)
+        else:
+            logger.debug("Starting text extraction and segmentation...")
+            ocr_job = text_job(data, ocr_backend)
+
+            if SEGMENTATION_PROCESSES > 0 and SEGMENTATION_SHARED_MEMORY:
+                text_result, (segments_result, decoded) = await asyncio.gather(
+                    ocr_job, segment_shared(data, decoded, method, analysis_store.enabled)
+                )
+            elif SEGMENTATION_PROCESSES > 0:
+                # Worker processes decode the bytes themselves, which is cheaper
+                # than pickling the decoded array over to them
+                segmentation_job = run_in_pool(
+                    get_segmentation_pool(), detect_segments, data, None, None, method, None, analysis_store.enabled
+                )
+                if visualize:
+                    text_result, segments_result, decoded = await asyncio.gather(
+                        ocr_job, segmentation_job, run_in_pool(get_thread_pool(), decode_image, data)
+                    )
+                elif result_cache.enabled and fingerprint is None:
+                    text_result, segments_result, fingerprint = await asyncio.gather(
+                        ocr_job, segmentation_job, run_in_pool(get_thread_pool(), fingerprint_bytes, data)
+                    )
+                else:
+                    text_result, segments_result = await asyncio.gather(ocr_job, segmentation_job)
+            else:
+                # Decode once and share the array with segmentation and rendering
+                if decoded is None:
+                    decoded = await run_in_pool(get_thread_pool(), decode_image, data)
+                segmentation_job = run_in_pool(
+                    get_thread_pool(), detect_segments, decoded if decoded is not None else data, None, None, method,
+                    None, analysis_store.enabled
+                )
+                text_result, segments_result = await asyncio.gather(ocr_job, segmentation_job)
+
+        result = await run_in_pool(get_thread_pool(), combine_results, text_result, segments_result)
+        if cache_info is not None:
+            result["cache"] = cache_info
+        if "raw_segments" in segments_result and (cache_info is None or cache_info["status"] != NEAR_DUPLICATE):
+            state = AnalysisState(data, options, text_result, segments_result["raw_segments"], result,
+                                  segments_result.get("dimension_strokes"))
+            result["result_id"] = analysis_store.put(state)
+        elif cache_info is not None and cache_info["status"] == HIT and result_id is not None:
+            # Same bytes and options: the stored analysis still applies
+            if analysis_store.get(result_id) is not None:
+                result["result_id"] = result_id
+
+        if cached is None and result_cache.enabled and is_primary_result(text_result, ocr_backend):
+            if fingerprint is None and decoded is not None:
+                fingerprint = await run_in_pool(get_thread_pool(), image_fingerprint, decoded)
+            result_cache.put(key, options, fingerprint, text_result, segments_result, result.get("result_id"))
+
+        overlay = None
+        if visualize and decoded is not None:
+            overlay = await run_in_pool(
+                get_thread_pool(),
+                render_overlay,
+                decoded,
+                result["segments_result"].get("segments", []),
+                result["linked_data"],
+                overlay_format,
+            )
+        return result, overlay
+
+
+async def update_analysis_async(result_id, data, rects=None):
+    """
+    Re-analyze an edited version of a stored result (see analyze_image_async)
+    from its changed regions only: rects ((x, y, w, h) list) or, if not
+    given, the pixels that differ from the stored image. Segmentation
+    (update_segments) and OCR (update_text) run on those regions, and only
+    the links they can affect are recomputed, so the cost follows the size
+    of the edit rather than of the image. Changes outside the given rects
+    are not seen.
+
+    Falls back to a full analysis when the image size changed or the stored
+    result cannot be updated (failed OCR or segmentation). Returns the new
+    result, stored under a new result_id, with result["incremental"] telling
+    what was done; None if result_id is unknown.
+    """
+    state = analysis_store.get(result_id)
+    if state is None:
+        return None
+    ocr_backend, method = state.options
+
+    reason = None
+    async with get_upload_semaphore():
+        image = await run_in_pool(get_thread_pool(), decode_image, data)
+        if image is None:
+            raise ValueError("Failed to read image")
+        image_height, image_width = image.shape[:2]
+        if [image_width, image_height] != state.image_size:
+            reason = "image size changed"
+        elif not isinstance(state.text_result, list) and "error" in state.text_result:
+            reason = "previous OCR failed"
+        else:
+            if rects is None:
+                old_image = await run_in_pool(get_thread_pool(), decode_image, state.data)
+                rects = await run_in_pool(get_thread_pool(), changed_regions, old_image, image)
+            else:
+                rects = clip_rects(rects, image_width, image_height)
+
+            jobs = [
+                run_in_pool(get_thread_pool(), update_text, image, state.text_result, rects, ocr_backend),
+                run_in_pool(get_thread_pool(), update_segments, image, state.raw_segments, rects),
+            ]
+            if state.strokes is not None:
+                jobs.append(run_in_pool(get_thread_pool(), update_dimension_strokes, image, state.strokes, rects))
+            (text_result, kept, fresh), (raw_segments, segments, windows), *strokes = await asyncio.gather(*jobs)
+            if kept is None:
+                reason = "OCR of the changed regions failed"
+
+    if reason is not None:
+        logger.info("Incremental update of %s not possible (%s); running a full analysis", result_id, reason)
+        result, _ = await analyze_image_async(data, ocr_backend=ocr_backend, method=method)
+        result["incremental"] = {"status": "full", "source": result_id, "reason": reason}
+        return result
+
+    segments_result = {
+        "status": "success",
+        "num_segments": len(segments),
+        "segments": segments,
+        "method": method,
+        "image_size": state.image_size,
+    }
+    if strokes:
+        segments_result["dimension_strokes"] = strokes[0]
+    result, relinked = await run_in_pool(get_thread_pool(), relink_result, state, text_result, kept, fresh, segments_result)
+    result["result_id"] = analysis_store.put(
+        AnalysisState(data, state.options, text_result, raw_segments, result, segments_result.get("dimension_strokes"))
+    )
+    result["incremental"] = {
+        "status": "incremental",
+        "source": result_id,
+        "regions": rects,
+        "windows": windows,
+        "words_replaced": int((~kept).sum()),
+        "words_added": len(fresh),
+        "links_recomputed": relinked,
+    }
+    logger.info("Updated %s incrementally: %d regions, %d links recomputed", result_id, len(rects), relinked)
+    return result
+
+
+async def analyze_images_batch(images, ocr_backend=None, method=None):
+    """
+    Analyze many images (encoded bytes), yielding (index, result) as each one
+    finishes. OCR goes out in batches of up to VISION_BATCH_LIMIT images (one
+    Vision batch request each) while segmentation fans out over the
+    segmentation pool.
+    """
+    ocr_batches = [
+        asyncio.ensure_future(
+            run_in_pool(get_thread_pool(), extract_text_batch, images[start:start + VISION_BATCH_LIMIT], ocr_backend)
+        )
+        for start in range(0, len(images), VISION_BATCH_LIMIT)
+    ]
+
+    async def process(index):
+        try:
+            async with get_upload_semaphore():
+                segments_result = await run_in_pool(
+                    get_segmentation_pool(), detect_segments, images[index], None, None, method
+                )
+            text_results = await ocr_batches[index // VISION_BATCH_LIMIT]
+            text_result = text_results[index % VISION_BATCH_LIMIT]
+            result = await run_in_pool(get_thread_pool(), combine_results, text_result, segments_result)
+        except Exception as e:
+            logger.exception("Failed to process batch image %d", index)
+            result = {"error": str(e)}
+        return index, result
+
+    tasks = [asyncio.ensure_future(process(index)) for index in range(len(images))]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks + ocr_batches:
+            task.cancel()
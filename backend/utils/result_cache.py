@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from utils.ocr_cache import content_hash
+from utils.instrumentation import stage
+
+logger = logging.getLogger(__name__)
+
+
+# Whole-pipeline result cache for /upload/. Identical uploads (same bytes and
+# options) are exact hits; uploads whose perceptual hash differs from a
+# cached image of the same size by at most RESULT_CACHE_DISTANCE bits are
+# near-duplicates (re-exports, tiny edits) and get the cached result marked
+# as such. RESULT_CACHE_SIZE=0 disables the cache, RESULT_CACHE_DISTANCE=-1
+# disables near-duplicate matching. Entries expire after RESULT_CACHE_TTL
+# seconds (0 = never), so results follow OCR and model changes.
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "128"))
+RESULT_CACHE_DISTANCE = int(os.getenv("RESULT_CACHE_DISTANCE", "10"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+
+# dHash grid; 16 gives 256-bit hashes, where re-exports and small edits of a
+# sketch stay within a few bits and different sketches are dozens apart
+DHASH_SIZE = 16
+
+HIT = "hit"
+NEAR_DUPLICATE = "near_duplicate"
+MISS = "miss"
+
+
+def dhash(gray, hash_size=DHASH_SIZE):
+    """Difference hash of a grayscale image as an int (hash_size * hash_size bits)"""
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def image_fingerprint(image):
+    """(dhash, (width, height)) of a decoded BGR or gray ndarray"""
+    with stage("fingerprint"):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        return dhash(gray), (image.shape[1], image.shape[0])
+
+def fingerprint_bytes(data):
+    """image_fingerprint of encoded bytes, or None if they cannot be decoded"""
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    with stage("fingerprint"):
+        image = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+    return None if image is None else image_fingerprint(image)
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ResultCache:
+    """
+    Size-bounded LRU of (text_result, segments_result, result_id) entries
+    keyed by upload content hash and pipeline options, with a perceptual
+    hash per entry for near-duplicate lookups and a time to live. result_id
+    names the analysis store state of the result, if any. Entries are
+    shared, so callers must not mutate the returned results.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, max_distance=RESULT_CACHE_DISTANCE, ttl=RESULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.ttl = ttl
+        # key -> (options, fingerprint, (text_result, segments_result, result_id), stored_at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(data, options):
+        return f"{content_hash(data)}-{'-'.join(str(option) for option in options)}"
+
+    def _expire(self):
+        # Called with the lock held
+        if self.ttl <= 0:
+            return
+        cutoff = time.monotonic() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry[3] < cutoff]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, key):
+        """Exact lookup: (text_result, segments_result, result_id) or None"""
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def has_candidates(self, options):
+        """True if a near-duplicate lookup with these options could match anything"""
+        if self.max_distance < 0:
+            return False
+        with self._lock:
+            self._expire()
+            return any(entry[0] == options for entry in self._entries.values())
+
+    def find_similar(self, fingerprint, options):
+        """Closest entry of the same size and options within max_distance: (key, distance, results) or None"""
+        if self.max_distance < 0 or fingerprint is None:
+            return None
+        image_hash, size = fingerprint
+        with self._lock:
+            self._expire()
+            best = None
+            for key, (entry_options, (entry_hash, entry_size), results, _) in self._entries.items():
+                if entry_options != options or entry_size != size:
+                    continue
+                distance = hamming(image_hash, entry_hash)
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (key, distance, results)
+            if best is not None:
+                self._entries.move_to_end(best[0])
+                self.near_hits += 1
+            return best
+
+    def put(self, key, options, fingerprint, text_result, segments_result, result_id=None):
+        """
+        Store a successful pipeline result; failed OCR or segmentation is not
+        cached. The raw segments (contours kept for incremental updates) are
+        left out, the analysis store holds them under result_id.
+        """
+        if not self.enabled or fingerprint is None:
+            return
+        if (isinstance(text_result, dict) and "error" in text_result) or "error" in segments_result:
+            return
+        if "raw_segments" in segments_result:
+            segments_result = {name: value for name, value in segments_result.items() if name != "raw_segments"}
+        with self._lock:
+            self._entries[key] = (options, fingerprint, (text_result, segments_result, result_id), time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+result_cache = ResultCache()
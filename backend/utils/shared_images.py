@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Decoded images reach segmentation processes through shared memory: the API
+# process copies the pixels into a block once and the worker maps the same
+# block as an ndarray, so no image is pickled through the pool's pipe. Up to
+# SHARED_MEMORY_BLOCKS idle blocks are kept for reuse, which saves creating
+# and faulting in a new block per request.
+SHARED_MEMORY_BLOCKS = int(os.getenv("SHARED_MEMORY_BLOCKS", "8"))
+
+
+class SharedImagePool:
+    """
+    Reusable shared memory blocks for passing decoded images to worker
+    processes. put() copies an image into a free block and returns a small
+    picklable reference (block name, shape, dtype); release() makes the
+    block available again once the worker is done with it.
+    """
+
+    def __init__(self, max_idle=SHARED_MEMORY_BLOCKS):
+        self.max_idle = max_idle
+        self._idle = []  # SharedMemory blocks, smallest first
+        self._blocks = {}  # name -> SharedMemory, blocks in use
+        self._lock = threading.Lock()
+
+    def _acquire(self, nbytes):
+        with self._lock:
+            for i, block in enumerate(self._idle):
+                if block.size >= nbytes:
+                    block = self._idle.pop(i)
+                    break
+            else:
+                block = None
+        if block is None:
+            block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        with self._lock:
+            self._blocks[block.name] = block
+        return block
+
+    def put(self, image):
+        """Copy an ndarray into a shared block and return its reference"""
+        image = np.ascontiguousarray(image)
+        block = self._acquire(image.nbytes)
+        np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[...] = image
+        return block.name, image.shape, image.dtype.str
+
+    def release(self, ref):
+        """Return the block of a reference to the pool; blocks beyond max_idle are freed"""
+        with self._lock:
+            block = self._blocks.pop(ref[0], None)
+            if block is None:
+                return
+            if len(self._idle) < self.max_idle:
+                self._idle.append(block)
+                self._idle.sort(key=lambda idle: idle.size)
+                return
+        free_block(block)
+
+    def close(self):
+        """Free the idle blocks (blocks still in use are freed when released)"""
+        with self._lock:
+            idle, self._idle, self.max_idle = self._idle, [], 0
+        for block in idle:
+            free_block(block)
+
+
+def start_tracker():
+    """
+    Start the shared memory resource tracker before starting worker
+    processes, so they (and the forkserver) report to this process's tracker. A worker that
+    started its own would unlink the blocks it saw when it exits.
+    """
+    resource_tracker.ensure_running()
+
+
+def attach_block(name):
+    try:
+        # Python 3.13+: the API process owns the block, the worker only maps it
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def free_block(block):
+    block.close()
+    try:
+        block.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def call_with_shared_image(fn, ref, *args):
+    """
+    Worker side of SharedImagePool: call fn(image, *args) with image a
+    zero-copy view of the referenced block. fn must not keep references to
+    the image in its result.
+    """
+    name, shape, dtype = ref
+    block = attach_block(name)
+    try:
+        image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+        result = fn(image, *args)
+        del image
+        return result
+    finally:
+        try:
+            block.close()
+        except BufferError:
+            # A view is still alive (e.g. in a traceback); the mapping goes with it
+            logger.debug("Shared image %s still referenced, leaving it mapped", name)
+
+
+shared_images = SharedImagePool()
@@ -0,0 +1,111 @@
+import numpy as np
+
+from utils.tables import WordTable, as_segment_table
+
+
+# Rows of the measurement x segment distance matrix computed at once; bounds
+# memory to CHUNK_ROWS * num_segments floats for very dense drawings.
+CHUNK_ROWS = 4096
+
+METRICS = ("center", "edge")
+
+
+class SegmentIndex:
+    """
+    Batched nearest-segment lookups over segment bounding boxes.
+
+    Distances are computed with NumPy broadcasting, either to segment centers
+    ("center", the original behaviour) or to the closest point on the segment
+    box ("edge", zero when the point lies inside the box).
+    """
+
+    def __init__(self, segments):
+        self.segments = as_segment_table(segments)
+        boxes = self.segments.boxes.astype(np.float64)
+        self.x0 = boxes[:, 0]
+        self.y0 = boxes[:, 1]
+        self.x1 = boxes[:, 0] + boxes[:, 2]
+        self.y1 = boxes[:, 1] + boxes[:, 3]
+        self.center_x = boxes[:, 0] + boxes[:, 2] / 2
+        self.center_y = boxes[:, 1] + boxes[:, 3] / 2
+
+    def __len__(self):
+        return len(self.segments)
+
+    def anchor_points(self, points, indices, metric="center"):
+        """Return the point on each matched segment that distances were measured to"""
+        if metric == "center":
+            return np.stack([self.center_x[indices], self.center_y[indices]], axis=1)
+        px, py = points[:, 0], points[:, 1]
+        return np.stack([
+            np.clip(px, self.x0[indices], self.x1[indices]),
+            np.clip(py, self.y0[indices], self.y1[indices]),
+        ], axis=1)
+
+    def distances(self, points, metric="center"):
+        """Return the (len(points), len(segments)) distance matrix"""
+        if metric not in METRICS:
+            raise ValueError(f"Unknown distance metric: {metric}")
+        px = points[:, 0:1]
+        py = points[:, 1:2]
+        if metric == "center":
+            dx = px - self.center_x
+            dy = py - self.center_y
+        else:
+            dx = np.maximum(np.maximum(self.x0 - px, px - self.x1), 0)
+            dy = np.maximum(np.maximum(self.y0 - py, py - self.y1), 0)
+        return np.sqrt(dx * dx + dy * dy)
+
+    def nearest(self, points, max_distance=None, metric="center"):
+        """
+        Find the nearest segment for every point.
+        Returns (indices, distances); index is -1 where no segment lies within
+        max_distance. Ties go to the earlier segment, like the old loops.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        indices = np.full(len(points), -1, dtype=np.intp)
+        best = np.full(len(points), np.inf)
+        if len(points) == 0 or len(self.segments) == 0:
+            return indices, best
+
+        for start in range(0, len(points), CHUNK_ROWS):
+            chunk = self.distances(points[start:start + CHUNK_ROWS], metric)
+            idx = np.argmin(chunk, axis=1)
+            indices[start:start + CHUNK_ROWS] = idx
+            best[start:start + CHUNK_ROWS] = chunk[np.arange(len(idx)), idx]
+
+        if max_distance is not None:
+            indices[best > max_distance] = -1
+        return indices, best
+
+
+class SpanIndex:
+    """
+    Segment boxes sorted by where they start along each axis, for finding the
+    boxes that span a given interval without comparing it to every segment.
+    """
+
+    def __init__(self, segments):
+        boxes = as_segment_table(segments).boxes.astype(np.float64)
+        self.starts = (boxes[:, 0], boxes[:, 1])
+        self.ends = (boxes[:, 0] + boxes[:, 2], boxes[:, 1] + boxes[:, 3])
+        self.order = tuple(np.argsort(starts, kind="stable") for starts in self.starts)
+        self.sorted_starts = tuple(starts[order] for starts, order in zip(self.starts, self.order))
+
+    def spanning(self, axis, start, end, tolerance):
+        """Indices (ascending) of the boxes reaching from start to end along axis (0: x, 1: y), to within tolerance at each end"""
+        sorted_starts = self.sorted_starts[axis]
+        lo = np.searchsorted(sorted_starts, start - tolerance, side="left")
+        hi = np.searchsorted(sorted_starts, start + tolerance, side="right")
+        candidates = self.order[axis][lo:hi]
+        return np.sort(candidates[np.abs(self.ends[axis][candidates] - end) <= tolerance])
+
+
+def measurement_centers(measurements):
+    """Return an (M, 2) array of measurement bbox centers (WordTable or list of word dicts)"""
+    if isinstance(measurements, WordTable):
+        return measurements.centers()
+    return np.array(
+        [(m["bbox"]["center_x"], m["bbox"]["center_y"]) for m in measurements],
+        dtype=np.float64,
+    ).reshape(-1, 2)
@@ -0,0 +1,235 @@
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional; the standard json module is used instead
+    orjson = None
+
+
+class WordTable:
+    """
+    Columnar OCR words: a list of texts plus NumPy arrays of confidences and
+    (x0, y0, x1, y1) boxes. Used throughout the pipeline instead of one dict
+    per word; to_dicts() produces the extract_text word dicts for the API.
+    """
+
+    __slots__ = ("texts", "confidence", "boxes")
+
+    def __init__(self, texts=(), confidence=(), boxes=()):
+        self.texts = list(texts)
+        self.confidence = np.asarray(confidence, dtype=np.float64).reshape(-1)
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+
+    @classmethod
+    def from_dicts(cls, words):
+        """Build a table from extract_text word dicts (e.g. from the OCR cache)"""
+        return cls(
+            [word["text"] for word in words],
+            [word["confidence"] for word in words],
+            [(word["bbox"]["x"], word["bbox"]["y"],
+              word["bbox"]["x"] + word["bbox"]["width"], word["bbox"]["y"] + word["bbox"]["height"])
+             for word in words],
+        )
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, i):
+        return self.row(i)
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def take(self, indices):
+        """Return a new table with the given rows (indices or boolean mask)"""
+        indices = np.flatnonzero(indices) if np.asarray(indices).dtype == bool else np.asarray(indices, dtype=np.intp)
+        return WordTable([self.texts[i] for i in indices], self.confidence[indices], self.boxes[indices])
+
+    def has_digits(self):
+        """Boolean mask of words containing a digit (potential measurements)"""
+        return np.fromiter((any(char.isdigit() for char in text) for text in self.texts), dtype=bool, count=len(self))
+
+    def centers(self):
+        """(N, 2) float array of box centers"""
+        return (self.boxes[:, :2] + self.boxes[:, 2:]) / 2.0
+
+    def bboxes(self, indices=None):
+        """Bounding box dicts (extract_text format) of all rows, or of the given rows"""
+        boxes = self.boxes if indices is None else self.boxes[indices]
+        return [
+            {
+                "x": x0,
+                "y": y0,
+                "width": x1 - x0,
+                "height": y1 - y0,
+                "center_x": (x0 + x1) / 2,
+                "center_y": (y0 + y1) / 2
+            }
+            for x0, y0, x1, y1 in boxes.tolist()
+        ]
+
+    def row(self, i):
+        return {"text": self.texts[i], "confidence": float(self.confidence[i]), "bbox": self.bboxes([i])[0]}
+
+    def to_dicts(self):
+        return [
+            {"text": text, "confidence": confidence, "bbox": bbox}
+            for text, confidence, bbox in zip(self.texts, self.confidence.tolist(), self.bboxes())
+        ]
+
+
+class SegmentTable:
+    """
+    Columnar segments: (x, y, w, h) boxes and one NumPy array per segment
+    field (plus an object array of source contours). Used throughout segmentation and linking instead of one dict per
+    segment; to_dicts() produces the detect_segments segment dicts for the API.
+    """
+
+    __slots__ = ("boxes", "area", "aspect_ratio", "extent", "vertices", "component_type", "predicted_iou", "contours")
+
+    def __init__(self, boxes=(), area=(), aspect_ratio=(), extent=(), vertices=(), component_type=(), predicted_iou=None,
+                 contours=None):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.area = np.asarray(area, dtype=np.int64).reshape(-1)
+        self.aspect_ratio = np.asarray(aspect_ratio, dtype=np.float64).reshape(-1)
+        self.extent = np.asarray(extent, dtype=np.float64).reshape(-1)
+        self.vertices = np.asarray(vertices, dtype=np.int32).reshape(-1)
+        self.component_type = np.asarray(component_type, dtype=object).reshape(-1)
+        if predicted_iou is None:
+            predicted_iou = np.minimum(self.extent * 0.95, 0.92)
+        self.predicted_iou = np.asarray(predicted_iou, dtype=np.float64).reshape(-1)
+        # Source contour of each row where known (segmentation keeps them for
+        # incremental updates); not part of the API output
+        if contours is None or isinstance(contours, np.ndarray):
+            self.contours = contours if contours is not None else np.full(len(self.boxes), None, dtype=object)
+        else:
+            self.contours = np.empty(len(self.boxes), dtype=object)
+            self.contours[:] = list(contours)
+
+    @classmethod
+    def from_dicts(cls, segments):
+        """Build a table from detect_segments segment dicts"""
+        return cls(
+            [seg["bbox"] for seg in segments],
+            [seg.get("area", 0) for seg in segments],
+            [seg.get("aspect_ratio", 0.0) for seg in segments],
+            [seg.get("extent", 0.0) for seg in segments],
+            [seg.get("vertices", 0) for seg in segments],
+            [seg.get("component_type", "component") for seg in segments],
+            [seg.get("predicted_iou", 0.0) for seg in segments],
+        )
+
+    @classmethod
+    def concat(cls, tables):
+        tables = [table for table in tables if len(table)]
+        if not tables:
+            return cls()
+        return cls(*(np.concatenate([getattr(table, name) for table in tables]) for name in cls.__slots__))
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __getitem__(self, i):
+        return self.row(i)
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __reduce__(self):
+        # Compact pickled form for results coming back from worker processes:
+        # component types as codes into their distinct names and all contours
+        # as one point array instead of an object array per row
+        names, codes = np.unique(self.component_type.astype(str), return_inverse=True)
+        known = np.array([contour is not None for contour in self.contours], dtype=bool)
+        contours = None
+        if known.any():
+            kept = self.contours[known]
+            lengths = np.array([len(contour) for contour in kept], dtype=np.int64)
+            points = np.concatenate([contour.reshape(-1, 2) for contour in kept]).astype(np.int32)
+            contours = (known, lengths, points)
+        columns = (self.boxes, self.area, self.aspect_ratio, self.extent, self.vertices, self.predicted_iou)
+        return _unpickle_segment_table, (columns, names.tolist(), codes.astype(np.int32), contours)
+
+    def without_contours(self):
+        """The same rows without their source contours (cheaper to pickle and store)"""
+        return SegmentTable(*(getattr(self, name) for name in self.__slots__[:-1]))
+
+    def take(self, indices):
+        """Return a new table with the given rows (indices or boolean mask)"""
+        return SegmentTable(*(getattr(self, name)[indices] for name in self.__slots__))
+
+    def row(self, i):
+        return {
+            "bbox": self.boxes[i].tolist(),
+            "area": int(self.area[i]),
+            "aspect_ratio": float(self.aspect_ratio[i]),
+            "extent": float(self.extent[i]),
+            "vertices": int(self.vertices[i]),
+            "component_type": self.component_type[i],
+            "predicted_iou": float(self.predicted_iou[i])
+        }
+
+    def to_dicts(self):
+        return [
+            {
+                "bbox": bbox,
+                "area": area,
+                "aspect_ratio": aspect_ratio,
+                "extent": extent,
+                "vertices": vertices,
+                "component_type": component_type,
+                "predicted_iou": predicted_iou
+            }
+            for bbox, area, aspect_ratio, extent, vertices, component_type, predicted_iou in zip(
+                self.boxes.tolist(), self.area.tolist(), self.aspect_ratio.tolist(), self.extent.tolist(),
+                self.vertices.tolist(), self.component_type.tolist(), self.predicted_iou.tolist()
+            )
+        ]
+
+
+def _unpickle_segment_table(columns, names, codes, contours):
+    boxes, area, aspect_ratio, extent, vertices, predicted_iou = columns
+    component_type = np.empty(len(codes), dtype=object)
+    component_type[:] = [names[code] for code in codes.tolist()]
+    rows = np.full(len(codes), None, dtype=object)
+    if contours is not None:
+        known, lengths, points = contours
+        for i, part in zip(np.flatnonzero(known).tolist(), np.split(points, np.cumsum(lengths)[:-1])):
+            rows[i] = part.reshape(-1, 1, 2)
+    return SegmentTable(boxes, area, aspect_ratio, extent, vertices, component_type, predicted_iou, rows)
+
+
+def as_segment_table(segments):
+    """Return segments as a SegmentTable (accepts a SegmentTable or a list of segment dicts)"""
+    return segments if isinstance(segments, SegmentTable) else SegmentTable.from_dicts(segments or [])
+
+
+# -------- API boundary --------
+
+def _encode_default(obj):
+    """Encoder fallback: tables become their JSON row lists, NumPy values become Python values"""
+    if isinstance(obj, (WordTable, SegmentTable)):
+        return obj.to_dicts()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def to_jsonable(obj):
+    """Recursively replace tables and NumPy values with plain JSON types"""
+    if isinstance(obj, dict):
+        return {key: to_jsonable(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_jsonable(value) for value in obj]
+    if isinstance(obj, (WordTable, SegmentTable, np.ndarray, np.generic)):
+        return _encode_default(obj)
+    return obj
+
+def dumps(obj):
+    """Encode a pipeline result as JSON bytes (orjson when installed)"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_encode_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=_encode_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
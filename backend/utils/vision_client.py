@@ -0,0 +1,454 @@
+import asyncio
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.ocr_cache import content_hash
+from utils.instrumentation import get_deadline, time_remaining
+
+logger = logging.getLogger(__name__)
+
+
+# Per-call Vision deadline in seconds; the request deadline (see
+# utils.instrumentation) shortens it, and a call that misses it fails over to
+# the next OCR backend instead of holding the request
+VISION_TIMEOUT = float(os.getenv("VISION_TIMEOUT", "30"))
+
+# Retries of failed Vision calls (429, 5xx, unavailable, and timeouts when a
+# request deadline leaves room for another attempt). Waits
+# between attempts grow from VISION_BACKOFF up to VISION_BACKOFF_MAX seconds
+# with full jitter. Retries also draw from a budget that earns
+# VISION_RETRY_BUDGET retries per call (plus a reserve of
+# VISION_RETRY_RESERVE), so during an outage retries cannot multiply the load.
+VISION_RETRIES = int(os.getenv("VISION_RETRIES", "2"))
+VISION_BACKOFF = float(os.getenv("VISION_BACKOFF", "0.2"))
+VISION_BACKOFF_MAX = float(os.getenv("VISION_BACKOFF_MAX", "2"))
+VISION_RETRY_BUDGET = float(os.getenv("VISION_RETRY_BUDGET", "0.2"))
+VISION_RETRY_RESERVE = float(os.getenv("VISION_RETRY_RESERVE", "10"))
+
+# Circuit breaker: after VISION_BREAKER_FAILURES failed calls in a row, Vision
+# is not called for VISION_BREAKER_RESET seconds (OCR falls back to the next
+# backend straight away); then one trial call decides whether to close it.
+# A trial that has not reported back after VISION_TIMEOUT is given up and the
+# next call becomes the trial.
+VISION_BREAKER_FAILURES = int(os.getenv("VISION_BREAKER_FAILURES", "5"))
+VISION_BREAKER_RESET = float(os.getenv("VISION_BREAKER_RESET", "30"))
+
+# HTTP statuses (google.api_core errors carry them as .code) and google.rpc
+# codes in per-image Vision errors that are worth retrying
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+RETRYABLE_RPC_CODES = (4, 8, 13, 14)  # DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, INTERNAL, UNAVAILABLE
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling Vision while the circuit breaker is open"""
+
+
+class RetryableResponse(Exception):
+    """A Vision response whose per-image error is transient"""
+
+    def __init__(self, response):
+        super().__init__(response.error.message)
+        self.response = response
+
+
+def is_timeout(error):
+    return isinstance(error, TimeoutError) or getattr(error, "code", None) in (408, 504)
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError, RetryableResponse)):
+        return True
+    return getattr(error, "code", None) in RETRYABLE_STATUS
+
+
+def check_response(response):
+    """Raise RetryableResponse for a single-image response with a transient error"""
+    error = getattr(response, "error", None)
+    if error is not None and error.code in RETRYABLE_RPC_CODES:
+        raise RetryableResponse(response)
+    return response
+
+
+class RetryBudget:
+    """Token bucket for retries: every call earns ratio tokens (up to reserve), every retry spends one"""
+
+    def __init__(self, ratio=VISION_RETRY_BUDGET, reserve=VISION_RETRY_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._tokens = reserve
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.reserve, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Take a token for a retry; False when the budget is spent"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker. Closed: calls go through. Open:
+    calls are refused until reset_after seconds have passed. Half open: one
+    trial call goes through; its outcome closes or re-opens the circuit. A
+    trial that ends without an outcome (cancel_trial) or takes longer than
+    trial_timeout lets the next call be the trial instead.
+    """
+
+    def __init__(self, failures=VISION_BREAKER_FAILURES, reset_after=VISION_BREAKER_RESET,
+                 trial_timeout=VISION_TIMEOUT):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.trial_timeout = trial_timeout
+        self.state = CLOSED
+        self._failed = 0
+        self._opened_at = 0.0
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go out now"""
+        if self.failures <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN and now - self._opened_at >= self.reset_after:
+                self.state = HALF_OPEN
+            elif not (self.state == HALF_OPEN and now - self._trial_started >= self.trial_timeout):
+                return self.state == CLOSED
+            self._trial_started = now
+            return True
+
+    def cancel_trial(self):
+        """Forget a half-open trial that ended without telling anything about Vision"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_started = float("-inf")
+
+    def record_success(self):
+        with self._lock:
+            self._failed = 0
+            if self.state != CLOSED:
+                logger.info("Vision circuit breaker closed")
+            self.state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and 0 < self.failures <= self._failed):
+                if self.state == CLOSED:
+                    logger.warning("Vision circuit breaker opened after %d failures", self._failed)
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+
+def check_deadline():
+    """The request deadline; raises TimeoutError if it has passed, so an expired caller never starts a shared call"""
+    remaining = time_remaining()
+    if remaining is not None and remaining <= 0:
+        raise TimeoutError("Request deadline exceeded before calling Vision")
+    return get_deadline()
+
+
+class Flight:
+    """A shared call in progress and the latest deadline among its callers (None once one has no deadline)"""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.future = None
+        self.extended = 0  # how many times a joining caller pushed the deadline out
+
+    def join(self, deadline):
+        if self.deadline is not None and (deadline is None or deadline > self.deadline):
+            self.deadline = deadline
+            self.extended += 1
+
+    def time_remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self):
+        remaining = self.time_remaining()
+        return remaining is not None and remaining <= 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller starts
+    fn(flight), the others wait for its result (or exception) instead of
+    making their own call. The call runs apart from every caller, under the
+    latest of their deadlines (flight.time_remaining), and each caller
+    waits only until its own deadline, so a caller with a short deadline
+    neither gives up the call for the others nor is held past it. A call
+    that timed out is run again if a caller joined with a later deadline
+    meanwhile, so a late joiner does not get a timeout it had time to avoid.
+    Works for threads (do) and for one event loop (do_async).
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> Flight, threads
+        self._async_calls = {}  # key -> Flight, event loop
+        self._lock = threading.Lock()
+        self._pool = None
+        self.coalesced = 0
+
+    def _get_pool(self):
+        # Threads running the shared sync calls; the callers wait on them
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(thread_name_prefix="vision")
+            return self._pool
+
+    def do(self, key, fn):
+        deadline = check_deadline()
+        pool = self._get_pool()
+        with self._lock:
+            flight = self._calls.get(key)
+            if flight is None:
+                flight = self._calls[key] = Flight(deadline)
+                flight.future = pool.submit(contextvars.copy_context().run, self._run, key, flight, fn)
+            else:
+                flight.join(deadline)
+                self.coalesced += 1
+        remaining = time_remaining()
+        try:
+            return flight.future.result(timeout=None if remaining is None else max(remaining, 0))
+        except TimeoutError:
+            if flight.future.done():
+                return flight.future.result()
+            raise TimeoutError("Request deadline exceeded waiting for Vision") from None
+
+    def _run(self, key, flight, fn):
+        while True:
+            extended = flight.extended
+            try:
+                result = fn(flight)
+            except TimeoutError:
+                with self._lock:
+                    if flight.extended != extended and not flight.expired():
+                        continue
+                    del self._calls[key]
+                raise
+            except BaseException:
+                with self._lock:
+                    del self._calls[key]
+                raise
+            with self._lock:
+                del self._calls[key]
+            return result
+
+    async def _run_async(self, flight, fn):
+        while True:
+            extended = flight.extended
+            try:
+                return await fn(flight)
+            except TimeoutError:
+                if flight.extended == extended or flight.expired():
+                    raise
+
+    async def do_async(self, key, fn):
+        # The call runs as its own task, so a caller that gives up (cancelled
+        # or past its deadline) does not cancel it for the others
+        deadline = check_deadline()
+        flight = self._async_calls.get(key)
+        if flight is None or flight.future.done():  # a finished call waiting for _call_done is not joined
+            flight = self._async_calls[key] = Flight(deadline)
+            flight.future = asyncio.ensure_future(self._run_async(flight, fn))
+            flight.future.add_done_callback(lambda done: self._call_done(key, done))
+        else:
+            flight.join(deadline)
+            self.coalesced += 1
+        task = flight.future
+        remaining = time_remaining()
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), None if remaining is None else max(remaining, 0))
+        except asyncio.TimeoutError:
+            if task.done():
+                return task.result()
+            raise TimeoutError("Request deadline exceeded waiting for Vision") from None
+
+    def _call_done(self, key, task):
+        if self._async_calls.get(key) is not None and self._async_calls[key].future is task:
+            del self._async_calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here in case every caller gave up
+
+
+class ManagedVisionClient:
+    """
+    Vision calls with a timeout per attempt (VISION_TIMEOUT, shortened to
+    the request deadline), jittered retries within a retry budget, a
+    circuit breaker, and single-flight coalescing of identical in-flight
+    single-image requests. get_client returns the shared sync client
+    (one gRPC channel for everything) and get_async_client the asyncio
+    client of the running loop.
+    """
+
+    def __init__(self, get_client, get_async_client=None, timeout=VISION_TIMEOUT, retries=VISION_RETRIES,
+                 backoff=VISION_BACKOFF, backoff_max=VISION_BACKOFF_MAX, budget=None, breaker=None):
+        self.get_client = get_client
+        self.get_async_client = get_async_client
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.single_flight = SingleFlight()
+
+    def attempt_timeout(self, remaining=time_remaining):
+        """Timeout for the next attempt; raises TimeoutError once the deadline (remaining() seconds away) has passed"""
+        remaining = remaining()
+        if remaining is None:
+            return self.timeout
+        if remaining <= 0:
+            raise TimeoutError("Request deadline exceeded before calling Vision")
+        return min(self.timeout, remaining)
+
+    def retry_delay(self, attempt, error, remaining=time_remaining, timeout=None):
+        """
+        Backoff before retry number attempt + 1, or None if the call should
+        fail now. Without a deadline, an attempt that ran out its whole
+        timeout is not retried: Vision is hanging, and the next OCR backend
+        should take over instead of waiting out every retry.
+        """
+        if not is_retryable(error) or attempt >= self.retries:
+            return None
+        remaining = remaining()
+        if remaining is None and is_timeout(error) and timeout is not None and timeout >= self.timeout:
+            return None
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+        if remaining is not None and remaining <= delay:
+            return None
+        if not self.budget.withdraw():
+            logger.warning("Vision retry budget exhausted, not retrying")
+            return None
+        return delay
+
+    def _before_attempt(self, remaining):
+        # The deadline is checked first: an attempt refused for it must not
+        # take the half-open trial slot
+        timeout = self.attempt_timeout(remaining)
+        if not self.breaker.allow():
+            raise CircuitOpen("Vision circuit breaker is open")
+        return timeout
+
+    def _after_failure(self, attempt, error, timeout, remaining):
+        # Only service-side trouble counts against the breaker; a rejected
+        # request still shows that Vision is up, and a timeout shortened by
+        # the caller's deadline shows nothing either way
+        if is_timeout(error) and timeout < self.timeout:
+            self.breaker.cancel_trial()
+        elif is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        delay = self.retry_delay(attempt, error, remaining, timeout)
+        if delay is not None:
+            logger.info("Vision call failed (%s), retry %d in %.2fs", error, attempt + 1, delay)
+        return delay
+
+    def call(self, fn, remaining=time_remaining):
+        """
+        Run fn(timeout) -> response with retries and the circuit breaker,
+        until the deadline remaining() seconds away (the request deadline by
+        default)
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            timeout = self._before_attempt(remaining)
+            try:
+                response = fn(timeout)
+            except Exception as e:
+                delay = self._after_failure(attempt, e, timeout, remaining)
+                if delay is None:
+                    if isinstance(e, RetryableResponse):
+                        return e.response
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.cancel_trial()
+                raise
+            self.breaker.record_success()
+            return response
+
+    async def call_async(self, fn, remaining=time_remaining):
+        """call for a coroutine function fn(timeout)"""
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            timeout = self._before_attempt(remaining)
+            try:
+                response = await fn(timeout)
+            except Exception as e:
+                delay = self._after_failure(attempt, e, timeout, remaining)
+                if delay is None:
+                    if isinstance(e, RetryableResponse):
+                        return e.response
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            except BaseException:
+                # Cancelled mid-call
+                self.breaker.cancel_trial()
+                raise
+            self.breaker.record_success()
+            return response
+
+    def document_text(self, content, key=None):
+        """AnnotateImageResponse of document text detection for one image"""
+        from google.cloud import vision
+
+        def attempt(timeout):
+            logger.debug("Sending to Google Cloud Vision API...")
+            response = self.get_client().document_text_detection(image=vision.Image(content=content), timeout=timeout)
+            return check_response(response)
+        return self.single_flight.do(key or content_hash(content), lambda flight: self.call(attempt, flight.time_remaining))
+
+    def document_text_batch(self, contents):
+        """BatchAnnotateImagesResponse of document text detection for up to VISION_BATCH_LIMIT images"""
+        from google.cloud import vision
+        requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+            )
+            for content in contents
+        ]
+
+        def attempt(timeout):
+            logger.debug("Sending %d images to Google Cloud Vision API...", len(requests))
+            return self.get_client().batch_annotate_images(requests=requests, timeout=timeout)
+        return self.call(attempt)
+
+    async def document_text_async(self, content, key=None):
+        """document_text on the asyncio gRPC client, without blocking the event loop"""
+        from google.cloud import vision
+        request = vision.AnnotateImageRequest(
+            image=vision.Image(content=content),
+            features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+        )
+
+        async def attempt(timeout):
+            logger.debug("Sending to Google Cloud Vision API (async)...")
+            response = await self.get_async_client().batch_annotate_images(requests=[request], timeout=timeout)
+            return check_response(response.responses[0])
+        return await self.single_flight.do_async(
+            key or content_hash(content), lambda flight: self.call_async(attempt, flight.time_remaining)
+        )
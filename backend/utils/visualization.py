@@ -0,0 +1,102 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from utils.image_processing import load_image
+from utils.instrumentation import stage
+from utils.tables import as_segment_table
+
+
+OVERLAY_MEDIA_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+}
+
+# Fixed BGR palette so the same segment index always gets the same color
+PALETTE = [
+    (230, 25, 75), (60, 180, 75), (0, 130, 200), (245, 130, 48),
+    (145, 30, 180), (70, 240, 240), (240, 50, 230), (0, 128, 128),
+]
+LINK_COLOR = (0, 0, 255)
+MEASUREMENT_COLOR = (0, 160, 255)
+
+
+def draw_overlay(image, segments, links=None):
+    """Draw segment boxes (SegmentTable or segment dicts) and measurement links onto image in place"""
+    thickness = max(1, round(max(image.shape[:2]) / 500))
+    font_scale = 0.4 * thickness
+
+    segments = as_segment_table(segments)
+    rows = zip(segments.boxes.tolist(), segments.component_type.tolist(), segments.predicted_iou.tolist())
+    for i, ((x, y, w, h), component_type, predicted_iou) in enumerate(rows):
+        color = PALETTE[i % len(PALETTE)]
+        cv2.rectangle(image, (x, y), (x + w, y + h), color, thickness)
+        label = f"{component_type} {predicted_iou:.2f}"
+        cv2.putText(image, label, (x, max(y - 5, 10)), cv2.FONT_HERSHEY_SIMPLEX,
+                    font_scale, color, thickness, cv2.LINE_AA)
+
+    for link in links or []:
+        bbox = link["measurement_bbox"]
+        cv2.rectangle(
+            image,
+            (int(bbox["x"]), int(bbox["y"])),
+            (int(bbox["x"] + bbox["width"]), int(bbox["y"] + bbox["height"])),
+            MEASUREMENT_COLOR, thickness
+        )
+        m_x, m_y = link["connection"]["measurement"]
+        s_x, s_y = link["connection"]["segment"]
+        cv2.line(image, (int(m_x), int(m_y)), (int(s_x), int(s_y)), LINK_COLOR, thickness, cv2.LINE_AA)
+
+    return image
+
+
+@stage("visualization")
+def render_overlay(image, segments, links=None, fmt="png"):
+    """
+    Render segments and links over the image and return encoded PNG/JPEG bytes.
+    image is a file path, encoded bytes or a decoded ndarray (left untouched).
+    """
+    fmt = fmt.lower()
+    if fmt not in OVERLAY_MEDIA_TYPES:
+        raise ValueError(f"Unsupported overlay format: {fmt}")
+
+    if isinstance(image, np.ndarray):
+        image = image.copy()
+    else:
+        image = load_image(image)
+    if image is None:
+        raise ValueError("Failed to read image")
+
+    draw_overlay(image, segments, links)
+    ok, encoded = cv2.imencode(".png" if fmt == "png" else ".jpg", image)
+    if not ok:
+        raise ValueError("Failed to encode overlay")
+    return encoded.tobytes()
+
+
+class OverlayCache:
+    """Small in-memory LRU of rendered overlays, served by GET /overlays/{id}"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # id -> (media_type, bytes)
+        self._lock = threading.Lock()
+
+    def put(self, data, fmt):
+        overlay_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[overlay_id] = (OVERLAY_MEDIA_TYPES[fmt.lower()], data)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return overlay_id
+
+    def get(self, overlay_id):
+        with self._lock:
+            return self._entries.get(overlay_id)
+
+
+overlay_cache = OverlayCache()